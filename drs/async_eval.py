@@ -0,0 +1,96 @@
+import multiprocessing as mp
+import queue
+from collections import defaultdict
+
+import gymnasium as gym
+import numpy as np
+import torch
+from gymnasium.vector.utils import CloudpickleWrapper
+
+
+def _eval_worker(env_fns, actor_fn, num_episodes, seed, jobs, results):
+    torch.set_num_threads(1)
+    # the worker is a daemon process and cannot have children, so its envs are stepped in-process
+    eval_envs = gym.vector.SyncVectorEnv(env_fns.fn)
+    eval_envs.reset(seed=seed) # seed eval_envs here, and no more seeding during evaluation
+    actor = actor_fn.fn(eval_envs)
+    actor.eval()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        global_step, weights = job
+        actor.load_state_dict({k: torch.from_numpy(v) for k, v in weights.items()})
+        result = defaultdict(list)
+        obs, info = eval_envs.reset() # don't seed here
+        while len(result['return']) < num_episodes:
+            with torch.no_grad():
+                action = actor.get_eval_action(torch.Tensor(obs))
+            obs, rew, terminated, truncated, info = eval_envs.step(action.numpy())
+            if "final_info" in info:
+                for i in np.where(info["_final_info"])[0]:
+                    ep = info["final_info"][i]['episode']
+                    result['return'].append(ep['r'][0])
+                    result['len'].append(ep['l'][0])
+                    result['success'].append(info["final_info"][i]['success'])
+        results.put((global_step, dict(result)))
+    eval_envs.close()
+
+
+class AsyncEvaluator(object):
+    # Evaluates snapshots of the actor in a separate process, so that evaluation (and video
+    # rendering) does not block collection and learning. Results are returned together with the
+    # global step at which the snapshot was taken.
+    def __init__(self, env_fns, actor_fn, num_episodes, seed, max_in_flight=2):
+        ctx = mp.get_context('forkserver')
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._process = ctx.Process(
+            target=_eval_worker,
+            args=(CloudpickleWrapper(env_fns), CloudpickleWrapper(actor_fn), num_episodes, seed, self._jobs, self._results),
+            daemon=True,
+        )
+        self._process.start()
+        self.max_in_flight = max_in_flight
+        self.n_in_flight = 0
+        self._finished = []
+
+    def submit(self, global_step, actor):
+        # waits for the oldest evaluation if too many are in flight
+        while self.n_in_flight >= self.max_in_flight:
+            self._finished.append(self._get())
+        weights = {k: v.detach().cpu().numpy().copy() for k, v in actor.state_dict().items()}
+        self._jobs.put((global_step, weights))
+        self.n_in_flight += 1
+
+    def poll(self):
+        # finished evaluations as a list of (global_step, result)
+        while self.n_in_flight > 0:
+            try:
+                self._finished.append(self._get(block=False))
+            except queue.Empty:
+                break
+        finished, self._finished = self._finished, []
+        return finished
+
+    def close(self):
+        # waits for all evaluations in flight and returns their results
+        while self.n_in_flight > 0:
+            self._finished.append(self._get())
+        self._jobs.put(None)
+        self._process.join()
+        finished, self._finished = self._finished, []
+        return finished
+
+    def _get(self, block=True):
+        while True:
+            try:
+                ret = self._results.get(block=block, timeout=1.0 if block else None)
+                break
+            except queue.Empty:
+                if not block:
+                    raise
+                if not self._process.is_alive():
+                    raise RuntimeError(f'evaluation process exited with code {self._process.exitcode}')
+        self.n_in_flight -= 1
+        return ret
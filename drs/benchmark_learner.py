@@ -0,0 +1,280 @@
+import argparse
+import itertools
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import gymnasium as gym
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from stable_baselines3.common.buffers import ReplayBuffer
+
+from drs.data_utils import load_demo_dataset
+from drs.drs_learn_reward_maniskill2 import (
+    Actor, SoftQNetwork, Discriminator, DiscriminatorBuffer, sample_from_multi_buffers, sample_stage_labelled,
+)
+
+# Micro-benchmarks of the DrS learner components, no ManiSkill2 or GPU needed.
+# Usage:
+#   python -m drs.benchmark_learner --save benchmarks/learner_baseline.json
+#   python -m drs.benchmark_learner --compare benchmarks/learner_baseline.json --threshold 0.2
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--obs-dims", type=int, nargs='+', default=[32, 64])
+    parser.add_argument("--act-dim", type=int, default=7)
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[256, 1024])
+    parser.add_argument("--n-stages", type=int, nargs='+', default=[2, 3])
+    parser.add_argument("--buffer-sizes", type=int, nargs='+', default=[100_000])
+    parser.add_argument("--repeat", type=int, default=50,
+        help="the number of timed calls per benchmark")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--filter", type=str, default=None,
+        help="only run the benchmarks whose name contains this string")
+    parser.add_argument("--device", type=str, default='cpu')
+    parser.add_argument("--save", type=str, default=None,
+        help="the path to write the results to as a json baseline")
+    parser.add_argument("--compare", type=str, default=None,
+        help="the path of a json baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+        help="the relative slowdown of the median time that counts as a regression")
+    return parser.parse_args()
+
+
+def make_spaces(obs_dim, act_dim):
+    return SimpleNamespace(
+        single_observation_space=gym.spaces.Box(-np.inf, np.inf, (obs_dim,), dtype=np.float32),
+        single_action_space=gym.spaces.Box(-1, 1, (act_dim,), dtype=np.float32),
+    )
+
+def make_stage_buffers(envs, n_stages, buffer_size, device):
+    buffers = [DiscriminatorBuffer(buffer_size, envs.single_observation_space, envs.single_action_space, device)
+               for _ in range(n_stages + 1)]
+    for b in buffers:
+        b.add(np.random.randn(buffer_size, *envs.single_observation_space.shape).astype(np.float32))
+    return buffers
+
+def make_replay_buffer(envs, buffer_size, device):
+    rb = ReplayBuffer(buffer_size, envs.single_observation_space, envs.single_action_space, device,
+                      n_envs=1, handle_timeout_termination=False)
+    rb.observations[:] = np.random.randn(*rb.observations.shape)
+    rb.next_observations[:] = np.random.randn(*rb.next_observations.shape)
+    rb.actions[:] = np.random.uniform(-1, 1, rb.actions.shape)
+    rb.full = True
+    return rb
+
+def write_demo_file(path, obs_dim, act_dim, n_traj=100, traj_len=100):
+    trajectories = [{
+        'observations': np.random.randn(traj_len + 1, obs_dim).astype(np.float32),
+        'actions': np.random.uniform(-1, 1, (traj_len, act_dim)).astype(np.float32),
+    } for _ in range(n_traj)]
+    with open(path, 'wb') as f:
+        pickle.dump(trajectories, f)
+
+
+def make_update_fn(envs, n_stages, batch_size, buffer_size, device, gamma=0.8, tau=0.005):
+    # one update of drs_learn_reward_maniskill2.py: discriminator step for every stage, then SAC
+    rb = make_replay_buffer(envs, buffer_size, device)
+    stage_buffers = make_stage_buffers(envs, n_stages, buffer_size, device)
+    disc = Discriminator(envs, n_stages).to(device)
+    disc_optimizer = optim.Adam(disc.parameters(), lr=3e-4)
+    actor = Actor(envs).to(device)
+    qf1, qf2 = SoftQNetwork(envs).to(device), SoftQNetwork(envs).to(device)
+    qf1_target, qf2_target = SoftQNetwork(envs).to(device), SoftQNetwork(envs).to(device)
+    qf1_target.load_state_dict(qf1.state_dict())
+    qf2_target.load_state_dict(qf2.state_dict())
+    q_optimizer = optim.Adam(list(qf1.parameters()) + list(qf2.parameters()), lr=3e-4)
+    actor_optimizer = optim.Adam(list(actor.parameters()), lr=3e-4)
+    target_entropy = -float(np.prod(envs.single_action_space.shape))
+    log_alpha = torch.zeros(1, requires_grad=True, device=device)
+    a_optimizer = optim.Adam([log_alpha], lr=3e-4)
+
+    def update():
+        data = rb.sample(batch_size)
+        for stage_idx in range(n_stages):
+            success_data = sample_from_multi_buffers(stage_buffers[stage_idx+1:], batch_size)
+            fail_data = sample_from_multi_buffers(stage_buffers[:stage_idx+1], batch_size)
+            disc_next_obs = torch.cat([fail_data['next_observations'], success_data['next_observations']], dim=0)
+            disc_labels = torch.cat([
+                torch.zeros((batch_size, 1), device=device),
+                torch.ones((batch_size, 1), device=device),
+            ], dim=0)
+            disc_loss = F.binary_cross_entropy_with_logits(disc(disc_next_obs, stage_idx), disc_labels)
+            disc_optimizer.zero_grad()
+            disc_loss.backward()
+            disc_optimizer.step()
+            disc.set_trained(stage_idx)
+
+        stage_idx = torch.randint(0, n_stages + 1, (batch_size, 1), device=device).float()
+        disc_rewards = disc.get_reward(data.next_observations, stage_idx, stage_idx == n_stages)
+        alpha = log_alpha.exp().item()
+        with torch.no_grad():
+            next_state_actions, next_state_log_pi, _ = actor.get_action(data.next_observations)
+            qf1_next_target = qf1_target(data.next_observations, next_state_actions)
+            qf2_next_target = qf2_target(data.next_observations, next_state_actions)
+            min_qf_next_target = torch.min(qf1_next_target, qf2_next_target) - alpha * next_state_log_pi
+            next_q_value = disc_rewards.flatten() + (1 - data.dones.flatten()) * gamma * (min_qf_next_target).view(-1)
+        qf1_a_values = qf1(data.observations, data.actions).view(-1)
+        qf2_a_values = qf2(data.observations, data.actions).view(-1)
+        qf_loss = F.mse_loss(qf1_a_values, next_q_value) + F.mse_loss(qf2_a_values, next_q_value)
+        q_optimizer.zero_grad()
+        qf_loss.backward()
+        q_optimizer.step()
+
+        pi, log_pi, _ = actor.get_action(data.observations)
+        min_qf_pi = torch.min(qf1(data.observations, pi), qf2(data.observations, pi))
+        actor_loss = ((alpha * log_pi) - min_qf_pi).mean()
+        actor_optimizer.zero_grad()
+        actor_loss.backward()
+        actor_optimizer.step()
+        with torch.no_grad():
+            _, log_pi, _ = actor.get_action(data.observations)
+        alpha_loss = (-log_alpha * (log_pi + target_entropy)).mean()
+        a_optimizer.zero_grad()
+        alpha_loss.backward()
+        a_optimizer.step()
+
+        for param, target_param in zip(qf1.parameters(), qf1_target.parameters()):
+            target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+        for param, target_param in zip(qf2.parameters(), qf2_target.parameters()):
+            target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    return update
+
+
+def make_benchmarks(args, device, tmp_dir):
+    # yields (name, params, fn); setup happens lazily so that --filter skips it
+    for obs_dim, batch_size, n_stages in itertools.product(args.obs_dims, args.batch_sizes, args.n_stages):
+        envs = make_spaces(obs_dim, args.act_dim)
+        x = torch.randn(batch_size, obs_dim, device=device)
+        params = dict(obs_dim=obs_dim, batch_size=batch_size, n_stages=n_stages)
+        def disc_forward(envs=envs, x=x, n_stages=n_stages):
+            disc = Discriminator(envs, n_stages).to(device)
+            return lambda: disc(x, n_stages - 1)
+        yield 'Discriminator.forward', params, disc_forward
+        def disc_get_reward(envs=envs, x=x, n_stages=n_stages, batch_size=batch_size):
+            disc = Discriminator(envs, n_stages).to(device)
+            for i in range(n_stages):
+                disc.set_trained(i)
+            stage_idx = torch.randint(0, n_stages + 1, (batch_size, 1), device=device).float()
+            success = stage_idx == n_stages
+            return lambda: disc.get_reward(x, stage_idx, success)
+        yield 'Discriminator.get_reward', params, disc_get_reward
+
+    for obs_dim, batch_size in itertools.product(args.obs_dims, args.batch_sizes):
+        envs = make_spaces(obs_dim, args.act_dim)
+        x = torch.randn(batch_size, obs_dim, device=device)
+        a = torch.rand(batch_size, args.act_dim, device=device) * 2 - 1
+        params = dict(obs_dim=obs_dim, batch_size=batch_size)
+        def actor_get_action(envs=envs, x=x):
+            actor = Actor(envs).to(device)
+            return lambda: actor.get_action(x)
+        yield 'Actor.get_action', params, actor_get_action
+        def q_forward(envs=envs, x=x, a=a):
+            qf = SoftQNetwork(envs).to(device)
+            return lambda: qf(x, a)
+        yield 'SoftQNetwork.forward', params, q_forward
+
+    for obs_dim, buffer_size in itertools.product(args.obs_dims, args.buffer_sizes):
+        envs = make_spaces(obs_dim, args.act_dim)
+        params = dict(obs_dim=obs_dim, buffer_size=buffer_size)
+        def buffer_add(envs=envs, buffer_size=buffer_size):
+            b = DiscriminatorBuffer(buffer_size, envs.single_observation_space, envs.single_action_space, device)
+            traj = np.random.randn(100, *envs.single_observation_space.shape).astype(np.float32)
+            return lambda: b.add(traj)
+        yield 'DiscriminatorBuffer.add', params, buffer_add
+        for batch_size in args.batch_sizes:
+            def buffer_sample(envs=envs, buffer_size=buffer_size, batch_size=batch_size):
+                b, = make_stage_buffers(envs, 0, buffer_size, device)
+                return lambda: b.sample(batch_size)
+            yield 'DiscriminatorBuffer.sample', dict(params, batch_size=batch_size), buffer_sample
+            for n_stages in args.n_stages:
+                def multi_sample(envs=envs, buffer_size=buffer_size, batch_size=batch_size, n_stages=n_stages):
+                    buffers = make_stage_buffers(envs, n_stages, buffer_size, device)
+                    return lambda: sample_from_multi_buffers(buffers, batch_size)
+                yield 'sample_from_multi_buffers', dict(params, batch_size=batch_size, n_stages=n_stages), multi_sample
+                def stage_labelled_sample(envs=envs, buffer_size=buffer_size, batch_size=batch_size, n_stages=n_stages):
+                    buffers = make_stage_buffers(envs, n_stages, buffer_size, device)
+                    return lambda: sample_stage_labelled(buffers, 2 * batch_size, device)
+                yield 'sample_stage_labelled', dict(params, batch_size=batch_size, n_stages=n_stages), stage_labelled_sample
+                def update(envs=envs, buffer_size=buffer_size, batch_size=batch_size, n_stages=n_stages):
+                    return make_update_fn(envs, n_stages, batch_size, buffer_size, device)
+                yield 'update', dict(params, batch_size=batch_size, n_stages=n_stages), update
+
+    for obs_dim in args.obs_dims:
+        def load_demo(obs_dim=obs_dim):
+            path = os.path.join(tmp_dir, f'demo_{obs_dim}.pkl')
+            write_demo_file(path, obs_dim, args.act_dim)
+            return lambda: load_demo_dataset(path, keys=['next_observations'])
+        yield 'load_demo_dataset', dict(obs_dim=obs_dim), load_demo
+
+
+def run_benchmark(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = np.zeros(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+    return dict(median=float(np.median(times)), mean=float(times.mean()), min=float(times.min()), std=float(times.std()))
+
+def benchmark_key(name, params):
+    return name + '[' + ','.join(f'{k}={v}' for k, v in params.items()) + ']'
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, params, setup in make_benchmarks(args, device, tmp_dir):
+            key = benchmark_key(name, params)
+            if args.filter and args.filter not in key:
+                continue
+            results[key] = run_benchmark(setup(), args.repeat, args.warmup)
+            print(f"{key:<90s} median={results[key]['median'] * 1e3:9.3f}ms  std={results[key]['std'] * 1e3:8.3f}ms")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({
+                'meta': dict(
+                    python=platform.python_version(), torch=torch.__version__, numpy=np.__version__,
+                    machine=platform.machine(), processor=platform.processor(), device=args.device,
+                ),
+                'results': results,
+            }, f, indent=4)
+        print(f'Saved {len(results)} results to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for key, r in results.items():
+            if key not in baseline['results']:
+                continue
+            ratio = r['median'] / baseline['results'][key]['median']
+            status = 'REGRESSION' if ratio > 1 + args.threshold else 'ok'
+            print(f'{key:<90s} {ratio:6.2f}x  {status}')
+            if status != 'ok':
+                regressions.append(key)
+        print(f"Compared against {args.compare} (torch {baseline['meta']['torch']}, numpy {baseline['meta']['numpy']}): "
+              f'{len(regressions)} regressions above {args.threshold:.0%}')
+        if regressions:
+            sys.exit(1)
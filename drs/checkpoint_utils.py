@@ -0,0 +1,176 @@
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+BUFFER_ARRAYS = ('observations', 'next_observations', 'actions', 'rewards', 'dones', 'timeouts')
+BUFFER_FIELDS = ('pos', 'full', 'n_added', 'n_saved', 'n_saved_rows', 'n_saved_trajs', 'traj_lengths', 'traj_ids', 'traj_versions', 'n_trajs')
+
+
+def get_rng_state():
+    state = dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+    )
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def to_cpu(obj):
+    # copy a (nested) state dict to cpu, so that training can go on while it is written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def buffer_arrays(buffer):
+    # works for both stable-baselines3 ReplayBuffer and DiscriminatorBuffer
+    return [k for k in BUFFER_ARRAYS if isinstance(getattr(buffer, k, None), np.ndarray)]
+
+
+class TrainingCheckpointer(object):
+    # Writes full training states to `ckpt_dir` in a background thread.
+    # Buffers are ring buffers along axis 0 (`pos`, `full`, `buffer_size`), and are mirrored into
+    # .npy files of their full size, of which only the rows inserted since the last save are written.
+    # Buffers that write rows anywhere (TrajectoryReservoirBuffer) list those rows in `rows_inserted_since`.
+    # The rows of a save are first written to a delta file, which the new state.pt references, and only
+    # copied into the .npy files once state.pt is replaced. A save interrupted before that leaves the
+    # previous state.pt and its .npy files untouched, and `load` replays the delta of the state it loads,
+    # which completes a copy that was interrupted.
+    def __init__(self, ckpt_dir):
+        self.ckpt_dir = ckpt_dir
+        os.makedirs(ckpt_dir, exist_ok=True)
+        self._n_inserted = {} # buffer name -> number of insertions at the last save
+        self._generation = 0 # number of the last state saved
+        self._error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, global_step, state, buffers={}):
+        # state: nested dict of tensors / python objects
+        # buffers: name -> (buffer, number of rows ever inserted into it)
+        self._raise_error()
+        buffer_deltas = {}
+        for name, (buffer, n_inserted) in buffers.items():
+            if hasattr(buffer, 'rows_inserted_since'):
+                idxs, _ = buffer.rows_inserted_since(self._n_inserted.get(name, 0))
+            else:
+                k = min(n_inserted - self._n_inserted.get(name, 0), buffer.buffer_size)
+                idxs = (buffer.pos - k + np.arange(k)) % buffer.buffer_size
+            buffer_deltas[name] = dict(
+                idxs=idxs,
+                rows={a: getattr(buffer, a)[idxs] for a in buffer_arrays(buffer)},
+                shapes={a: getattr(buffer, a).shape for a in buffer_arrays(buffer)},
+                dtypes={a: getattr(buffer, a).dtype for a in buffer_arrays(buffer)},
+            )
+            state.setdefault('buffers', {})[name] = {f: getattr(buffer, f) for f in BUFFER_FIELDS if hasattr(buffer, f)}
+            state['buffers'][name]['n_inserted'] = n_inserted
+            self._n_inserted[name] = n_inserted
+        self._generation += 1
+        state['generation'] = self._generation
+        state['buffer_deltas'] = {name: f'{name}.delta.{self._generation}.npz' for name in buffer_deltas}
+        state['global_step'] = global_step
+        # blocks only if the previous state is still being written
+        self._queue.put((to_cpu(state), buffer_deltas))
+
+    def load(self, buffers={}, map_location=None):
+        # restore buffers in place and return the rest of the training state
+        state = torch.load(os.path.join(self.ckpt_dir, 'state.pt'), map_location=map_location, weights_only=False)
+        for delta_file in state.get('buffer_deltas', {}).values():
+            self._apply_delta(delta_file)
+        self._generation = state.get('generation', 0)
+        for name, buffer in buffers.items():
+            for a in buffer_arrays(buffer):
+                saved = np.load(os.path.join(self.ckpt_dir, f'{name}.{a}.npy'), mmap_mode='r')
+                assert saved.shape == getattr(buffer, a).shape, \
+                    f"{name}.{a} has shape {saved.shape} in the checkpoint but {getattr(buffer, a).shape} in this run"
+                getattr(buffer, a)[:] = saved
+            for f, v in state['buffers'][name].items():
+                if f in BUFFER_FIELDS:
+                    setattr(buffer, f, v)
+            self._n_inserted[name] = state['buffers'][name]['n_inserted']
+        return state
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.ckpt_dir, 'state.pt'))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('writing the training state failed') from self._error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if self._error is None:
+                try:
+                    self._write(*job)
+                except Exception as e:
+                    self._error = e
+
+    def _write(self, state, buffer_deltas):
+        # 1. the delta files, which no state.pt references yet
+        for name, delta in buffer_deltas.items():
+            path = os.path.join(self.ckpt_dir, state['buffer_deltas'][name])
+            arrays = {'idxs': delta['idxs']}
+            for a, rows in delta['rows'].items():
+                arrays[f'rows.{a}'] = rows
+                arrays[f'shape.{a}'] = np.array(delta['shapes'][a], dtype=np.int64)
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        # 2. the state, which commits the deltas
+        path = os.path.join(self.ckpt_dir, 'state.pt')
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        # 3. the deltas into the .npy files, the older deltas are no longer needed
+        for delta_file in state['buffer_deltas'].values():
+            self._apply_delta(delta_file)
+        for name in os.listdir(self.ckpt_dir):
+            if '.delta.' in name and name not in state['buffer_deltas'].values():
+                os.remove(os.path.join(self.ckpt_dir, name))
+        print(f"Saved training state at global_step={state['global_step']} to {self.ckpt_dir}")
+
+    def _apply_delta(self, delta_file):
+        # copies the rows of a delta file into the .npy files of its buffer, can be repeated
+        name = delta_file[:delta_file.index('.delta.')]
+        with np.load(os.path.join(self.ckpt_dir, delta_file)) as delta:
+            idxs = delta['idxs']
+            for key in delta.files:
+                if not key.startswith('rows.'):
+                    continue
+                a = key[len('rows.'):]
+                rows = delta[key]
+                path = os.path.join(self.ckpt_dir, f'{name}.{a}.npy')
+                if os.path.exists(path):
+                    mm = np.load(path, mmap_mode='r+')
+                else:
+                    mm = np.lib.format.open_memmap(path, mode='w+', dtype=rows.dtype, shape=tuple(int(n) for n in delta[f'shape.{a}']))
+                mm[idxs] = rows
+                mm.flush()
+                del mm
@@ -1,5 +1,8 @@
 import numpy as np
 import pickle
+import json
+import os
+import glob
 
 def load_demo_dataset(path, keys=['observations', 'actions'], num_traj=None, success_only=False):
     with open(path, 'rb') as f:
@@ -43,4 +46,66 @@ def load_raw_trajectories(path, num_traj=None, success_only=False):
         trajectories = trajectories[:num_traj]
     # trajectories is a list of trajectory
     # trajectories[0] has keys like: ['actions', 'dones', ...]
-    return trajectories
\ No newline at end of file
+    return trajectories
+
+def load_trajectory_shards(path, num_traj=None, success_only=False):
+    # load trajectories written by drs.traj_logger.TrajectoryLogger
+    trajectories = []
+    for shard_path in sorted(glob.glob(os.path.join(path, 'traj_*.npz'))):
+        with np.load(shard_path) as shard:
+            ends = np.cumsum(shard['traj_lengths'])
+            next_obs = np.split(shard['next_observations'], ends[:-1])
+            stage_indices = np.split(shard['stage_indices'], ends[:-1])
+            for i in range(len(ends)):
+                trajectories.append({
+                    'next_observations': next_obs[i],
+                    'stage_indices': stage_indices[i],
+                    'success': bool(shard['success'][i]),
+                    'stage': int(shard['traj_stages'][i]),
+                })
+    if success_only:
+        trajectories = [t for t in trajectories if t['success']]
+    if num_traj is not None:
+        trajectories = trajectories[:num_traj]
+    return trajectories
+
+def append_rows(path, rows):
+    # append-only row storage: raw rows in `<path>.bin`, committed row count in `<path>.json`
+    rows = np.ascontiguousarray(rows)
+    n_rows = 0
+    if os.path.exists(path + '.json'):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        assert tuple(meta['shape']) == rows.shape[1:] and np.dtype(meta['dtype']) == rows.dtype, \
+            f"cannot append rows of shape {rows.shape[1:]} and dtype {rows.dtype} to {path}"
+        n_rows = meta['rows']
+    with open(path + '.bin', 'ab') as f:
+        f.truncate(n_rows * rows.dtype.itemsize * int(np.prod(rows.shape[1:]))) # drop rows of an interrupted write
+        f.write(rows.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    meta = dict(rows=n_rows + rows.shape[0], shape=list(rows.shape[1:]), dtype=rows.dtype.str)
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+def truncate_rows(path, n_rows):
+    # keep only the first n_rows rows of `path` (written by append_rows)
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    assert n_rows <= meta['rows'], f"{path} has {meta['rows']} rows, cannot truncate it to {n_rows}"
+    meta['rows'] = n_rows
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.json.tmp', path + '.json')
+    with open(path + '.bin', 'ab') as f:
+        f.truncate(n_rows * np.dtype(meta['dtype']).itemsize * int(np.prod(meta['shape'])))
+
+def load_rows(path):
+    # memory-map rows written by append_rows
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    shape = (meta['rows'],) + tuple(meta['shape'])
+    if meta['rows'] == 0:
+        return np.zeros(shape, dtype=meta['dtype'])
+    return np.memmap(path + '.bin', dtype=meta['dtype'], mode='r', shape=shape)
@@ -0,0 +1,162 @@
+import datetime
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from gymnasium.vector.utils import CloudpickleWrapper
+
+from drs.resource_plan import pin_process
+
+# Data-parallel SAC (and discriminator) updates over local cpu processes, with the gloo backend.
+# The training process is rank 0: it samples the full batch as before and writes it into shared
+# memory, then every rank runs the fused update on its shard of the batch. The gradients are averaged
+# with one all-reduce per update, so all replicas apply the same optimizer steps and stay identical.
+# The replicas are pickled copies of the fused update (networks, optimizers, alpha) of rank 0, made
+# when the learner is first used, i.e. after a checkpoint may have been loaded.
+
+SAC_KEYS = ('observations', 'actions', 'next_observations', 'rewards', 'dones')
+DISC_KEYS = ('fail_next_obs', 'success_next_obs')
+LABELLED_KEYS = ('next_observations', 'labels', 'weights')
+_STOP, _UPDATE, _DISC_STEP, _LABELLED_DISC_STEP = 0, 1, 2, 3
+
+
+@torch.compiler.disable
+def all_reduce_grads(params):
+    # averages the gradients of params over all ranks, flattened into a single all-reduce
+    grads = [p.grad for p in params if p.grad is not None]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def _shard(batch, rank, shard_size):
+    return {k: v[rank * shard_size:(rank + 1) * shard_size] for k, v in batch.items()}
+
+
+def _stage_ids(mask):
+    return [i for i in range(mask.bit_length()) if mask >> i & 1]
+
+
+def _worker(rank, world_size, init_method, replica, batch, disc_batch, labelled_batch, shard_size, seed, cpus):
+    if cpus is not None:
+        pin_process(cpus[rank])
+    else:
+        torch.set_num_threads(1)
+    torch.manual_seed(seed + rank)
+    update, disc_step = replica.fn
+    update.grad_hook = all_reduce_grads
+    if disc_step is not None:
+        disc_step.grad_hook = all_reduce_grads
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(minutes=10))
+    ctrl = torch.zeros(2, dtype=torch.int64)
+    while True:
+        dist.broadcast(ctrl, 0)
+        cmd, arg = ctrl.tolist()
+        if cmd == _STOP:
+            break
+        elif cmd == _UPDATE:
+            update(SimpleNamespace(**_shard(batch, rank, shard_size)), arg)
+        elif cmd == _DISC_STEP:
+            data = _shard(disc_batch, rank, shard_size)
+            disc_step(data['fail_next_obs'], data['success_next_obs'], arg)
+            disc_step.disc.set_trained(arg)
+        elif cmd == _LABELLED_DISC_STEP:
+            # the labelled batch holds both the failed and the successful rows, twice the shard size
+            data = _shard(labelled_batch, rank, 2 * shard_size)
+            disc_step.labelled(data['next_observations'], data['labels'], data['weights'], _stage_ids(arg))
+            for i in _stage_ids(arg):
+                disc_step.disc.set_trained(i)
+    dist.destroy_process_group()
+
+
+class DataParallelLearner(object):
+    # Wraps a FusedSACUpdate (and a DiscriminatorStep) of the training process, with the same call
+    # signatures. The returned losses and q-values are the ones of the shard of rank 0. `cpus` optionally
+    # lists the cpus each rank is pinned to (see drs.resource_plan).
+    def __init__(self, world_size, update, disc_step=None, batch_size=256, obs_shape=(), action_shape=(), n_stages=1, seed=0, cpus=None):
+        assert world_size > 1, world_size
+        assert batch_size % world_size == 0, f"batch size {batch_size} is not divisible by {world_size} ranks"
+        self.world_size = world_size
+        self.update = update
+        self._disc_step = disc_step
+        self.shard_size = batch_size // world_size
+        self.seed = seed
+        self.cpus = cpus
+        shapes = dict(
+            observations=obs_shape, actions=action_shape, next_observations=obs_shape, rewards=(1,), dones=(1,),
+        )
+        self._batch = {k: torch.zeros((batch_size, *shapes[k])).share_memory_() for k in SAC_KEYS}
+        self._disc_batch = {k: torch.zeros((batch_size, *obs_shape)).share_memory_() for k in DISC_KEYS}
+        labelled_shapes = dict(next_observations=obs_shape, labels=(n_stages,), weights=(n_stages,))
+        self._labelled_batch = {k: torch.zeros((2 * batch_size, *labelled_shapes[k])).share_memory_() for k in LABELLED_KEYS}
+        self._ctrl = torch.zeros(2, dtype=torch.int64)
+        self._processes = None
+
+    def _start(self):
+        self._store_dir = tempfile.mkdtemp(prefix='drs_ddp_')
+        init_method = f'file://{os.path.join(self._store_dir, "store")}'
+        ctx = mp.get_context('forkserver')
+        replica = CloudpickleWrapper((self.update, self._disc_step))
+        self._processes = []
+        for rank in range(1, self.world_size):
+            p = ctx.Process(
+                target=_worker,
+                args=(rank, self.world_size, init_method, replica, self._batch, self._disc_batch, self._labelled_batch, self.shard_size, self.seed, self.cpus),
+                daemon=True,
+            )
+            p.start()
+            self._processes.append(p)
+        dist.init_process_group('gloo', init_method=init_method, rank=0, world_size=self.world_size,
+                                timeout=datetime.timedelta(minutes=10))
+        self.update.grad_hook = all_reduce_grads
+        if self._disc_step is not None:
+            self._disc_step.grad_hook = all_reduce_grads
+
+    def _broadcast(self, cmd, arg):
+        if self._processes is None:
+            self._start()
+        self._ctrl[0], self._ctrl[1] = cmd, arg
+        dist.broadcast(self._ctrl, 0)
+
+    def __call__(self, data, global_update):
+        for k in SAC_KEYS:
+            self._batch[k].copy_(getattr(data, k))
+        self._broadcast(_UPDATE, global_update)
+        return self.update(SimpleNamespace(**_shard(self._batch, 0, self.shard_size)), global_update)
+
+    def disc_step(self, fail_next_obs, success_next_obs, stage_idx):
+        # the caller marks the stage as trained on its discriminator, the workers do it on theirs
+        self._disc_batch['fail_next_obs'].copy_(fail_next_obs)
+        self._disc_batch['success_next_obs'].copy_(success_next_obs)
+        self._broadcast(_DISC_STEP, stage_idx)
+        data = _shard(self._disc_batch, 0, self.shard_size)
+        return self._disc_step(data['fail_next_obs'], data['success_next_obs'], stage_idx)
+
+    def disc_step_labelled(self, next_obs, labels, weights, stage_ids):
+        # The weights are normalised over the full batch, each rank sums its weighted losses. Scaled by
+        # world_size, the averaged gradients are the ones of the full batch.
+        self._labelled_batch['next_observations'].copy_(next_obs)
+        self._labelled_batch['labels'].copy_(labels)
+        self._labelled_batch['weights'].copy_(weights * self.world_size)
+        self._broadcast(_LABELLED_DISC_STEP, sum(1 << i for i in stage_ids))
+        data = _shard(self._labelled_batch, 0, 2 * self.shard_size)
+        return self._disc_step.labelled(data['next_observations'], data['labels'], data['weights'], stage_ids)
+
+    def close(self):
+        if self._processes is None:
+            return
+        self._broadcast(_STOP, 0)
+        for p in self._processes:
+            p.join()
+        dist.destroy_process_group()
+        shutil.rmtree(self._store_dir, ignore_errors=True)
+        self._processes = None
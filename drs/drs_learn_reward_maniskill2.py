@@ -1,6 +1,7 @@
 ALGO_NAME = 'DrS-learn-reward'
 
 import argparse
+import json
 import os
 import random
 import time
@@ -18,7 +19,10 @@ from stable_baselines3.common.buffers import ReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
 import datetime
-from collections import defaultdict
+
+from drs.metrics_utils import MetricsAggregator, AsyncScalarWriter
+from drs.perf_utils import PhaseTimer
+from drs.rollout_inference import RolloutPolicy, sample_actions
 
 def parse_args():
     # fmt: off
@@ -69,6 +73,8 @@ def parse_args():
         help="the frequency of updates for the target nerworks")
     parser.add_argument("--disc-frequency", type=int, default=1,
         help="the frequency of training discriminator (delayed)")
+    parser.add_argument("--disc-sampling", type=str, choices=['per-stage', 'stratified'], default='per-stage',
+        help="`per-stage` samples a failed and a successful batch for each stage, `stratified` one stage-labelled batch of 2 * batch-size rows for all stages")
     parser.add_argument("--disc-th", type=float, default=0.95,
         help="the success rate threshold for early stopping discriminator training")
     parser.add_argument("--alpha", type=float, default=0.2,
@@ -77,6 +83,10 @@ def parse_args():
         help="automatic tuning of the entropy coefficient")
     parser.add_argument("--utd", type=float, default=0.5,
         help="Update-to-Data ratio (number of gradient updates / number of env steps)")
+    parser.add_argument("--adaptive-utd", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the env steps and updates per cycle are chosen from their measured costs, within --utd-tolerance of --utd")
+    parser.add_argument("--utd-tolerance", type=float, default=0.25,
+        help="the relative deviation from --utd the adaptive replay ratio may take")
     
     parser.add_argument("--output-dir", type=str, default='output')
     parser.add_argument("--eval-freq", type=int, default=100_000)
@@ -84,12 +94,58 @@ def parse_args():
     parser.add_argument("--num-eval-episodes", type=int, default=10)
     parser.add_argument("--num-eval-envs", type=int, default=1)
     parser.add_argument("--sync-venv", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True)
+    parser.add_argument("--async-eval", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, evaluation runs in a separate process on a snapshot of the actor")
+    parser.add_argument("--max-inflight-evals", type=int, default=2,
+        help="the maximum number of pending asynchronous evaluations before training waits for one")
     parser.add_argument("--training-freq", type=int, default=64)
+    parser.add_argument("--perf-timers", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the time spent in each phase of the training loop is logged under `perf/`")
+    parser.add_argument("--quiet", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, finished episodes are not printed")
+    parser.add_argument("--async-logging", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, tensorboard scalars are written from a background thread")
+    parser.add_argument("--fused-update", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the SAC update uses one ensemble for the twin critics, one actor forward and one backward pass")
+    parser.add_argument("--compile-update", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the fused update (and the discriminator step) is compiled with torch.compile, implies --fused-update")
+    parser.add_argument("--rollout-backend", type=str, choices=['actor', 'torch', 'numpy'], default='actor',
+        help="how collection actions are sampled: `actor.get_action`, an inference-mode torch path, or a numpy copy of the actor")
+    parser.add_argument("--ddp-workers", type=int, default=1,
+        help="the number of cpu processes (including this one) that share each update's batch, >1 implies --fused-update")
+    parser.add_argument("--pin-cpus", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the learner, env workers and eval workers are pinned to disjoint cpu sets (saved to resource_plan.json)")
+    parser.add_argument("--cpu-plan", type=str, default=None,
+        help="the path of a resource_plan.json to pin the processes with, instead of the derived one, implies --pin-cpus")
+    parser.add_argument("--learner-threads", type=int, default=None,
+        help="the number of cpus (and torch threads) of each learner process when pinning, defaults to the cpus left by the envs")
+    parser.add_argument("--collector-port", type=int, default=None,
+        help="if set, transitions are collected by collector processes (`python -m drs.remote_collect`) connecting to this port, instead of local env workers")
+    parser.add_argument("--local-collectors", type=int, default=0,
+        help="the number of collector processes started on this host (over loopback), they share --num-envs")
+    parser.add_argument("--collector-timeout", type=float, default=600,
+        help="seconds without transitions from any collector after which training fails")
     parser.add_argument("--log-freq", type=int, default=10000)
     parser.add_argument("--num-demo-traj", type=int, default=None)
     parser.add_argument("--save-freq", type=int, default=2000000)
+    parser.add_argument("--state-save-freq", type=int, default=None,
+        help="the frequency of saving the full training state (networks, optimizers, buffers, RNG states) used by --resume")
+    parser.add_argument("--resume", type=str, default=None,
+        help="the log path of a previous run to resume from its last full training state (approximately: the envs start fresh episodes)")
     parser.add_argument("--control-mode", type=str, default='pd_ee_delta_pose')
+    parser.add_argument("--env-kwargs", type=json.loads, default={},
+        help="extra keyword arguments of the environment as json, e.g. '{\"obs_dim\": 64}' for DrS_Synthetic-v0")
     parser.add_argument("--n-stages", type=int, required=True)
+    parser.add_argument("--load-stage-buffers", type=str, default=None,
+        help="the stage buffers saved by a previous run (`checkpoints/stage_buffers` under its log path) to warm start from")
+    parser.add_argument("--stage-retention", type=str, choices=['fifo', 'reservoir', 'age-stratified'], default='fifo',
+        help="which rows the stage buffers keep once full: the latest (`fifo`), or whole trajectories chosen by reservoir sampling or equally from age strata")
+    parser.add_argument("--stage-buffer-trajs", type=int, nargs='+', default=None,
+        help="the number of trajectories each stage buffer keeps with --stage-retention reservoir/age-stratified, one value for all or one per buffer (n_stages + 1), defaults to buffer-size / episode length")
+    parser.add_argument("--log-trajectories", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, finished stage-labelled trajectories are written to `trajectories` under the log path")
+    parser.add_argument("--traj-shard-size", type=int, default=100_000,
+        help="the number of transitions per trajectory shard")
 
     args = parser.parse_args()
     args.algo_name = ALGO_NAME
@@ -100,12 +156,20 @@ def parse_args():
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
     assert args.num_eval_episodes % args.num_eval_envs == 0
     assert args.training_freq % args.num_envs == 0
-    assert (args.training_freq * args.utd).is_integer()
+    assert args.adaptive_utd or (args.training_freq * args.utd).is_integer()
+    assert args.stage_buffer_trajs is None or len(args.stage_buffer_trajs) in (1, args.n_stages + 1), "one --stage-buffer-trajs for all stage buffers or one per buffer"
+    assert args.local_collectors == 0 or args.num_envs % args.local_collectors == 0, "--num-envs is split between the local collectors"
     # fmt: on
     return args
 
-import drs.envs_with_stage_indicators
-from mani_skill2.utils.wrappers import RecordEpisode
+import drs.synthetic_env
+try:
+    import drs.envs_with_stage_indicators
+    from mani_skill2.utils.wrappers import RecordEpisode
+except ModuleNotFoundError as e: # the learner components and DrS_Synthetic-v0 can be used without ManiSkill2
+    if e.name.split('.')[0] not in ('mani_skill2', 'sapien'):
+        raise
+    RecordEpisode = None
 
 def make_env(env_id, seed, control_mode=None, video_dir=None, **kwargs):
     def thunk():
@@ -251,6 +315,9 @@ class DiscriminatorBuffer(object):
         self.device = device
         self.pos = 0
         self.full = False
+        self.n_added = 0 # total number of rows ever added
+        self.n_saved = 0 # number of rows already handed to `save`
+        self.n_saved_rows = 0 # number of rows in the file of `save`
 
     @property
     def size(self) -> int:
@@ -258,6 +325,7 @@ class DiscriminatorBuffer(object):
 
     def add(self, next_obs):
         l = next_obs.shape[0]
+        self.n_added += l
         
         while self.pos + l >= self.buffer_size:
             self.full = True
@@ -270,13 +338,173 @@ class DiscriminatorBuffer(object):
         self.next_observations[self.pos:self.pos+l] = next_obs.copy()
         self.pos = (self.pos + l) % self.buffer_size
 
+    def sample_rows(self, n):
+        return self.next_observations[np.random.randint(0, self.size, size=n)]
+
+    def sample(self, batch_size):
+        batch = dict(
+            next_observations=self.sample_rows(batch_size),
+        )
+        return {k: torch.tensor(v).to(self.device) for k,v in batch.items()}
+
+    def unsaved_rows(self):
+        # rows added since the last call, oldest first (rows already overwritten are skipped)
+        k = min(self.n_added - self.n_saved, self.size)
+        idxs = (self.pos - k + np.arange(k)) % self.buffer_size
+        self.n_saved = self.n_added
+        return self.next_observations[idxs]
+
+    def save(self, path):
+        # incremental: only rows added since the last save are appended to `path`
+        from drs.data_utils import append_rows
+        rows = self.unsaved_rows()
+        append_rows(path, rows)
+        self.n_saved_rows += len(rows)
+
+    def rollback_saved(self, path):
+        # drops the rows that `save` wrote to `path` after this buffer's state was taken, e.g. by a
+        # run that is resumed from an earlier training state
+        from drs.data_utils import truncate_rows
+        if os.path.exists(path + '.json'):
+            truncate_rows(path, self.n_saved_rows)
+
+    def load(self, path):
+        from drs.data_utils import load_rows
+        rows = load_rows(path)
+        self.add(rows[-self.buffer_size:])
+
+class TrajectoryReservoirBuffer(object):
+    # A stage buffer with the interface of DiscriminatorBuffer, which keeps whole trajectories in
+    # `max_trajs` slots of `traj_len` rows, instead of overwriting rows in FIFO order. Once the slots
+    # are full, the trajectories to keep are chosen by `policy`:
+    # - 'reservoir': every trajectory seen is kept with the same probability (reservoir sampling), so
+    #   early trajectories, e.g. rare ones of high stages, are not the first to go
+    # - 'age-stratified': the slots are shared equally by age strata [2^k, 2^(k+1)) (in trajectories
+    #   added since, itself included), so the buffer keeps recent trajectories and a thinning sample
+    #   of older ones
+    # Rows added at once are split into trajectories of at most traj_len rows. Sampling is uniform
+    # over the rows kept, through the cumulative trajectory lengths.
+    def __init__(self, max_trajs, traj_len, obs_space, action_space, device, policy='reservoir'):
+        assert policy in ('reservoir', 'age-stratified'), policy
+        self.max_trajs = max_trajs
+        self.traj_len = traj_len
+        self.policy = policy
+        self.buffer_size = max_trajs * traj_len
+        self.next_observations = np.zeros((self.buffer_size,) + obs_space.shape, dtype=obs_space.dtype)
+        self.device = device
+        self.traj_lengths = np.zeros(max_trajs, dtype=np.int64) # 0 for empty slots
+        self.traj_ids = np.zeros(max_trajs, dtype=np.int64) # the number of trajectories seen before each one
+        self.traj_versions = np.zeros(max_trajs, dtype=np.int64) # n_added right after each one was written
+        self.n_trajs = 0 # total number of trajectories ever added
+        self.n_added = 0 # total number of rows ever added
+        self.n_saved = 0 # n_added at the last `save`
+        self.n_saved_rows = 0 # number of rows and trajectories in the files of `save`
+        self.n_saved_trajs = 0
+        self._cum_lengths = None
+
+    @property
+    def size(self) -> int:
+        return int(self.traj_lengths.sum())
+
+    def add(self, next_obs):
+        for start in range(0, next_obs.shape[0], self.traj_len):
+            self._add_traj(next_obs[start:start+self.traj_len])
+
+    def _add_traj(self, traj):
+        self.n_added += traj.shape[0]
+        self.n_trajs += 1
+        slot = self._choose_slot()
+        if slot is None:
+            return
+        self.next_observations[slot*self.traj_len:slot*self.traj_len+traj.shape[0]] = traj
+        self.traj_lengths[slot] = traj.shape[0]
+        self.traj_ids[slot] = self.n_trajs - 1
+        self.traj_versions[slot] = self.n_added
+        self._cum_lengths = None
+
+    def _choose_slot(self):
+        # the slot the new trajectory goes to, None if it is not kept
+        if self.n_trajs <= self.max_trajs:
+            return self.n_trajs - 1
+        if self.policy == 'reservoir':
+            j = np.random.randint(0, self.n_trajs)
+            return j if j < self.max_trajs else None
+        # the new trajectory is always kept, in a slot of the largest stratum (the youngest on ties)
+        ages = self.n_trajs - self.traj_ids
+        strata = np.floor(np.log2(ages)).astype(np.int64)
+        return np.random.choice(np.flatnonzero(strata == np.argmax(np.bincount(strata))))
+
+    def sample_rows(self, n):
+        if self._cum_lengths is None:
+            self._cum_lengths = np.cumsum(self.traj_lengths)
+        u = np.random.randint(0, self._cum_lengths[-1], size=n)
+        slots = np.searchsorted(self._cum_lengths, u, side='right')
+        offsets = u - (self._cum_lengths[slots] - self.traj_lengths[slots])
+        return self.next_observations[slots * self.traj_len + offsets]
+
     def sample(self, batch_size):
-        idxs = np.random.randint(0, self.size, size=batch_size)
         batch = dict(
-            next_observations=self.next_observations[idxs],
+            next_observations=self.sample_rows(batch_size),
         )
         return {k: torch.tensor(v).to(self.device) for k,v in batch.items()}
 
+    def rows_inserted_since(self, n_added):
+        # the rows of the trajectories written after n_added rows had been added, oldest first
+        slots = np.flatnonzero(self.traj_versions > n_added)
+        slots = slots[np.argsort(self.traj_versions[slots])]
+        idxs = [slot * self.traj_len + np.arange(self.traj_lengths[slot]) for slot in slots]
+        return (np.concatenate(idxs) if idxs else np.zeros(0, dtype=np.int64)), self.traj_lengths[slots]
+
+    @staticmethod
+    def lengths_path(path):
+        return os.path.join(os.path.dirname(path), 'lengths_' + os.path.basename(path))
+
+    def _repair(self, path):
+        # The lengths of a save are committed before its rows. A save interrupted in between leaves
+        # lengths without rows, those are dropped (and rows without lengths, which cannot happen).
+        from drs.data_utils import load_rows, truncate_rows
+        if not os.path.exists(path + '.json') or not os.path.exists(self.lengths_path(path) + '.json'):
+            return
+        n_rows = load_rows(path).shape[0]
+        ends = np.cumsum(load_rows(self.lengths_path(path)))
+        k = int(np.searchsorted(ends, n_rows, side='right'))
+        if k < len(ends):
+            truncate_rows(self.lengths_path(path), k)
+        if k == 0 or ends[k-1] < n_rows:
+            truncate_rows(path, int(ends[k-1]) if k > 0 else 0)
+
+    def save(self, path):
+        # incremental: only the trajectories kept since the last save are appended to `path`, their
+        # lengths to `lengths_<name>` next to it
+        from drs.data_utils import append_rows
+        self._repair(path)
+        idxs, lengths = self.rows_inserted_since(self.n_saved)
+        self.n_saved = self.n_added
+        append_rows(self.lengths_path(path), lengths)
+        append_rows(path, self.next_observations[idxs])
+        self.n_saved_rows += len(idxs)
+        self.n_saved_trajs += len(lengths)
+
+    def rollback_saved(self, path):
+        # see DiscriminatorBuffer.rollback_saved
+        from drs.data_utils import truncate_rows
+        if os.path.exists(self.lengths_path(path) + '.json'):
+            truncate_rows(self.lengths_path(path), self.n_saved_trajs)
+        if os.path.exists(path + '.json'):
+            truncate_rows(path, self.n_saved_rows)
+
+    def load(self, path):
+        # the saved trajectories are added again, in order, so they go through the retention policy
+        from drs.data_utils import load_rows
+        if not os.path.exists(self.lengths_path(path) + '.json'):
+            self.add(load_rows(path)) # saved by a DiscriminatorBuffer
+            return
+        self._repair(path)
+        rows = load_rows(path)
+        ends = np.cumsum(load_rows(self.lengths_path(path)))
+        for start, end in zip(np.concatenate([[0], ends[:-1]]), ends):
+            self._add_traj(rows[start:end])
+
 def sample_from_multi_buffers(buffers, batch_size):
     # Warning: when the buffers are full, this will make samples not uniform
     sizes = [b.size for b in buffers]
@@ -297,32 +525,76 @@ def sample_from_multi_buffers(buffers, batch_size):
         ret[k] = torch.cat([b[k] for b in batches], dim=0)
     return ret
 
-
-def collect_episode_info(infos, result=None):
+def sample_stage_labelled(buffers, batch_size, device):
+    # One batch for all stages of the discriminator: the same number of rows from each non-empty stage
+    # buffer, copied to the device at once. The labels and weights of the stage s discriminator are
+    # column s. Rows of buffers > s are positives, the others negatives, and each row is weighted by the
+    # number of buffer rows it stands for, so that the weighted loss is the expectation of the loss of
+    # `sample_from_multi_buffers` batches: positives and negatives weigh 0.5 each.
+    n_stages = len(buffers) - 1
+    sizes = np.array([b.size for b in buffers])
+    nonempty = np.flatnonzero(sizes)
+    if len(nonempty) == 0:
+        raise Exception('All buffers are empty!')
+    counts = np.zeros(len(buffers), dtype=np.int64)
+    counts[nonempty] = batch_size // len(nonempty)
+    counts[nonempty[:batch_size % len(nonempty)]] += 1
+    rows = np.concatenate([buffers[i].sample_rows(counts[i]) for i in nonempty])
+    stages = np.repeat(np.arange(len(buffers)), counts)
+    row_weights = np.divide(sizes, counts, out=np.zeros(len(buffers)), where=counts > 0)[stages]
+
+    next_obs = torch.tensor(rows).to(device)
+    stages = torch.tensor(stages).to(device)
+    row_weights = torch.tensor(row_weights, dtype=torch.float32).to(device)
+    labels = (stages[:, None] > torch.arange(n_stages, device=device)).float()
+    pos_total = (row_weights[:, None] * labels).sum(0).clamp_min(1e-8)
+    neg_total = (row_weights[:, None] * (1 - labels)).sum(0).clamp_min(1e-8)
+    weights = 0.5 * row_weights[:, None] * (labels / pos_total + (1 - labels) / neg_total)
+    # the stages with both positives and negatives, the only ones that can be trained on this batch
+    cum_sizes = np.cumsum(sizes)
+    trainable = [s for s in range(n_stages) if cum_sizes[s] > 0 and cum_sizes[-1] > cum_sizes[s]]
+    return dict(next_observations=next_obs, labels=labels, weights=weights), trainable
+
+
+def collect_episode_info(infos, result=None, verbose=True):
     if result is None:
-        result = defaultdict(list)
+        result = MetricsAggregator()
     if "final_info" in infos: # infos is a dict
         indices = np.where(infos["_final_info"])[0] # not all envs are done at the same time
         for i in indices:
             info = infos["final_info"][i] # info is also a dict
             ep = info['episode']
-            print(f"global_step={global_step}, ep_return={ep['r'][0]:.2f}, ep_len={ep['l'][0]}, success={info['success']}")
+            if verbose:
+                print(f"global_step={global_step}, ep_return={ep['r'][0]:.2f}, ep_len={ep['l'][0]}, success={info['success']}")
             result['return'].append(ep['r'][0])
             result['len'].append(ep["l"][0])
             result['success'].append(info['success'])
     return result
 
-def evaluate(n, agent, eval_envs, device):
-    print('======= Evaluation Starts =========')
+def assign_stage(traj, stage_indices, success, n_stages):
+    # the stage buffer of a finished trajectory and the part of it that goes there: successful ones go
+    # to the last buffer, the others to the highest stage they reached, cut after their last step in it
+    if success:
+        return n_stages, traj
+    if n_stages > 1:
+        stage_indices = np.asarray(stage_indices).reshape(-1)
+        best_step = len(stage_indices) - 1 - np.argmax(stage_indices[::-1])
+        return int(stage_indices[best_step]), traj[:best_step+1]
+    return 0, traj
+
+def evaluate(n, agent, eval_envs, device, verbose=True):
+    if verbose:
+        print('======= Evaluation Starts =========')
     agent.eval()
-    result = defaultdict(list)
+    result = MetricsAggregator()
     obs, info = eval_envs.reset() # don't seed here
     while len(result['return']) < n:
         with torch.no_grad():
             action = agent.get_eval_action(torch.Tensor(obs).to(device))
         obs, rew, terminated, truncated, info = eval_envs.step(action.cpu().numpy())
-        collect_episode_info(info, result)
-    print('======= Evaluation Ends =========')
+        collect_episode_info(info, result, verbose)
+    if verbose:
+        print('======= Evaluation Ends =========')
     agent.train()
     return result
 
@@ -335,6 +607,8 @@ if __name__ == "__main__":
     if args.exp_name: tag += '_' + args.exp_name
     log_name = os.path.join(args.env_id, ALGO_NAME, tag)
     log_path = os.path.join(args.output_dir, log_name)
+    if args.resume:
+        log_path = args.resume # keep logging into the resumed run
 
     if args.track:
         import wandb
@@ -349,6 +623,8 @@ if __name__ == "__main__":
             save_code=True,
         )
     writer = SummaryWriter(log_path)
+    if args.async_logging:
+        writer = AsyncScalarWriter(writer)
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
@@ -365,21 +641,47 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
+    # cpu affinity and thread budgets
+    resource_plan = None
+    if args.pin_cpus or args.cpu_plan:
+        from drs.resource_plan import format_resource_plan, load_resource_plan, make_resource_plan, pin_process, pinned_env_fn
+        if args.cpu_plan:
+            resource_plan = load_resource_plan(args.cpu_plan, args.num_envs, args.ddp_workers)
+        else:
+            resource_plan = make_resource_plan(args.num_envs, args.num_eval_envs, args.ddp_workers, args.learner_threads)
+        with open(f'{log_path}/resource_plan.json', 'w') as f:
+            json.dump(resource_plan, f, indent=4)
+        print('CPU plan:', format_resource_plan(resource_plan))
+
     # env setup
     VecEnv = gym.vector.SyncVectorEnv if args.sync_venv or args.num_envs == 1 \
         else lambda x: gym.vector.AsyncVectorEnv(x, context='forkserver')
-    envs = VecEnv(
-        [make_env(args.env_id, args.seed + i, args.control_mode) for i in range(args.num_envs)]
-    )
-    VecEnv = gym.vector.SyncVectorEnv if args.sync_venv or args.num_eval_envs == 1 \
-        else lambda x: gym.vector.AsyncVectorEnv(x, context='forkserver')
-    eval_envs = VecEnv(
-        [make_env(args.env_id, args.seed + 1000 + i, args.control_mode,
-                f'{log_path}/videos' if args.capture_video and i == 0 else None,
-        ) 
-        for i in range(args.num_eval_envs)]
-    )
-    eval_envs.reset(seed=args.seed+1000) # seed eval_envs here, and no more seeding during evaluation
+    env_fns = [make_env(args.env_id, args.seed + i, args.control_mode, **args.env_kwargs) for i in range(args.num_envs)]
+    eval_env_fns = [
+        make_env(args.env_id, args.seed + 1000 + i, args.control_mode,
+            f'{log_path}/videos' if args.capture_video and i == 0 else None, **args.env_kwargs,
+        )
+        for i in range(args.num_eval_envs)
+    ]
+    if resource_plan is not None:
+        env_fns = [pinned_env_fn(fn, cpus) for fn, cpus in zip(env_fns, resource_plan['envs'])]
+        eval_env_fns = [pinned_env_fn(fn, resource_plan['eval']) for fn in eval_env_fns]
+    remote_collection = args.collector_port is not None or args.local_collectors > 0
+    if remote_collection:
+        envs = gym.vector.SyncVectorEnv(env_fns[:1]) # only for the spaces, the collectors run the envs
+    else:
+        envs = VecEnv(env_fns)
+    if args.async_eval:
+        from drs.async_eval import AsyncEvaluator
+        evaluator = AsyncEvaluator(eval_env_fns, Actor, args.num_eval_episodes, seed=args.seed+1000, max_in_flight=args.max_inflight_evals)
+    else:
+        VecEnv = gym.vector.SyncVectorEnv if args.sync_venv or args.num_eval_envs == 1 \
+            else lambda x: gym.vector.AsyncVectorEnv(x, context='forkserver')
+        eval_envs = VecEnv(eval_env_fns)
+        eval_envs.reset(seed=args.seed+1000) # seed eval_envs here, and no more seeding during evaluation
+    if resource_plan is not None:
+        # only now, so that the env workers started above do not inherit the learner's affinity
+        pin_process(resource_plan['learner'][0])
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
     max_action = float(envs.single_action_space.high[0])
 
@@ -414,6 +716,31 @@ if __name__ == "__main__":
     else:
         alpha = args.alpha
 
+    fused_update = None
+    if args.fused_update or args.compile_update or args.ddp_workers > 1:
+        from drs.fused_update import DiscriminatorStep, FusedSACUpdate
+        fused_update = FusedSACUpdate(
+            actor, qf1, qf2, qf1_target, qf2_target, actor_optimizer, q_lr=args.q_lr, gamma=args.gamma, tau=args.tau,
+            policy_frequency=args.policy_frequency, target_network_frequency=args.target_network_frequency,
+            reward_fn=disc.get_reward, alpha=alpha, log_alpha=log_alpha if args.autotune else None,
+            a_optimizer=a_optimizer if args.autotune else None, target_entropy=target_entropy if args.autotune else None,
+            compile=args.compile_update,
+        )
+        q_optimizer = fused_update.q_optimizer # holds the parameters of qf1 and qf2 through the ensemble
+        disc_step = DiscriminatorStep(disc, disc_optimizer, compile=args.compile_update)
+
+    learner = None
+    if args.ddp_workers > 1:
+        from drs.ddp_learner import DataParallelLearner
+        assert device.type == 'cpu', "--ddp-workers only supports training on cpu"
+        learner = DataParallelLearner(
+            args.ddp_workers, fused_update, disc_step=disc_step, batch_size=args.batch_size,
+            obs_shape=envs.single_observation_space.shape, action_shape=envs.single_action_space.shape, n_stages=args.n_stages, seed=args.seed,
+            cpus=resource_plan['learner'] if resource_plan is not None else None,
+        )
+        # same call signatures, the batch is now sharded across the ranks
+        fused_update, disc_step = learner, learner.disc_step
+
     envs.single_observation_space.dtype = np.float32
     rb = ReplayBuffer(
         args.buffer_size,
@@ -424,19 +751,43 @@ if __name__ == "__main__":
         handle_timeout_termination=False, # stable-baselines3 has not fully supported Gymnasium's termination signal
     )
 
+    tmp_env = make_env(args.env_id, seed=0, **args.env_kwargs)()
+    max_t = tmp_env.spec.max_episode_steps
+    del tmp_env
+
     # DrS specific
-    stage_buffers = [DiscriminatorBuffer(
-        args.buffer_size,
-        envs.single_observation_space,
-        envs.single_action_space,
-        device,
-    ) for _ in range(args.n_stages + 1)]
-    if args.demo_path:
+    if args.stage_retention == 'fifo':
+        stage_buffers = [DiscriminatorBuffer(
+            args.buffer_size,
+            envs.single_observation_space,
+            envs.single_action_space,
+            device,
+        ) for _ in range(args.n_stages + 1)]
+    else:
+        stage_buffer_trajs = args.stage_buffer_trajs or [max(1, args.buffer_size // max_t)]
+        if len(stage_buffer_trajs) == 1:
+            stage_buffer_trajs = stage_buffer_trajs * (args.n_stages + 1)
+        stage_buffers = [TrajectoryReservoirBuffer(
+            n_trajs,
+            max_t,
+            envs.single_observation_space,
+            envs.single_action_space,
+            device,
+            policy=args.stage_retention,
+        ) for n_trajs in stage_buffer_trajs]
+    if args.load_stage_buffers:
+        # the demos added by the previous run are part of its last stage buffer
+        for i, b in enumerate(stage_buffers):
+            assert os.path.exists(f'{args.load_stage_buffers}/stage_{i}.json'), f"stage buffer {i} is missing in {args.load_stage_buffers}"
+            b.load(f'{args.load_stage_buffers}/stage_{i}')
+        print(f'Loaded stage buffers of sizes {[b.size for b in stage_buffers]} from {args.load_stage_buffers}')
+    elif args.demo_path:
         stage_buffers[-1].add(next_obs=demo_dataset['next_observations'])
+    traj_logger = None
+    if args.log_trajectories:
+        from drs.traj_logger import TrajectoryLogger
+        traj_logger = TrajectoryLogger(f'{log_path}/trajectories', shard_size=args.traj_shard_size)
 
-    tmp_env = make_env(args.env_id, seed=0)()
-    max_t = tmp_env.spec.max_episode_steps
-    del tmp_env
     assert args.learning_starts > args.num_envs * max_t, "learning_starts must be larger than num_envs * max_ep_steps"
     episode_next_obs = np.zeros((args.num_envs, max_t) + envs.single_observation_space.shape)
     episode_rewards = np.zeros((args.num_envs, max_t,1))
@@ -449,81 +800,202 @@ if __name__ == "__main__":
     global_update = 0
     learning_has_started = False
     num_updates_per_training = int(args.training_freq * args.utd)
-    result = defaultdict(list)
+    utd_controller = None
+    if args.adaptive_utd:
+        from drs.replay_ratio import ReplayRatioController
+        utd_controller = ReplayRatioController(args.utd, args.utd_tolerance, args.num_envs, args.training_freq, cuda_sync=device.type == 'cuda')
+    result = MetricsAggregator()
+
+    # Full training state. Resuming is approximate: the envs are not part of it, so the episodes in
+    # progress at the save are dropped, and the envs start fresh episodes, reseeded with
+    # `seed + global_step` so that they do not replay the episodes of the start of the run.
+    checkpointer = None
+    if args.state_save_freq or args.resume:
+        from drs.checkpoint_utils import TrainingCheckpointer, get_rng_state, set_rng_state
+        checkpointer = TrainingCheckpointer(f'{log_path}/checkpoints/state')
+    if args.resume:
+        assert checkpointer.exists(), f"no training state to resume from in {log_path}/checkpoints/state"
+        state = checkpointer.load(buffers={'rb': rb, **{f'stage_{i}': b for i, b in enumerate(stage_buffers)}}, map_location='cpu')
+        # the stage buffer files may hold rows saved after this state (--save-freq), they would be saved twice
+        for i, b in enumerate(stage_buffers):
+            if 'n_saved_rows' in state['buffers'][f'stage_{i}']:
+                b.rollback_saved(f'{log_path}/checkpoints/stage_buffers/stage_{i}')
+        global_step = state['global_step']
+        global_update = state['global_update']
+        learning_has_started = state['learning_has_started']
+        actor.load_state_dict(state['actor'])
+        qf1.load_state_dict(state['qf1'])
+        qf2.load_state_dict(state['qf2'])
+        qf1_target.load_state_dict(state['qf1_target'])
+        qf2_target.load_state_dict(state['qf2_target'])
+        actor_optimizer.load_state_dict(state['actor_optimizer'])
+        q_optimizer.load_state_dict(state['q_optimizer'])
+        disc.load_state_dict(state['discriminator'])
+        disc_optimizer.load_state_dict(state['disc_optimizer'])
+        disc.trained = state['disc_trained']
+        disc_training = state['disc_training']
+        if args.autotune:
+            with torch.no_grad():
+                log_alpha.copy_(state['log_alpha'])
+            a_optimizer.load_state_dict(state['a_optimizer'])
+        alpha = state['alpha']
+        set_rng_state(state['rng'])
+        envs.single_action_space.np_random.bit_generator.state = state['action_space_rng']
+        if utd_controller is not None and state.get('utd_controller') is not None:
+            utd_controller.load_state_dict(state['utd_controller'])
+        rollout_rng_state = state.get('rollout_rng')
+        del state
+        obs, info = envs.reset(seed=args.seed + global_step)
+        print(f'Resumed from global_step={global_step}')
+    start_step = global_step
+    timer = PhaseTimer(enabled=args.perf_timers, cuda_sync=device.type == 'cuda')
+    collectors = None
+    if remote_collection:
+        from drs.remote_collect import ROW_KEYS, CollectorPool
+        collectors = CollectorPool(
+            dict(env_id=args.env_id, control_mode=args.control_mode, env_kwargs=args.env_kwargs, seed=args.seed + global_step, rollout_backend=args.rollout_backend),
+            port=args.collector_port or 0, timeout=args.collector_timeout,
+        )
+        if args.local_collectors > 0:
+            collectors.spawn_local(args.local_collectors, args.num_envs // args.local_collectors)
+        if learning_has_started:
+            collectors.broadcast(actor, global_update)
+    rollout_policy = None
+    if args.rollout_backend != 'actor' and collectors is None:
+        rollout_policy = RolloutPolicy(actor, envs.num_envs, device, (LOG_STD_MIN, LOG_STD_MAX), backend=args.rollout_backend, seed=args.seed)
+        if args.resume and rollout_rng_state is not None:
+            rollout_policy.set_rng_state(rollout_rng_state)
 
     while global_step < args.total_timesteps:
+        cycle_steps, cycle_updates = (args.training_freq, num_updates_per_training) if utd_controller is None else utd_controller.plan()
 
         #############################################
         # Interact with environments
         #############################################
-        for local_step in range(args.training_freq // args.num_envs):
-            global_step += 1 * args.num_envs
-
-            # ALGO LOGIC: put action logic here
-            if not learning_has_started:
-                actions = np.array([envs.single_action_space.sample() for _ in range(envs.num_envs)])
-            else:
-                actions, _, _ = actor.get_action(torch.Tensor(obs).to(device))
-                actions = actions.detach().cpu().numpy()
-
-            # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, rewards, terminations, truncations, infos = envs.step(actions)
-            success_rewards = terminations.astype(rewards.dtype)
-
-            # TRY NOT TO MODIFY: record rewards for plotting purposes
-            result = collect_episode_info(infos, result)
-
-            # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
-            real_next_obs = next_obs.copy()
-            # bootstrap at truncated
-            need_final_obs = truncations & (~terminations) # only need final obs when truncated and not terminated
-            stop_bootstrap = terminations # only stop bootstrap when terminated, don't stop when truncated
-            for idx, _need_final_obs in enumerate(need_final_obs):
-                if _need_final_obs:
-                    real_next_obs[idx] = infos["final_observation"][idx]
-            rb.add(obs, real_next_obs, actions, rewards, stop_bootstrap, infos)
-
-            # DrS pecific: record data for the current episode, add data to stage buffers
-            np.put_along_axis(episode_next_obs, step_in_episodes, values=real_next_obs[:, None, :], axis=1)
-            np.put_along_axis(episode_rewards, step_in_episodes, values=rewards[:, None, None], axis=1)
-            step_in_episodes += 1
-
-            for i, d in enumerate(terminations | truncations):
-                if d:                    
-                    # add completed trajectory to corresponding buffer
-                    l = step_in_episodes[i,0,0]
-                    traj = episode_next_obs[i, :l]
-                    if infos["final_info"][i]['success']:
-                        stage_idx = args.n_stages
-                    elif args.n_stages > 1:
-                        stage_indices = episode_rewards[i, :l]
-                        best_step = l -1 - np.argmax(stage_indices[::-1])
-                        stage_idx = int(stage_indices[best_step])
-                        traj = traj[:best_step+1]
-                    else:
-                        stage_idx = 0
-                    stage_buffers[stage_idx].add(traj)
-                    step_in_episodes[i] = 0
-
-                    for j in range(1, args.n_stages):
-                        result[f'stage_{j}_success'].append(j<=stage_idx)
-
-            # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
-            obs = next_obs
+        if collectors is not None:
+            rows, trajectories, episodes = collectors.take(cycle_steps)
+            global_step += cycle_steps
+            timer.lap('collect')
+            for k in range(0, cycle_steps, args.num_envs):
+                # in groups of num_envs rows, the layout of the replay buffer
+                rb.add(*(rows[key][k:k+args.num_envs] for key in ROW_KEYS[:5]), [{}] * args.num_envs)
+            timer.lap('rb_add')
+            for ep in episodes:
+                if not args.quiet:
+                    print(f"global_step={global_step}, ep_return={ep['r']:.2f}, ep_len={ep['l']}, success={ep['success']}")
+                result['return'].append(ep['r'])
+                result['len'].append(ep['l'])
+                result['success'].append(ep['success'])
+            for traj, stage_indices, success in trajectories:
+                stage_idx, traj_part = assign_stage(traj, stage_indices, success, args.n_stages)
+                stage_buffers[stage_idx].add(traj_part)
+                if traj_logger is not None:
+                    traj_logger.log(traj, stage_indices, success, stage_idx)
+                for j in range(1, args.n_stages):
+                    result[f'stage_{j}_success'].append(j<=stage_idx)
+            if learning_has_started and (rows['versions'] >= 0).any():
+                # how many updates behind the learner the actors that collected the rows were
+                result['charts/policy_lag'].append((global_update - rows['versions'][rows['versions'] >= 0]).mean())
+            timer.lap('episode_finalize')
+        else:
+            for local_step in range(cycle_steps // args.num_envs):
+                global_step += 1 * args.num_envs
+
+                # ALGO LOGIC: put action logic here
+                if not learning_has_started:
+                    actions = sample_actions(envs.single_action_space, envs.num_envs)
+                elif rollout_policy is not None:
+                    actions = rollout_policy(obs)
+                else:
+                    actions, _, _ = actor.get_action(torch.Tensor(obs).to(device))
+                    actions = actions.detach().cpu().numpy()
+                timer.lap('action')
+
+                # TRY NOT TO MODIFY: execute the game and log data.
+                next_obs, rewards, terminations, truncations, infos = envs.step(actions)
+                timer.lap('env_step')
+                success_rewards = terminations.astype(rewards.dtype)
+
+                # TRY NOT TO MODIFY: record rewards for plotting purposes
+                result = collect_episode_info(infos, result, verbose=not args.quiet)
+                timer.lap('episode_info')
+
+                # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
+                real_next_obs = next_obs.copy()
+                # bootstrap at truncated
+                need_final_obs = truncations & (~terminations) # only need final obs when truncated and not terminated
+                stop_bootstrap = terminations # only stop bootstrap when terminated, don't stop when truncated
+                for idx, _need_final_obs in enumerate(need_final_obs):
+                    if _need_final_obs:
+                        real_next_obs[idx] = infos["final_observation"][idx]
+                timer.lap('final_obs')
+                rb.add(obs, real_next_obs, actions, rewards, stop_bootstrap, infos)
+                timer.lap('rb_add')
+
+                # DrS pecific: record data for the current episode, add data to stage buffers
+                np.put_along_axis(episode_next_obs, step_in_episodes, values=real_next_obs[:, None, :], axis=1)
+                np.put_along_axis(episode_rewards, step_in_episodes, values=rewards[:, None, None], axis=1)
+                step_in_episodes += 1
+
+                for i, d in enumerate(terminations | truncations):
+                    if d:                    
+                        # add completed trajectory to corresponding buffer
+                        l = step_in_episodes[i,0,0]
+                        stage_idx, traj = assign_stage(episode_next_obs[i, :l], episode_rewards[i, :l], infos["final_info"][i]['success'], args.n_stages)
+                        timer.lap('episode_finalize')
+                        stage_buffers[stage_idx].add(traj)
+                        timer.lap('stage_buffer_add')
+                        if traj_logger is not None:
+                            traj_logger.log(episode_next_obs[i, :l], episode_rewards[i, :l], infos["final_info"][i]['success'], stage_idx)
+                        step_in_episodes[i] = 0
+
+                        for j in range(1, args.n_stages):
+                            result[f'stage_{j}_success'].append(j<=stage_idx)
+                timer.lap('episode_finalize')
+
+                # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
+                obs = next_obs
 
         # ALGO LOGIC: training.
+        if utd_controller is not None:
+            utd_controller.collected()
         if global_step < args.learning_starts:
             continue
 
         learning_has_started = True
-        for local_update in range(num_updates_per_training):
+        for local_update in range(cycle_updates):
             global_update += 1
             data = rb.sample(args.batch_size)
+            timer.lap('rb_sample')
 
             #############################################
             # Train discriminator
             #############################################
-            if global_update % args.disc_frequency == 0:
+            if global_update % args.disc_frequency == 0 and args.disc_sampling == 'stratified':
+                disc_data, trainable = sample_stage_labelled(stage_buffers, 2 * args.batch_size, device)
+                stage_ids = [i for i in trainable if disc_training[i]]
+                timer.lap('disc_sample')
+                if stage_ids:
+                    if learner is not None:
+                        disc_loss, logits = learner.disc_step_labelled(disc_data['next_observations'], disc_data['labels'], disc_data['weights'], stage_ids)
+                    elif fused_update is not None:
+                        disc_loss, logits = disc_step.labelled(disc_data['next_observations'], disc_data['labels'], disc_data['weights'], stage_ids)
+                    else:
+                        # the stages have disjoint networks, so one step on the sum of their losses is one step of each
+                        disc_loss = 0
+                        for stage_idx in stage_ids:
+                            logits = disc(disc_data['next_observations'], stage_idx)
+                            stage_loss = F.binary_cross_entropy_with_logits(logits, disc_data['labels'][:, stage_idx:stage_idx+1], reduction='none')
+                            disc_loss = disc_loss + (disc_data['weights'][:, stage_idx:stage_idx+1] * stage_loss).sum()
+
+                        disc_optimizer.zero_grad()
+                        disc_loss.backward()
+                        disc_optimizer.step()
+
+                    for stage_idx in stage_ids:
+                        disc.set_trained(stage_idx)
+                    timer.lap('disc_step')
+            elif global_update % args.disc_frequency == 0:
                 for stage_idx in range(args.n_stages):
                     if not disc_training[stage_idx]:
                         continue
@@ -531,30 +1003,41 @@ if __name__ == "__main__":
                     if not success_data:
                         break
                     fail_data = sample_from_multi_buffers(stage_buffers[:stage_idx+1], args.batch_size)
+                    timer.lap('disc_sample')
 
-                    disc_next_obs = torch.cat([fail_data['next_observations'], success_data['next_observations']], dim=0)
-                    disc_labels = torch.cat([
-                        torch.zeros((args.batch_size, 1), device=device), # fail label is 0
-                        torch.ones((args.batch_size, 1), device=device), # success label is 1
-                    ], dim=0)
+                    if fused_update is not None:
+                        disc_loss, logits = disc_step(fail_data['next_observations'], success_data['next_observations'], stage_idx)
+                    else:
+                        disc_next_obs = torch.cat([fail_data['next_observations'], success_data['next_observations']], dim=0)
+                        disc_labels = torch.cat([
+                            torch.zeros((args.batch_size, 1), device=device), # fail label is 0
+                            torch.ones((args.batch_size, 1), device=device), # success label is 1
+                        ], dim=0)
 
-                    logits = disc(disc_next_obs, stage_idx)
-                    disc_loss = F.binary_cross_entropy_with_logits(logits, disc_labels)
-                    
-                    disc_optimizer.zero_grad()
-                    disc_loss.backward()
-                    disc_optimizer.step()
+                        logits = disc(disc_next_obs, stage_idx)
+                        disc_loss = F.binary_cross_entropy_with_logits(logits, disc_labels)
+
+                        disc_optimizer.zero_grad()
+                        disc_loss.backward()
+                        disc_optimizer.step()
 
                     pred = logits.detach() > 0
 
                     disc.set_trained(stage_idx)
+                    timer.lap('disc_step')
 
             #############################################
             # Train agent
             #############################################
             
+            if fused_update is not None:
+                qf1_a_values, qf2_a_values, qf1_loss, qf2_loss, qf_loss, actor_loss, alpha_loss, alpha = fused_update(data, global_update)
+                timer.lap('fused_update')
+                continue
+
             # compute reward by discriminator
             disc_rewards = disc.get_reward(data.next_observations, data.rewards, data.dones)
+            timer.lap('disc_reward')
 
             # update the value networks
             with torch.no_grad():
@@ -574,6 +1057,7 @@ if __name__ == "__main__":
             q_optimizer.zero_grad()
             qf_loss.backward()
             q_optimizer.step()
+            timer.lap('critic_step')
 
             # update the policy network
             if global_update % args.policy_frequency == 0:  # TD 3 Delayed update support
@@ -586,6 +1070,7 @@ if __name__ == "__main__":
                 actor_optimizer.zero_grad()
                 actor_loss.backward()
                 actor_optimizer.step()
+                timer.lap('actor_step')
 
                 if args.autotune:
                     with torch.no_grad():
@@ -596,6 +1081,7 @@ if __name__ == "__main__":
                     alpha_loss.backward()
                     a_optimizer.step()
                     alpha = log_alpha.exp().item()
+                    timer.lap('alpha_step')
 
             # update the target networks
             if global_update % args.target_network_frequency == 0:
@@ -603,44 +1089,111 @@ if __name__ == "__main__":
                     target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
                 for param, target_param in zip(qf2.parameters(), qf2_target.parameters()):
                     target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
+                timer.lap('target_update')
+        if rollout_policy is not None:
+            rollout_policy.sync()
+        if collectors is not None:
+            collectors.broadcast(actor, global_update)
+        if utd_controller is not None:
+            utd_controller.trained()
 
         # Log training-related data
-        if (global_step - args.training_freq) // args.log_freq < global_step // args.log_freq:
+        if (global_step - cycle_steps) // args.log_freq < global_step // args.log_freq:
             if len(result['return']) > 0:
-                for k, v in result.items():
-                    tag = k if '/' in k else f"train/{k}"
-                    writer.add_scalar(tag, np.mean(v), global_step)
+                result.write(writer, global_step, prefix='train')
                 for j in range(1, args.n_stages):
-                    if np.mean(result[f'stage_{j}_success']) > args.disc_th:
+                    if result[f'stage_{j}_success'].mean() > args.disc_th:
                         disc_training[j-1] = False
-                sr = np.mean(result['success'])
+                sr = result['success'].mean()
                 if sr > args.disc_th:
                     disc_training[-1] = False
-                result = defaultdict(list)
-            writer.add_scalar("losses/qf1_values", qf1_a_values.mean().item(), global_step)
-            writer.add_scalar("losses/qf2_values", qf2_a_values.mean().item(), global_step)
-            writer.add_scalar("losses/qf1_loss", qf1_loss.item(), global_step)
-            writer.add_scalar("losses/qf2_loss", qf2_loss.item(), global_step)
-            writer.add_scalar("losses/qf_loss", qf_loss.item() / 2.0, global_step)
-            writer.add_scalar("losses/actor_loss", actor_loss.item(), global_step)
+                result = MetricsAggregator()
+            writer.add_scalar("losses/qf1_values", qf1_a_values.mean(), global_step)
+            writer.add_scalar("losses/qf2_values", qf2_a_values.mean(), global_step)
+            writer.add_scalar("losses/qf1_loss", qf1_loss, global_step)
+            writer.add_scalar("losses/qf2_loss", qf2_loss, global_step)
+            writer.add_scalar("losses/qf_loss", qf_loss / 2.0, global_step)
+            writer.add_scalar("losses/actor_loss", actor_loss, global_step)
             writer.add_scalar("losses/alpha", alpha, global_step)
-            writer.add_scalar("charts/SPS", int(global_step / (time.time() - start_time)), global_step)
+            writer.add_scalar("charts/SPS", int((global_step - start_step) / (time.time() - start_time)), global_step)
             if args.autotune:
-                writer.add_scalar("losses/alpha_loss", alpha_loss.item(), global_step)
+                writer.add_scalar("losses/alpha_loss", alpha_loss, global_step)
+            if collectors is not None:
+                writer.add_scalar("charts/collectors", collectors.num_collectors, global_step)
+                writer.add_scalar("charts/collectors_lost", collectors.n_lost, global_step)
+            if utd_controller is not None:
+                utd_controller.write(writer, global_step)
+            timer.write(writer, global_step)
+        timer.lap('logging')
 
         # Evaluation
-        if (global_step - args.training_freq) // args.eval_freq < global_step // args.eval_freq:
-            result = evaluate(args.num_eval_episodes, actor, eval_envs, device)
-            for k, v in result.items():
-                writer.add_scalar(f"eval/{k}", np.mean(v), global_step)
+        if (global_step - cycle_steps) // args.eval_freq < global_step // args.eval_freq:
+            if args.async_eval:
+                evaluator.submit(global_step, actor)
+            else:
+                result = evaluate(args.num_eval_episodes, actor, eval_envs, device, verbose=not args.quiet)
+                result.write(writer, global_step, prefix='eval')
+        if args.async_eval:
+            # logged at the step the actor snapshot was taken
+            for eval_step, eval_result in evaluator.poll():
+                for k, v in eval_result.items():
+                    writer.add_scalar(f"eval/{k}", np.mean(v), eval_step)
+        timer.lap('evaluation')
 
         # Checkpoint
         if args.save_freq and ( global_step >= args.total_timesteps or \
-                (global_step - args.training_freq) // args.save_freq < global_step // args.save_freq):
+                (global_step - cycle_steps) // args.save_freq < global_step // args.save_freq):
             os.makedirs(f'{log_path}/checkpoints', exist_ok=True)
             torch.save({
                 'discriminator': disc.state_dict(),
             }, f'{log_path}/checkpoints/{global_step}.pt')
-
+            os.makedirs(f'{log_path}/checkpoints/stage_buffers', exist_ok=True)
+            for i, b in enumerate(stage_buffers):
+                b.save(f'{log_path}/checkpoints/stage_buffers/stage_{i}')
+
+        # Full training state
+        if args.state_save_freq and ( global_step >= args.total_timesteps or \
+                (global_step - cycle_steps) // args.state_save_freq < global_step // args.state_save_freq):
+            checkpointer.save(global_step, {
+                'global_update': global_update,
+                'learning_has_started': learning_has_started,
+                'actor': actor.state_dict(),
+                'qf1': qf1.state_dict(),
+                'qf2': qf2.state_dict(),
+                'qf1_target': qf1_target.state_dict(),
+                'qf2_target': qf2_target.state_dict(),
+                'actor_optimizer': actor_optimizer.state_dict(),
+                'q_optimizer': q_optimizer.state_dict(),
+                'discriminator': disc.state_dict(),
+                'disc_optimizer': disc_optimizer.state_dict(),
+                'disc_trained': disc.trained,
+                'disc_training': disc_training,
+                'log_alpha': log_alpha if args.autotune else None,
+                'a_optimizer': a_optimizer.state_dict() if args.autotune else None,
+                'alpha': alpha,
+                'rng': get_rng_state(),
+                'action_space_rng': envs.single_action_space.np_random.bit_generator.state,
+                'rollout_rng': rollout_policy.rng_state() if rollout_policy is not None else None,
+                'utd_controller': utd_controller.state_dict() if utd_controller is not None else None,
+            }, buffers={
+                'rb': (rb, global_step // args.num_envs),
+                **{f'stage_{i}': (b, b.n_added) for i, b in enumerate(stage_buffers)},
+            })
+        timer.lap('checkpoint')
+
+    if traj_logger is not None:
+        traj_logger.close()
+    if checkpointer is not None:
+        checkpointer.close()
+    if args.async_eval:
+        for eval_step, eval_result in evaluator.close():
+            for k, v in eval_result.items():
+                writer.add_scalar(f"eval/{k}", np.mean(v), eval_step)
+    else:
+        eval_envs.close()
+    if learner is not None:
+        learner.close()
+    if collectors is not None:
+        collectors.close()
     envs.close()
     writer.close()
@@ -1,8 +1,10 @@
 ALGO_NAME = 'DrS-reuse-reward'
 
 import argparse
+import json
 import os
 import random
+import sys
 import time
 from distutils.util import strtobool
 
@@ -18,9 +20,13 @@ from stable_baselines3.common.buffers import ReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
 import datetime
-from collections import defaultdict
+
+from drs.metrics_utils import MetricsAggregator, AsyncScalarWriter
+from drs.perf_utils import PhaseTimer
+from drs.rollout_inference import RolloutPolicy, sample_actions
 
 from drs.drs_learn_reward_maniskill2 import Discriminator
+from drs.learned_reward_wrapper import LearnedRewardWrapper, load_reward_weights
 
 def parse_args():
     # fmt: off
@@ -71,6 +77,10 @@ def parse_args():
         help="automatic tuning of the entropy coefficient")
     parser.add_argument("--utd", type=float, default=0.5,
         help="Update-to-Data ratio (number of gradient updates / number of env steps)")
+    parser.add_argument("--adaptive-utd", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the env steps and updates per cycle are chosen from their measured costs, within --utd-tolerance of --utd")
+    parser.add_argument("--utd-tolerance", type=float, default=0.25,
+        help="the relative deviation from --utd the adaptive replay ratio may take")
 
     parser.add_argument("--output-dir", type=str, default='output')
     parser.add_argument("--eval-freq", type=int, default=100_000)
@@ -78,11 +88,47 @@ def parse_args():
     parser.add_argument("--num-eval-episodes", type=int, default=10)
     parser.add_argument("--num-eval-envs", type=int, default=1)
     parser.add_argument("--sync-venv", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True)
+    parser.add_argument("--async-eval", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, evaluation runs in a separate process on a snapshot of the actor")
+    parser.add_argument("--max-inflight-evals", type=int, default=2,
+        help="the maximum number of pending asynchronous evaluations before training waits for one")
     parser.add_argument("--training-freq", type=int, default=64)
+    parser.add_argument("--perf-timers", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the time spent in each phase of the training loop is logged under `perf/`")
+    parser.add_argument("--quiet", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, finished episodes are not printed")
+    parser.add_argument("--async-logging", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, tensorboard scalars are written from a background thread")
+    parser.add_argument("--fused-update", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the SAC update uses one ensemble for the twin critics, one actor forward and one backward pass")
+    parser.add_argument("--compile-update", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the fused update (and the discriminator step) is compiled with torch.compile, implies --fused-update")
+    parser.add_argument("--rollout-backend", type=str, choices=['actor', 'torch', 'numpy'], default='actor',
+        help="how collection actions are sampled: `actor.get_action`, an inference-mode torch path, or a numpy copy of the actor")
+    parser.add_argument("--ddp-workers", type=int, default=1,
+        help="the number of cpu processes (including this one) that share each update's batch, >1 implies --fused-update")
+    parser.add_argument("--pin-cpus", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the learner, env workers and eval workers are pinned to disjoint cpu sets (saved to resource_plan.json)")
+    parser.add_argument("--cpu-plan", type=str, default=None,
+        help="the path of a resource_plan.json to pin the processes with, instead of the derived one, implies --pin-cpus")
+    parser.add_argument("--learner-threads", type=int, default=None,
+        help="the number of cpus (and torch threads) of each learner process when pinning, defaults to the cpus left by the envs")
+    parser.add_argument("--population", type=int, default=1,
+        help="the number of independent agents (seeds `seed`, `seed`+1, ...) trained together, each on num-envs/population envs")
     parser.add_argument("--log-freq", type=int, default=2000)
     parser.add_argument("--save-freq", type=int, default=None)
+    parser.add_argument("--state-save-freq", type=int, default=None,
+        help="the frequency of saving the full training state (networks, optimizers, buffers, RNG states) used by --resume")
+    parser.add_argument("--resume", type=str, default=None,
+        help="the log path of a previous run to resume from its last full training state (approximately: the envs start fresh episodes)")
     parser.add_argument("--disc-ckpt", type=str, required=True)
+    parser.add_argument("--reward-server", type=str, default=None,
+        help="the unix socket of a drs.reward_server serving --disc-ckpt, which then computes the rewards instead of this process")
+    parser.add_argument("--reward-in-env", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the env workers compute the learned reward of --disc-ckpt in numpy and the learner uses it as is")
     parser.add_argument("--control-mode", type=str, default='pd_ee_delta_pose')
+    parser.add_argument("--env-kwargs", type=json.loads, default={},
+        help="extra keyword arguments of the environment as json, e.g. '{\"obs_dim\": 64}' for DrS_Synthetic-v0")
     parser.add_argument("--n-stages", type=int, required=True)
 
     args = parser.parse_args()
@@ -94,14 +140,20 @@ def parse_args():
     args.num_eval_envs = min(args.num_eval_envs, args.num_eval_episodes)
     assert args.num_eval_episodes % args.num_eval_envs == 0
     assert args.training_freq % args.num_envs == 0
-    assert (args.training_freq * args.utd).is_integer()
+    assert args.adaptive_utd or (args.training_freq * args.utd).is_integer()
     # fmt: on
     return args
 
-import drs.envs_with_stage_indicators
-from mani_skill2.utils.wrappers import RecordEpisode
+import drs.synthetic_env
+try:
+    import drs.envs_with_stage_indicators
+    from mani_skill2.utils.wrappers import RecordEpisode
+except ModuleNotFoundError as e: # DrS_Synthetic-v0 can be used without ManiSkill2
+    if e.name.split('.')[0] not in ('mani_skill2', 'sapien'):
+        raise
+    RecordEpisode = None
 
-def make_env(env_id, seed, control_mode=None, video_dir=None, **kwargs):
+def make_env(env_id, seed, control_mode=None, video_dir=None, reward_weights=None, **kwargs):
     def thunk():
         env = gym.make(env_id, reward_mode='semi_sparse', control_mode=control_mode,
                 render_mode='cameras' if video_dir else None, **kwargs)
@@ -109,6 +161,9 @@ def make_env(env_id, seed, control_mode=None, video_dir=None, **kwargs):
             env = RecordEpisode(env, output_dir=video_dir, save_trajectory=False, info_on_video=True)
         env = gym.wrappers.RecordEpisodeStatistics(env)
         env = gym.wrappers.ClipAction(env)
+        if reward_weights is not None:
+            # after RecordEpisodeStatistics, which keeps logging the semi_sparse return
+            env = LearnedRewardWrapper(env, reward_weights)
 
         env.action_space.seed(seed)
         env.observation_space.seed(seed)
@@ -194,34 +249,167 @@ class Actor(nn.Module):
         return super().to(device)
 
 
-def collect_episode_info(infos, result=None):
+def collect_episode_info(infos, result=None, verbose=True):
     if result is None:
-        result = defaultdict(list)
+        result = MetricsAggregator()
     if "final_info" in infos: # infos is a dict
         indices = np.where(infos["_final_info"])[0] # not all envs are done at the same time
         for i in indices:
             info = infos["final_info"][i] # info is also a dict
             ep = info['episode']
-            print(f"global_step={global_step}, ep_return={ep['r'][0]:.2f}, ep_len={ep['l'][0]}, success={info['success']}")
+            if verbose:
+                print(f"global_step={global_step}, ep_return={ep['r'][0]:.2f}, ep_len={ep['l'][0]}, success={info['success']}")
             result['return'].append(ep['r'][0])
             result['len'].append(ep["l"][0])
             result['success'].append(info['success'])
     return result
 
-def evaluate(n, agent, eval_envs, device):
-    print('======= Evaluation Starts =========')
+def evaluate(n, agent, eval_envs, device, verbose=True):
+    if verbose:
+        print('======= Evaluation Starts =========')
     agent.eval()
-    result = defaultdict(list)
+    result = MetricsAggregator()
     obs, info = eval_envs.reset() # don't seed here
     while len(result['return']) < n:
         with torch.no_grad():
             action = agent.get_eval_action(torch.Tensor(obs).to(device))
         obs, rew, terminated, truncated, info = eval_envs.step(action.cpu().numpy())
-        collect_episode_info(info, result)
-    print('======= Evaluation Ends =========')
+        collect_episode_info(info, result, verbose)
+    if verbose:
+        print('======= Evaluation Ends =========')
     agent.train()
     return result
 
+def train_population(args, envs, eval_envs, disc, device, log_path):
+    # Population mode (--population K): K agents with their own networks, optimizers, replay buffers
+    # and env columns, updated together by drs.population.PopulationSAC. Member k has the seed
+    # `args.seed + k`, for its network init, env columns (seeded like the envs of a run of that seed),
+    # replay sampling, warm-up actions and action noise. It logs into and checkpoints under `{log_path}/member_{k}`.
+    from drs.population import PopulationReplayBuffer, PopulationSAC, split_infos
+    global global_step # printed by collect_episode_info
+    n_members = args.population
+    member_seeds = [args.seed + k for k in range(n_members)]
+    envs_per_member = args.num_envs // n_members
+
+    actors, qf1s, qf2s = [], [], []
+    for k in range(n_members):
+        torch.manual_seed(args.seed + k)
+        actors.append(Actor(envs).to(device))
+        qf1s.append(SoftQNetwork(envs).to(device))
+        qf2s.append(SoftQNetwork(envs).to(device))
+    torch.manual_seed(args.seed)
+    population = PopulationSAC(
+        actors, qf1s, qf2s, (LOG_STD_MIN, LOG_STD_MAX), policy_lr=args.policy_lr, q_lr=args.q_lr, gamma=args.gamma, tau=args.tau,
+        policy_frequency=args.policy_frequency, target_network_frequency=args.target_network_frequency,
+        reward_fn=disc.get_reward if disc is not None else None, alpha=args.alpha, autotune=args.autotune,
+        target_entropy=-float(np.prod(envs.single_action_space.shape)), alpha_loss_exp=True, seeds=member_seeds,
+    )
+    eval_actor = Actor(envs).to(device)
+    writers = []
+    for k in range(n_members):
+        w = SummaryWriter(f'{log_path}/member_{k}')
+        writers.append(AsyncScalarWriter(w) if args.async_logging else w)
+
+    envs.single_observation_space.dtype = np.float32
+    rb = PopulationReplayBuffer(
+        n_members,
+        args.buffer_size,
+        envs.single_observation_space,
+        envs.single_action_space,
+        device,
+        n_envs=args.num_envs,
+        seeds=member_seeds,
+        handle_timeout_termination=False,
+    )
+
+    start_time = time.time()
+    obs, info = envs.reset(seed=[s + j for s in member_seeds for j in range(envs_per_member)])
+    global_step = 0
+    global_update = 0
+    learning_has_started = False
+    num_updates_per_training = int(args.training_freq * args.utd)
+    utd_controller = None
+    if args.adaptive_utd:
+        from drs.replay_ratio import ReplayRatioController
+        utd_controller = ReplayRatioController(args.utd, args.utd_tolerance, args.num_envs, args.training_freq, cuda_sync=device.type == 'cuda')
+    results = [MetricsAggregator() for _ in range(n_members)]
+
+    while global_step < args.total_timesteps:
+        cycle_steps, cycle_updates = (args.training_freq, num_updates_per_training) if utd_controller is None else utd_controller.plan()
+        for local_step in range(cycle_steps // args.num_envs):
+            global_step += 1 * args.num_envs
+
+            if not learning_has_started:
+                actions = population.random_actions(envs.single_action_space, envs.num_envs)
+            else:
+                actions = population.act(obs)
+
+            next_obs, rewards, terminations, truncations, infos = envs.step(actions)
+            for k, member_infos in enumerate(split_infos(infos, n_members)):
+                results[k] = collect_episode_info(member_infos, results[k], verbose=not args.quiet)
+
+            real_next_obs = next_obs.copy()
+            need_final_obs = truncations & (~terminations) # only need final obs when truncated and not terminated
+            stop_bootstrap = terminations # only stop bootstrap when terminated, don't stop when truncated
+            for idx, _need_final_obs in enumerate(need_final_obs):
+                if _need_final_obs:
+                    real_next_obs[idx] = infos["final_observation"][idx]
+            rb.add(obs, real_next_obs, actions, rewards, stop_bootstrap, infos)
+            obs = next_obs
+
+        if utd_controller is not None:
+            utd_controller.collected()
+        if global_step < args.learning_starts:
+            continue
+
+        learning_has_started = True
+        for local_update in range(cycle_updates):
+            global_update += 1
+            data = rb.sample(args.batch_size)
+            qf1_a_values, qf2_a_values, qf1_loss, qf2_loss, qf_loss, actor_loss, alpha_loss, alpha = population(data, global_update)
+        if utd_controller is not None:
+            utd_controller.trained()
+
+        # Log training-related data
+        if (global_step - cycle_steps) // args.log_freq < global_step // args.log_freq:
+            sps = int(global_step / (time.time() - start_time))
+            for k, writer in enumerate(writers):
+                if len(results[k]['return']) > 0:
+                    results[k].write(writer, global_step, prefix='train')
+                    results[k] = MetricsAggregator()
+                writer.add_scalar("losses/qf1_values", qf1_a_values[k].mean(), global_step)
+                writer.add_scalar("losses/qf2_values", qf2_a_values[k].mean(), global_step)
+                writer.add_scalar("losses/qf1_loss", qf1_loss[k], global_step)
+                writer.add_scalar("losses/qf2_loss", qf2_loss[k], global_step)
+                writer.add_scalar("losses/qf_loss", qf_loss[k] / 2.0, global_step)
+                writer.add_scalar("losses/actor_loss", actor_loss[k], global_step)
+                writer.add_scalar("losses/alpha", alpha[k], global_step)
+                writer.add_scalar("charts/SPS", sps, global_step)
+                if utd_controller is not None:
+                    utd_controller.write(writer, global_step)
+                if args.autotune:
+                    writer.add_scalar("losses/alpha_loss", alpha_loss[k], global_step)
+
+        # Evaluation, one member after the other on the shared eval envs
+        if (global_step - cycle_steps) // args.eval_freq < global_step // args.eval_freq:
+            for k, writer in enumerate(writers):
+                eval_actor.load_state_dict(population.actor_state_dict(k))
+                result = evaluate(args.num_eval_episodes, eval_actor, eval_envs, device, verbose=not args.quiet)
+                result.write(writer, global_step, prefix='eval')
+
+        # Checkpoint
+        if args.save_freq and ( global_step >= args.total_timesteps or \
+                (global_step - cycle_steps) // args.save_freq < global_step // args.save_freq):
+            for k in range(n_members):
+                os.makedirs(f'{log_path}/member_{k}/checkpoints', exist_ok=True)
+                torch.save({
+                    'actor': population.actor_state_dict(k),
+                }, f'{log_path}/member_{k}/checkpoints/{global_step}.pt')
+
+    for writer in writers:
+        writer.close()
+
+
 if __name__ == "__main__":
     args = parse_args()
 
@@ -230,6 +418,8 @@ if __name__ == "__main__":
     if args.exp_name: tag += '_' + args.exp_name
     log_name = os.path.join(args.env_id, ALGO_NAME, tag)
     log_path = os.path.join(args.output_dir, log_name)
+    if args.resume:
+        log_path = args.resume # keep logging into the resumed run
 
     if args.track:
         import wandb
@@ -244,6 +434,8 @@ if __name__ == "__main__":
             save_code=True,
         )
     writer = SummaryWriter(log_path)
+    if args.async_logging:
+        writer = AsyncScalarWriter(writer)
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
@@ -260,30 +452,74 @@ if __name__ == "__main__":
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
+    # cpu affinity and thread budgets
+    resource_plan = None
+    if args.pin_cpus or args.cpu_plan:
+        from drs.resource_plan import format_resource_plan, load_resource_plan, make_resource_plan, pin_process, pinned_env_fn
+        if args.cpu_plan:
+            resource_plan = load_resource_plan(args.cpu_plan, args.num_envs, args.ddp_workers)
+        else:
+            resource_plan = make_resource_plan(args.num_envs, args.num_eval_envs, args.ddp_workers, args.learner_threads)
+        with open(f'{log_path}/resource_plan.json', 'w') as f:
+            json.dump(resource_plan, f, indent=4)
+        print('CPU plan:', format_resource_plan(resource_plan))
+
     # env setup
     VecEnv = gym.vector.SyncVectorEnv if args.sync_venv or args.num_envs == 1 \
         else lambda x: gym.vector.AsyncVectorEnv(x, context='forkserver')
-    envs = VecEnv(
-        [make_env(args.env_id, args.seed + i, args.control_mode) for i in range(args.num_envs)]
-    )
-    VecEnv = gym.vector.SyncVectorEnv if args.sync_venv or args.num_eval_envs == 1 \
-        else lambda x: gym.vector.AsyncVectorEnv(x, context='forkserver')
-    eval_envs = VecEnv(
-        [make_env(args.env_id, args.seed + 1000 + i, args.control_mode,
-                f'{log_path}/videos' if args.capture_video and i == 0 else None,
-        ) 
-        for i in range(args.num_eval_envs)]
-    )
-    eval_envs.reset(seed=args.seed+1000) # seed eval_envs here, and no more seeding during evaluation
+    reward_weights = load_reward_weights(args.disc_ckpt) if args.reward_in_env else None
+    env_fns = [make_env(args.env_id, args.seed + i, args.control_mode, reward_weights=reward_weights, **args.env_kwargs) for i in range(args.num_envs)]
+    eval_env_fns = [
+        make_env(args.env_id, args.seed + 1000 + i, args.control_mode,
+            f'{log_path}/videos' if args.capture_video and i == 0 else None, **args.env_kwargs,
+        )
+        for i in range(args.num_eval_envs)
+    ]
+    if resource_plan is not None:
+        env_fns = [pinned_env_fn(fn, cpus) for fn, cpus in zip(env_fns, resource_plan['envs'])]
+        eval_env_fns = [pinned_env_fn(fn, resource_plan['eval']) for fn in eval_env_fns]
+    envs = VecEnv(env_fns)
+    if args.async_eval:
+        from drs.async_eval import AsyncEvaluator
+        evaluator = AsyncEvaluator(eval_env_fns, Actor, args.num_eval_episodes, seed=args.seed+1000, max_in_flight=args.max_inflight_evals)
+    else:
+        VecEnv = gym.vector.SyncVectorEnv if args.sync_venv or args.num_eval_envs == 1 \
+            else lambda x: gym.vector.AsyncVectorEnv(x, context='forkserver')
+        eval_envs = VecEnv(eval_env_fns)
+        eval_envs.reset(seed=args.seed+1000) # seed eval_envs here, and no more seeding during evaluation
+    if resource_plan is not None:
+        # only now, so that the env workers started above do not inherit the learner's affinity
+        pin_process(resource_plan['learner'][0])
     assert isinstance(envs.single_action_space, gym.spaces.Box), "only continuous action space is supported"
     max_action = float(envs.single_action_space.high[0])
 
     # discriminator setup
-    disc = Discriminator(envs, args.n_stages).to(device)
-    checkpoint = torch.load(args.disc_ckpt)
-    disc.load_state_dict(checkpoint['discriminator'])
-    for i in range(args.n_stages):
-        disc.set_trained(i)
+    assert not (args.reward_server and args.reward_in_env), "--reward-server and --reward-in-env are exclusive"
+    if args.reward_in_env:
+        disc = None # the replay buffer holds the learned rewards, see make_env
+    elif args.reward_server:
+        from drs.reward_server import RewardClient, checkpoint_name
+        disc = RewardClient(args.reward_server, checkpoint_name(args.disc_ckpt))
+        assert disc.n_stages == args.n_stages, f"the served discriminator has {disc.n_stages} stages"
+        assert disc.obs_dim == np.prod(envs.single_observation_space.shape), "the served discriminator has another observation size"
+    else:
+        disc = Discriminator(envs, args.n_stages).to(device)
+        checkpoint = torch.load(args.disc_ckpt)
+        disc.load_state_dict(checkpoint['discriminator'])
+        for i in range(args.n_stages):
+            disc.set_trained(i)
+
+    if args.population > 1:
+        # the population has its own batched update and action sampling, --reward-server and --adaptive-utd apply to it
+        assert not (args.async_eval or args.resume or args.state_save_freq or args.ddp_workers > 1
+                    or args.fused_update or args.compile_update or args.rollout_backend != 'actor' or args.perf_timers), \
+            "--population does not support --async-eval, --resume, --state-save-freq, --ddp-workers, " \
+            "--fused-update, --compile-update, --rollout-backend or --perf-timers"
+        train_population(args, envs, eval_envs, disc, device, log_path)
+        eval_envs.close()
+        envs.close()
+        writer.close()
+        sys.exit()
 
     # agent setup
     actor = Actor(envs).to(device)
@@ -305,6 +541,31 @@ if __name__ == "__main__":
     else:
         alpha = args.alpha
 
+    fused_update = None
+    if args.fused_update or args.compile_update or args.ddp_workers > 1:
+        from drs.fused_update import FusedSACUpdate
+        fused_update = FusedSACUpdate(
+            actor, qf1, qf2, qf1_target, qf2_target, actor_optimizer, q_lr=args.q_lr, gamma=args.gamma, tau=args.tau,
+            policy_frequency=args.policy_frequency, target_network_frequency=args.target_network_frequency,
+            reward_fn=disc.get_reward if disc is not None else None, alpha=alpha, log_alpha=log_alpha if args.autotune else None,
+            a_optimizer=a_optimizer if args.autotune else None, target_entropy=target_entropy if args.autotune else None,
+            alpha_loss_exp=True,
+            compile=args.compile_update,
+        )
+        q_optimizer = fused_update.q_optimizer # holds the parameters of qf1 and qf2 through the ensemble
+
+    learner = None
+    if args.ddp_workers > 1:
+        from drs.ddp_learner import DataParallelLearner
+        assert device.type == 'cpu', "--ddp-workers only supports training on cpu"
+        learner = DataParallelLearner(
+            args.ddp_workers, fused_update, batch_size=args.batch_size,
+            obs_shape=envs.single_observation_space.shape, action_shape=envs.single_action_space.shape, seed=args.seed,
+            cpus=resource_plan['learner'] if resource_plan is not None else None,
+        )
+        # same call signatures, the batch is now sharded across the ranks
+        fused_update = learner
+
     envs.single_observation_space.dtype = np.float32
     rb = ReplayBuffer(
         args.buffer_size,
@@ -322,29 +583,80 @@ if __name__ == "__main__":
     global_update = 0
     learning_has_started = False
     num_updates_per_training = int(args.training_freq * args.utd)
-    result = defaultdict(list)
+    utd_controller = None
+    if args.adaptive_utd:
+        from drs.replay_ratio import ReplayRatioController
+        utd_controller = ReplayRatioController(args.utd, args.utd_tolerance, args.num_envs, args.training_freq, cuda_sync=device.type == 'cuda')
+    result = MetricsAggregator()
+
+    # Full training state. Resuming is approximate: the envs are not part of it, so the episodes in
+    # progress at the save are dropped, and the envs start fresh episodes, reseeded with
+    # `seed + global_step` so that they do not replay the episodes of the start of the run.
+    checkpointer = None
+    if args.state_save_freq or args.resume:
+        from drs.checkpoint_utils import TrainingCheckpointer, get_rng_state, set_rng_state
+        checkpointer = TrainingCheckpointer(f'{log_path}/checkpoints/state')
+    if args.resume:
+        assert checkpointer.exists(), f"no training state to resume from in {log_path}/checkpoints/state"
+        state = checkpointer.load(buffers={'rb': rb}, map_location='cpu')
+        global_step = state['global_step']
+        global_update = state['global_update']
+        learning_has_started = state['learning_has_started']
+        actor.load_state_dict(state['actor'])
+        qf1.load_state_dict(state['qf1'])
+        qf2.load_state_dict(state['qf2'])
+        qf1_target.load_state_dict(state['qf1_target'])
+        qf2_target.load_state_dict(state['qf2_target'])
+        actor_optimizer.load_state_dict(state['actor_optimizer'])
+        q_optimizer.load_state_dict(state['q_optimizer'])
+        if args.autotune:
+            with torch.no_grad():
+                log_alpha.copy_(state['log_alpha'])
+            a_optimizer.load_state_dict(state['a_optimizer'])
+        alpha = state['alpha']
+        set_rng_state(state['rng'])
+        envs.single_action_space.np_random.bit_generator.state = state['action_space_rng']
+        if utd_controller is not None and state.get('utd_controller') is not None:
+            utd_controller.load_state_dict(state['utd_controller'])
+        rollout_rng_state = state.get('rollout_rng')
+        del state
+        obs, info = envs.reset(seed=args.seed + global_step)
+        print(f'Resumed from global_step={global_step}')
+    start_step = global_step
+    timer = PhaseTimer(enabled=args.perf_timers, cuda_sync=device.type == 'cuda')
+    rollout_policy = None
+    if args.rollout_backend != 'actor':
+        rollout_policy = RolloutPolicy(actor, envs.num_envs, device, (LOG_STD_MIN, LOG_STD_MAX), backend=args.rollout_backend, seed=args.seed)
+        if args.resume and rollout_rng_state is not None:
+            rollout_policy.set_rng_state(rollout_rng_state)
 
     while global_step < args.total_timesteps:
+        cycle_steps, cycle_updates = (args.training_freq, num_updates_per_training) if utd_controller is None else utd_controller.plan()
 
         #############################################
         # Interact with environments
         #############################################
-        for local_step in range(args.training_freq // args.num_envs):
+        for local_step in range(cycle_steps // args.num_envs):
             global_step += 1 * args.num_envs
 
             # ALGO LOGIC: put action logic here
             if not learning_has_started:
-                actions = np.array([envs.single_action_space.sample() for _ in range(envs.num_envs)])
+                actions = sample_actions(envs.single_action_space, envs.num_envs)
+            elif rollout_policy is not None:
+                actions = rollout_policy(obs)
             else:
                 actions, _, _ = actor.get_action(torch.Tensor(obs).to(device))
                 actions = actions.detach().cpu().numpy()
+            timer.lap('action')
 
             # TRY NOT TO MODIFY: execute the game and log data.
             next_obs, rewards, terminations, truncations, infos = envs.step(actions)
+            timer.lap('env_step')
             success_rewards = terminations.astype(rewards.dtype)
 
             # TRY NOT TO MODIFY: record rewards for plotting purposes
-            result = collect_episode_info(infos, result)
+            result = collect_episode_info(infos, result, verbose=not args.quiet)
+            timer.lap('episode_info')
 
             # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
             real_next_obs = next_obs.copy()
@@ -354,25 +666,39 @@ if __name__ == "__main__":
             for idx, _need_final_obs in enumerate(need_final_obs):
                 if _need_final_obs:
                     real_next_obs[idx] = infos["final_observation"][idx]
+            timer.lap('final_obs')
             rb.add(obs, real_next_obs, actions, rewards, stop_bootstrap, infos)
+            timer.lap('rb_add')
 
             # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
             obs = next_obs
 
         # ALGO LOGIC: training.
+        if utd_controller is not None:
+            utd_controller.collected()
         if global_step < args.learning_starts:
             continue
 
         learning_has_started = True
-        for local_update in range(num_updates_per_training):
+        for local_update in range(cycle_updates):
             global_update += 1
             data = rb.sample(args.batch_size)
+            timer.lap('rb_sample')
 
             #############################################
             # Train agent
             #############################################
+            if fused_update is not None:
+                qf1_a_values, qf2_a_values, qf1_loss, qf2_loss, qf_loss, actor_loss, alpha_loss, alpha = fused_update(data, global_update)
+                timer.lap('fused_update')
+                continue
+
             # compute reward by discriminator
-            disc_rewards = disc.get_reward(data.next_observations, data.rewards, data.dones)
+            if disc is not None:
+                disc_rewards = disc.get_reward(data.next_observations, data.rewards, data.dones)
+            else:
+                disc_rewards = data.rewards.flatten()
+            timer.lap('disc_reward')
 
             # update the value networks
             with torch.no_grad():
@@ -392,6 +718,7 @@ if __name__ == "__main__":
             q_optimizer.zero_grad()
             qf_loss.backward()
             q_optimizer.step()
+            timer.lap('critic_step')
 
             # update the policy network
             if global_update % args.policy_frequency == 0:  # TD 3 Delayed update support
@@ -404,6 +731,7 @@ if __name__ == "__main__":
                 actor_optimizer.zero_grad()
                 actor_loss.backward()
                 actor_optimizer.step()
+                timer.lap('actor_step')
 
                 if args.autotune:
                     with torch.no_grad():
@@ -414,6 +742,7 @@ if __name__ == "__main__":
                     alpha_loss.backward()
                     a_optimizer.step()
                     alpha = log_alpha.exp().item()
+                    timer.lap('alpha_step')
 
             # update the target networks
             if global_update % args.target_network_frequency == 0:
@@ -421,38 +750,86 @@ if __name__ == "__main__":
                     target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
                 for param, target_param in zip(qf2.parameters(), qf2_target.parameters()):
                     target_param.data.copy_(args.tau * param.data + (1 - args.tau) * target_param.data)
+                timer.lap('target_update')
+        if rollout_policy is not None:
+            rollout_policy.sync()
+        if utd_controller is not None:
+            utd_controller.trained()
 
         # Log training-related data
-        if (global_step - args.training_freq) // args.log_freq < global_step // args.log_freq:
+        if (global_step - cycle_steps) // args.log_freq < global_step // args.log_freq:
             if len(result['return']) > 0:
-                for k, v in result.items():
-                    tag = k if '/' in k else f"train/{k}"
-                    writer.add_scalar(tag, np.mean(v), global_step)
-                result = defaultdict(list)
-            writer.add_scalar("losses/qf1_values", qf1_a_values.mean().item(), global_step)
-            writer.add_scalar("losses/qf2_values", qf2_a_values.mean().item(), global_step)
-            writer.add_scalar("losses/qf1_loss", qf1_loss.item(), global_step)
-            writer.add_scalar("losses/qf2_loss", qf2_loss.item(), global_step)
-            writer.add_scalar("losses/qf_loss", qf_loss.item() / 2.0, global_step)
-            writer.add_scalar("losses/actor_loss", actor_loss.item(), global_step)
+                result.write(writer, global_step, prefix='train')
+                result = MetricsAggregator()
+            writer.add_scalar("losses/qf1_values", qf1_a_values.mean(), global_step)
+            writer.add_scalar("losses/qf2_values", qf2_a_values.mean(), global_step)
+            writer.add_scalar("losses/qf1_loss", qf1_loss, global_step)
+            writer.add_scalar("losses/qf2_loss", qf2_loss, global_step)
+            writer.add_scalar("losses/qf_loss", qf_loss / 2.0, global_step)
+            writer.add_scalar("losses/actor_loss", actor_loss, global_step)
             writer.add_scalar("losses/alpha", alpha, global_step)
-            writer.add_scalar("charts/SPS", int(global_step / (time.time() - start_time)), global_step)
+            writer.add_scalar("charts/SPS", int((global_step - start_step) / (time.time() - start_time)), global_step)
             if args.autotune:
-                writer.add_scalar("losses/alpha_loss", alpha_loss.item(), global_step)
+                writer.add_scalar("losses/alpha_loss", alpha_loss, global_step)
+            if utd_controller is not None:
+                utd_controller.write(writer, global_step)
+            timer.write(writer, global_step)
+        timer.lap('logging')
 
         # Evaluation
-        if (global_step - args.training_freq) // args.eval_freq < global_step // args.eval_freq:
-            result = evaluate(args.num_eval_episodes, actor, eval_envs, device)
-            for k, v in result.items():
-                writer.add_scalar(f"eval/{k}", np.mean(v), global_step)
+        if (global_step - cycle_steps) // args.eval_freq < global_step // args.eval_freq:
+            if args.async_eval:
+                evaluator.submit(global_step, actor)
+            else:
+                result = evaluate(args.num_eval_episodes, actor, eval_envs, device, verbose=not args.quiet)
+                result.write(writer, global_step, prefix='eval')
+        if args.async_eval:
+            # logged at the step the actor snapshot was taken
+            for eval_step, eval_result in evaluator.poll():
+                for k, v in eval_result.items():
+                    writer.add_scalar(f"eval/{k}", np.mean(v), eval_step)
+        timer.lap('evaluation')
 
         # Checkpoint
         if args.save_freq and ( global_step >= args.total_timesteps or \
-                (global_step - args.training_freq) // args.save_freq < global_step // args.save_freq):
+                (global_step - cycle_steps) // args.save_freq < global_step // args.save_freq):
             os.makedirs(f'{log_path}/checkpoints', exist_ok=True)
             torch.save({
                 'actor': actor.state_dict(),
             }, f'{log_path}/checkpoints/{global_step}.pt')
 
+        # Full training state
+        if args.state_save_freq and ( global_step >= args.total_timesteps or \
+                (global_step - cycle_steps) // args.state_save_freq < global_step // args.state_save_freq):
+            checkpointer.save(global_step, {
+                'global_update': global_update,
+                'learning_has_started': learning_has_started,
+                'actor': actor.state_dict(),
+                'qf1': qf1.state_dict(),
+                'qf2': qf2.state_dict(),
+                'qf1_target': qf1_target.state_dict(),
+                'qf2_target': qf2_target.state_dict(),
+                'actor_optimizer': actor_optimizer.state_dict(),
+                'q_optimizer': q_optimizer.state_dict(),
+                'log_alpha': log_alpha if args.autotune else None,
+                'a_optimizer': a_optimizer.state_dict() if args.autotune else None,
+                'alpha': alpha,
+                'rng': get_rng_state(),
+                'action_space_rng': envs.single_action_space.np_random.bit_generator.state,
+                'rollout_rng': rollout_policy.rng_state() if rollout_policy is not None else None,
+                'utd_controller': utd_controller.state_dict() if utd_controller is not None else None,
+            }, buffers={'rb': (rb, global_step // args.num_envs)})
+        timer.lap('checkpoint')
+
+    if checkpointer is not None:
+        checkpointer.close()
+    if args.async_eval:
+        for eval_step, eval_result in evaluator.close():
+            for k, v in eval_result.items():
+                writer.add_scalar(f"eval/{k}", np.mean(v), eval_step)
+    else:
+        eval_envs.close()
+    if learner is not None:
+        learner.close()
     envs.close()
     writer.close()
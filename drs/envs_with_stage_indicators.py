@@ -56,6 +56,12 @@ class PickAndPlace_DrS_learn(PickSingleYCBEnv, DrS_BaseEnv):
 class PickAndPlace_DrS_reuse(PickSingleEGADEnv, PickAndPlace_DrS_learn):
     pass
 
+############################################
+# Stack Cube
+############################################
+
+from mani_skill2.envs.pick_and_place.stack_cube import StackCubeEnv
+
 @register_env("StackCube_DrS_learn-v0", max_episode_steps=100)
 class StackCube_DrS_learn(StackCubeEnv, DrS_BaseEnv):
     def __init__(self, *args, **kwargs):
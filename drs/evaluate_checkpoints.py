@@ -0,0 +1,153 @@
+import argparse
+import csv
+import glob
+import os
+import time
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import multiprocessing as mp
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+# Usage:
+#   python -m drs.evaluate_checkpoints --ckpt-dir output/TurnFaucet_DrS_reuse-v0 \
+#       --env-ids TurnFaucet_DrS_reuse-v0 --control-mode pd_ee_delta_pose --num-workers 16
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt-dir", type=str, required=True,
+        help="the directory searched recursively for checkpoints with an `actor` entry")
+    parser.add_argument("--env-ids", type=str, nargs='+', required=True,
+        help="the ids of the environments to evaluate every checkpoint on")
+    parser.add_argument("--control-mode", type=str, default='pd_ee_delta_pose')
+    parser.add_argument("--num-episodes", type=int, default=100,
+        help="the number of evaluation episodes per checkpoint and environment")
+    parser.add_argument("--episodes-per-job", type=int, default=10,
+        help="the number of episodes handed to a worker at once")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=1000,
+        help="episode i is reset with seed + i, so that all checkpoints see the same episodes")
+    parser.add_argument("--output", type=str, default=None,
+        help="the path of the results table (csv), defaults to `eval_results.csv` in ckpt-dir")
+    parser.add_argument("--int8", type=str, choices=['dynamic', 'static'], default=None,
+        help="if set, the actors are quantized to int8 (see drs.quantization) before they are evaluated")
+    parser.add_argument("--int8-calib", type=str, default=None,
+        help="the observations static int8 actors are calibrated on: a demo .pkl, a stage_buffers directory or a .npy array")
+    args = parser.parse_args()
+    assert args.int8 != 'static' or args.int8_calib, "--int8 static needs --int8-calib"
+    if args.output is None:
+        args.output = os.path.join(args.ckpt_dir, 'eval_results.csv')
+    return args
+
+
+# Worker state, kept across jobs: one env and one actor per env id, the last loaded weights, and
+# their int8 actors per env id
+_worker = {}
+
+def _init_worker(control_mode, int8=None, int8_calib=None):
+    torch.set_num_threads(1)
+    _worker.update(control_mode=control_mode, envs={}, actors={}, ckpt_path=None, weights=None, int8=int8, calib_obs=None, quantized={})
+    if int8_calib is not None:
+        from drs.quantization import load_calibration_obs
+        _worker['calib_obs'] = load_calibration_obs(int8_calib, max_rows=2048)
+
+def _get_actor(env_id):
+    from drs.drs_reuse_reward_maniskill2 import Actor, make_env
+    if env_id not in _worker['envs']:
+        envs = gym.vector.SyncVectorEnv([make_env(env_id, 0, _worker['control_mode'])])
+        _worker['envs'][env_id] = envs
+        _worker['actors'][env_id] = Actor(envs).eval()
+    return _worker['envs'][env_id], _worker['actors'][env_id]
+
+def _run_job(job):
+    ckpt_path, env_id, seeds = job
+    if _worker['ckpt_path'] != ckpt_path:
+        ckpt = torch.load(ckpt_path, map_location='cpu', weights_only=False)
+        _worker.update(ckpt_path=ckpt_path, weights=ckpt.get('actor'), quantized={})
+    if _worker['weights'] is None:
+        return ckpt_path, env_id, None, 'no actor in checkpoint'
+    envs, actor = _get_actor(env_id)
+    if env_id in _worker['quantized']:
+        actor = _worker['quantized'][env_id]
+    else:
+        try:
+            actor.load_state_dict(_worker['weights'])
+        except RuntimeError as e:
+            return ckpt_path, env_id, None, str(e).splitlines()[0]
+        if _worker['int8'] is not None:
+            # once per checkpoint and env id, the later jobs of this checkpoint reuse it
+            from drs.quantization import quantize_actor
+            actor = _worker['quantized'][env_id] = quantize_actor(actor, _worker['int8'], _worker['calib_obs'])
+    episodes = []
+    for seed in seeds:
+        obs, info = envs.reset(seed=int(seed))
+        while True:
+            with torch.no_grad():
+                action = actor.get_eval_action(torch.Tensor(obs))
+            obs, rew, terminated, truncated, info = envs.step(action.numpy())
+            if terminated[0] or truncated[0]:
+                final_info = info['final_info'][0]
+                episodes.append((final_info['episode']['r'][0], final_info['episode']['l'][0], float(final_info['success'])))
+                break
+    return ckpt_path, env_id, episodes, None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # the full training states (`checkpoints/state`, see --state-save-freq) hold an actor too, but are not checkpoints
+    ckpt_paths = sorted(
+        p for p in glob.glob(os.path.join(args.ckpt_dir, '**', '*.pt'), recursive=True)
+        if not os.path.dirname(os.path.abspath(p)).endswith(os.path.join('checkpoints', 'state'))
+    )
+    assert len(ckpt_paths) > 0, f"no checkpoints found in {args.ckpt_dir}"
+    seeds = args.seed + np.arange(args.num_episodes)
+    jobs = [
+        (ckpt_path, env_id, seeds[i:i + args.episodes_per_job])
+        for ckpt_path in ckpt_paths
+        for env_id in args.env_ids
+        for i in range(0, args.num_episodes, args.episodes_per_job)
+    ]
+    print(f'Evaluating {len(ckpt_paths)} checkpoints on {len(args.env_ids)} envs: {len(jobs)} jobs on {args.num_workers} workers')
+
+    start_time = time.time()
+    episodes = {}
+    errors = {}
+    ctx = mp.get_context('forkserver')
+    with ctx.Pool(args.num_workers, initializer=_init_worker, initargs=(args.control_mode, args.int8, args.int8_calib)) as pool:
+        for n_done, (ckpt_path, env_id, eps, error) in enumerate(pool.imap_unordered(_run_job, jobs), 1):
+            if error is not None:
+                errors[(ckpt_path, env_id)] = error
+            else:
+                episodes.setdefault((ckpt_path, env_id), []).extend(eps)
+            if n_done % 100 == 0:
+                print(f'{n_done}/{len(jobs)} jobs done, {time.time() - start_time:.0f}s')
+
+    rows = []
+    for ckpt_path in ckpt_paths:
+        for env_id in args.env_ids:
+            key = (ckpt_path, env_id)
+            if key in errors:
+                if errors[key] != 'no actor in checkpoint':
+                    print(f'Skipped {ckpt_path} on {env_id}: {errors[key]}')
+                continue
+            eps = np.array(episodes[key])
+            rows.append({
+                'checkpoint': os.path.relpath(ckpt_path, args.ckpt_dir),
+                'env_id': env_id,
+                'episodes': len(eps),
+                'success_rate': eps[:, 2].mean(),
+                'return_mean': eps[:, 0].mean(),
+                'return_std': eps[:, 0].std(),
+                'len_mean': eps[:, 1].mean(),
+            })
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['checkpoint', 'env_id', 'episodes', 'success_rate', 'return_mean', 'return_std', 'len_mean'])
+        writer.writeheader()
+        writer.writerows(rows)
+    for row in rows:
+        print(f"{row['checkpoint']}  {row['env_id']}  success={row['success_rate']:.3f}  return={row['return_mean']:.2f}  len={row['len_mean']:.1f}")
+    print(f'Results of {len(rows)} evaluations written to {args.output} in {time.time() - start_time:.0f}s')
@@ -0,0 +1,248 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+
+class EnsembleLinear(nn.Module):
+    # n_members independent linear layers evaluated with one batched matmul
+    def __init__(self, n_members, in_features, out_features):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(n_members, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(n_members, 1, out_features))
+
+    def forward(self, x):
+        # x: (n_members, batch, in_features)
+        return torch.baddbmm(self.bias, x, self.weight.transpose(1, 2))
+
+
+class EnsembleSoftQNetwork(nn.Module):
+    # The twin critics as one module. Built from SoftQNetworks, whose parameters then become views
+    # into the ensemble: their state_dicts stay valid, and load_state_dict on them writes through.
+    def __init__(self, qfs):
+        super().__init__()
+        linears = [[m for m in qf.net if isinstance(m, nn.Linear)] for qf in qfs]
+        self.layers = nn.ModuleList([
+            EnsembleLinear(len(qfs), l.in_features, l.out_features) for l in linears[0]
+        ])
+        with torch.no_grad():
+            for i, layer in enumerate(self.layers):
+                layer.weight.copy_(torch.stack([ls[i].weight for ls in linears]))
+                layer.bias.copy_(torch.stack([ls[i].bias for ls in linears])[:, None])
+        self.to(linears[0][0].weight.device)
+        for i, layer in enumerate(self.layers):
+            for j, ls in enumerate(linears):
+                ls[i].weight.data = layer.weight.data[j]
+                ls[i].bias.data = layer.bias.data[j, 0]
+
+    def forward(self, x, a, detach_params=False):
+        # returns (n_members, batch, 1), with detach_params no gradients flow into the ensemble
+        x = torch.cat([x, a], -1)
+        if x.dim() == 2:
+            x = x.expand(len(self.layers[0].weight), *x.shape)
+        for i, layer in enumerate(self.layers):
+            w, b = (layer.weight.detach(), layer.bias.detach()) if detach_params else (layer.weight, layer.bias)
+            x = torch.baddbmm(b, x, w.transpose(1, 2))
+            if i < len(self.layers) - 1:
+                x = F.relu(x)
+        return x
+
+
+def sample_action(actor, x):
+    # Actor.get_action without torch.distributions, which is cheaper to trace
+    mean, log_std = actor(x)
+    return squashed_normal_sample(mean, log_std, actor.action_scale, actor.action_bias)
+
+
+def squashed_normal_sample(mean, log_std, action_scale, action_bias, eps=None):
+    if eps is None:
+        eps = torch.randn_like(mean)
+    x_t = mean + log_std.exp() * eps
+    y_t = torch.tanh(x_t)
+    action = y_t * action_scale + action_bias
+    log_prob = -0.5 * eps.pow(2) - log_std - 0.5 * math.log(2 * math.pi)
+    log_prob = log_prob - torch.log(action_scale * (1 - y_t.pow(2)) + 1e-6)
+    return action, log_prob.sum(-1, keepdim=True)
+
+
+class FusedSACUpdate(object):
+    # One SAC update (reward, critics, actor, alpha, target networks) in a single torch.compile'd
+    # function with static shapes. Compared to the update in the scripts:
+    # - the twin critics (and their targets) are one EnsembleSoftQNetwork, evaluated with batched matmuls
+    # - the actor runs once on cat([next_obs, obs]), its log-probs on obs are reused for the alpha loss
+    #   (so the alpha loss sees the actor before, not after, this update's actor step)
+    # - critic, actor and alpha losses are summed and share one backward pass, so the actor loss uses
+    #   the critics before, not after, this update's critic step
+    # - the target networks are updated with one fused foreach lerp
+    # `q_optimizer` replaces the optimizer of the scripts, which held the parameters of qf1 and qf2.
+    # `grad_hook`, if set, is called with the parameters that received gradients after the backward pass
+    # and before the optimizer steps (see drs.ddp_learner).
+    def __init__(self, actor, qf1, qf2, qf1_target, qf2_target, actor_optimizer, q_lr, gamma, tau,
+                 policy_frequency=1, target_network_frequency=1, reward_fn=None,
+                 alpha=0.2, log_alpha=None, a_optimizer=None, target_entropy=None, alpha_loss_exp=False,
+                 compile=True):
+        self.actor = actor
+        self.qf = EnsembleSoftQNetwork([qf1, qf2])
+        self.qf_target = EnsembleSoftQNetwork([qf1_target, qf2_target])
+        self.qf_target.requires_grad_(False)
+        self.q_optimizer = optim.Adam(self.qf.parameters(), lr=q_lr)
+        self.actor_optimizer = actor_optimizer
+        self.gamma = gamma
+        self.tau = tau
+        self.policy_frequency = policy_frequency
+        self.target_network_frequency = target_network_frequency
+        self.reward_fn = reward_fn # (next_obs, rewards, dones) -> rewards, e.g. Discriminator.get_reward
+        self.alpha = alpha
+        self.log_alpha = log_alpha # None unless alpha is tuned
+        self.a_optimizer = a_optimizer
+        self.target_entropy = target_entropy
+        self.alpha_loss_exp = alpha_loss_exp # alpha loss on exp(log_alpha) instead of log_alpha
+        self._params = list(self.qf.parameters())
+        self._target_params = list(self.qf_target.parameters())
+        self._actor_params = list(self.actor.parameters()) + ([self.log_alpha] if self.log_alpha is not None else [])
+        self.compile = compile
+        self.grad_hook = None
+        self._step = torch.compile(self._update, dynamic=False) if compile else self._update
+        self.actor_loss = None
+        self.alpha_loss = None
+
+    def __getstate__(self):
+        # the compiled function cannot be pickled, and the hook belongs to the process that set it
+        state = self.__dict__.copy()
+        del state['_step']
+        state['grad_hook'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._step = torch.compile(self._update, dynamic=False) if self.compile else self._update
+
+    def __call__(self, data, global_update):
+        # returns the same quantities as the update in the scripts, actor and alpha losses are the
+        # ones of the last actor update
+        update_actor = global_update % self.policy_frequency == 0
+        update_target = global_update % self.target_network_frequency == 0
+        out = self._step(data.observations, data.actions, data.next_observations, data.rewards, data.dones,
+                         update_actor, update_target)
+        qf_a_values, qf1_loss, qf2_loss, qf_loss, actor_loss, alpha_loss, alpha = out
+        if update_actor:
+            self.actor_loss = actor_loss
+            if self.log_alpha is not None:
+                self.alpha_loss = alpha_loss
+                self.alpha = alpha
+        return qf_a_values[0], qf_a_values[1], qf1_loss, qf2_loss, qf_loss, self.actor_loss, self.alpha_loss, self.alpha
+
+    def _update(self, obs, actions, next_obs, rewards, dones, update_actor, update_target):
+        bs = obs.shape[0]
+        if self.reward_fn is not None:
+            rewards = self.reward_fn(next_obs, rewards, dones)
+        alpha = self.log_alpha.detach().exp() if self.log_alpha is not None else self.alpha
+
+        pi, log_pi = sample_action(self.actor, torch.cat([next_obs, obs], 0))
+        with torch.no_grad():
+            next_state_actions, next_state_log_pi = pi[:bs], log_pi[:bs]
+            min_qf_next_target = self.qf_target(next_obs, next_state_actions).min(0).values - alpha * next_state_log_pi
+            next_q_value = rewards.flatten() + (1 - dones.flatten()) * self.gamma * min_qf_next_target.view(-1)
+
+        qf_a_values = self.qf(obs, actions).view(2, bs)
+        qf1_loss = F.mse_loss(qf_a_values[0], next_q_value)
+        qf2_loss = F.mse_loss(qf_a_values[1], next_q_value)
+        qf_loss = qf1_loss + qf2_loss
+        loss = qf_loss
+
+        actor_loss, alpha_loss = None, None
+        if update_actor:
+            pi, log_pi = pi[bs:], log_pi[bs:]
+            min_qf_pi = self.qf(obs, pi, detach_params=True).min(0).values
+            actor_loss = ((alpha * log_pi) - min_qf_pi).mean()
+            loss = loss + actor_loss
+            if self.log_alpha is not None:
+                log_alpha = self.log_alpha.exp() if self.alpha_loss_exp else self.log_alpha
+                alpha_loss = (-log_alpha * (log_pi.detach() + self.target_entropy)).mean()
+                loss = loss + alpha_loss
+
+        # the losses depend on disjoint parameters, so one backward pass computes all gradients
+        self.q_optimizer.zero_grad()
+        if update_actor:
+            self.actor_optimizer.zero_grad()
+            if self.log_alpha is not None:
+                self.a_optimizer.zero_grad()
+        loss.backward()
+        if self.grad_hook is not None:
+            self.grad_hook(self._params + self._actor_params if update_actor else self._params)
+        self.q_optimizer.step()
+        if update_actor:
+            self.actor_optimizer.step()
+            if self.log_alpha is not None:
+                self.a_optimizer.step()
+                alpha = self.log_alpha.detach().exp()
+
+        if update_target:
+            with torch.no_grad():
+                torch._foreach_lerp_(self._target_params, self._params, self.tau)
+        return qf_a_values.detach(), qf1_loss.detach(), qf2_loss.detach(), qf_loss.detach(), \
+            actor_loss.detach() if actor_loss is not None else None, \
+            alpha_loss.detach() if alpha_loss is not None else None, alpha
+
+
+class DiscriminatorStep(object):
+    # one discriminator step on a batch of failed and successful next observations of a stage, or
+    # (`labelled`) one step of several stages on a stage-labelled batch
+    def __init__(self, disc, disc_optimizer, compile=True):
+        self.disc = disc
+        self.disc_optimizer = disc_optimizer
+        self.compile = compile
+        self.grad_hook = None
+        self._step = torch.compile(self._update, dynamic=False) if compile else self._update
+        self._labelled_step = torch.compile(self._labelled_update, dynamic=False) if compile else self._labelled_update
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_step']
+        del state['_labelled_step']
+        state['grad_hook'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._step = torch.compile(self._update, dynamic=False) if self.compile else self._update
+        self._labelled_step = torch.compile(self._labelled_update, dynamic=False) if self.compile else self._labelled_update
+
+    def __call__(self, fail_next_obs, success_next_obs, stage_idx):
+        return self._step(fail_next_obs, success_next_obs, stage_idx)
+
+    def labelled(self, next_obs, labels, weights, stage_ids):
+        # labels and weights are (batch, n_stages), see sample_stage_labelled in the reward learning script
+        return self._labelled_step(next_obs, labels, weights, tuple(stage_ids))
+
+    def _update(self, fail_next_obs, success_next_obs, stage_idx):
+        disc_next_obs = torch.cat([fail_next_obs, success_next_obs], dim=0)
+        disc_labels = torch.cat([
+            torch.zeros((fail_next_obs.shape[0], 1), device=disc_next_obs.device), # fail label is 0
+            torch.ones((success_next_obs.shape[0], 1), device=disc_next_obs.device), # success label is 1
+        ], dim=0)
+        logits = self.disc(disc_next_obs, stage_idx)
+        disc_loss = F.binary_cross_entropy_with_logits(logits, disc_labels)
+        self.disc_optimizer.zero_grad()
+        disc_loss.backward()
+        if self.grad_hook is not None:
+            self.grad_hook(list(self.disc.parameters()))
+        self.disc_optimizer.step()
+        return disc_loss.detach(), logits.detach()
+
+    def _labelled_update(self, next_obs, labels, weights, stage_ids):
+        # the stages have disjoint networks, so one step on the sum of their losses is one step of each
+        disc_loss, logits = 0, []
+        for i in stage_ids:
+            stage_logits = self.disc(next_obs, i)
+            stage_loss = F.binary_cross_entropy_with_logits(stage_logits, labels[:, i:i+1], reduction='none')
+            disc_loss = disc_loss + (weights[:, i:i+1] * stage_loss).sum()
+            logits.append(stage_logits)
+        self.disc_optimizer.zero_grad()
+        disc_loss.backward()
+        if self.grad_hook is not None:
+            self.grad_hook(list(self.disc.parameters()))
+        self.disc_optimizer.step()
+        return disc_loss.detach(), torch.cat(logits, dim=1).detach()
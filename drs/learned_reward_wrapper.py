@@ -0,0 +1,48 @@
+import gymnasium as gym
+import numpy as np
+
+# The learned DrS reward computed inside the env, with a NumPy copy of a frozen Discriminator, so that
+# it is spread over the env workers and arrives with the transition. Any RL trainer can then consume
+# it like an ordinary env reward.
+#   weights = load_reward_weights('reward_checkpoints/TurnFaucet.pt') # in the parent process, needs torch
+#   env = LearnedRewardWrapper(gym.make('TurnFaucet_DrS_reuse-v0', reward_mode='semi_sparse'), weights)
+
+
+def load_reward_weights(path):
+    # the per-stage MLPs of a reward checkpoint as numpy arrays, stacked over the stages
+    import torch
+    state_dict = torch.load(path, map_location='cpu')['discriminator']
+    n_stages = len({k.split('.')[1] for k in state_dict if k.startswith('nets.')})
+    def stack(name):
+        return np.stack([state_dict[f'nets.{i}.{name}'].numpy() for i in range(n_stages)]).astype(np.float32)
+    return dict(
+        w1=stack('0.weight'), b1=stack('0.bias'), # (n_stages, 32, obs_dim), (n_stages, 32)
+        w2=stack('2.weight'), b2=stack('2.bias'), # (n_stages, 1, 32), (n_stages, 1)
+    )
+
+
+class LearnedRewardWrapper(gym.Wrapper):
+    # Replaces the semi_sparse reward (the stage index: the sum of the stage indicators in `extra`
+    # plus success) by Discriminator.get_reward of the next observation, with all stages trained as
+    # in the reuse phase. The stage index is kept in info['stage_idx'].
+    def __init__(self, env, weights):
+        super().__init__(env)
+        assert env.unwrapped._reward_mode == 'semi_sparse', "the stage index is read from the semi_sparse reward"
+        self.w1, self.b1, self.w2, self.b2 = weights['w1'], weights['b1'], weights['w2'], weights['b2']
+        self.n_stages = len(self.w1)
+        assert self.w1.shape[2] == np.prod(env.observation_space.shape), "the reward checkpoint has another observation size"
+
+    def learned_reward(self, next_obs, stage_idx):
+        k = 3
+        stage_reward = 0.0
+        if stage_idx < self.n_stages:
+            h = 1 / (1 + np.exp(-(self.w1[stage_idx] @ next_obs.reshape(-1) + self.b1[stage_idx])))
+            stage_reward = np.tanh(self.w2[stage_idx] @ h + self.b2[stage_idx]).item()
+        reward = (k * stage_idx + stage_reward) / (k * self.n_stages) # reward is in (0, 1]
+        return reward - 2 # make the reward negative
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        stage_idx = int(reward)
+        info['stage_idx'] = stage_idx
+        return obs, self.learned_reward(obs.astype(np.float32), stage_idx), terminated, truncated, info
@@ -0,0 +1,128 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class StreamingStat(object):
+    # Count, mean, min and max of all appended values, and percentiles of a fixed-size uniform
+    # sample of them (reservoir sampling), so memory does not grow with the number of values.
+    def __init__(self, reservoir_size=1024, rng=None):
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._reservoir = np.zeros(reservoir_size)
+        self._rng = rng if rng is not None else np.random.default_rng(0)
+
+    def append(self, x):
+        x = float(x)
+        if self.count < len(self._reservoir):
+            self._reservoir[self.count] = x
+        else:
+            j = self._rng.integers(self.count + 1)
+            if j < len(self._reservoir):
+                self._reservoir[j] = x
+        self.count += 1
+        self.total += x
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    def __len__(self):
+        return self.count
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else np.nan
+
+    def percentile(self, q):
+        if self.count == 0:
+            return np.nan
+        return np.percentile(self._reservoir[:min(self.count, len(self._reservoir))], q)
+
+
+class MetricsAggregator(object):
+    # Drop-in for the `defaultdict(list)` of episode metrics: `result[key].append(x)` creates the
+    # statistic on first use. `write` logs the means, and for `distributions` also percentiles and counts.
+    def __init__(self, distributions=('return', 'len'), percentiles=(10, 50, 90), reservoir_size=1024):
+        self.distributions = distributions
+        self.percentiles = percentiles
+        self.reservoir_size = reservoir_size
+        self._rng = np.random.default_rng(0) # not the global RNG, logging must not change training
+        self._stats = {}
+
+    def __getitem__(self, key):
+        if key not in self._stats:
+            self._stats[key] = StreamingStat(self.reservoir_size, self._rng)
+        return self._stats[key]
+
+    def __contains__(self, key):
+        return key in self._stats
+
+    def items(self):
+        return self._stats.items()
+
+    def write(self, writer, global_step, prefix):
+        for k, stat in self._stats.items():
+            if len(stat) == 0:
+                continue
+            tag = k if '/' in k else f"{prefix}/{k}"
+            writer.add_scalar(tag, stat.mean(), global_step)
+            if k in self.distributions:
+                for q in self.percentiles:
+                    writer.add_scalar(f"{tag}_p{q}", stat.percentile(q), global_step)
+                writer.add_scalar(f"{tag}_count", len(stat), global_step)
+
+
+class AsyncScalarWriter(object):
+    # Forwards add_scalar / add_text to a SummaryWriter from a background thread, so that the
+    # training loop never waits for tensorboard I/O. Tensors are converted to numbers in that thread,
+    # so logging a loss does not synchronize the training loop with the device either.
+    def __init__(self, writer):
+        self.writer = writer
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        self._raise_error()
+        if torch.is_tensor(scalar_value):
+            scalar_value = scalar_value.detach()
+        self._queue.put(('add_scalar', (tag, scalar_value, global_step)))
+
+    def add_text(self, tag, text_string, global_step=None):
+        self._raise_error()
+        self._queue.put(('add_text', (tag, text_string, global_step)))
+
+    def flush(self):
+        # waits until everything logged so far is written
+        self._queue.put(('flush', ()))
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('writing to tensorboard failed') from self._error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            if self._error is None:
+                method, args = job
+                try:
+                    if method == 'add_scalar' and torch.is_tensor(args[1]):
+                        args = (args[0], args[1].item(), args[2])
+                    getattr(self.writer, method)(*args)
+                except Exception as e:
+                    self._error = e
+            self._queue.task_done()
@@ -0,0 +1,60 @@
+import time
+
+import numpy as np
+import torch
+
+
+class PhaseTimer(object):
+    # Times consecutive phases of the training loop: `lap(name)` attributes the time since the
+    # previous lap to `name`. A disabled timer does no work at all.
+    def __init__(self, enabled=True, cuda_sync=False, window=4096):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync # needed to attribute asynchronous cuda work to the right phase
+        self.window = window # number of most recent samples per phase used for percentiles
+        self._samples = {}
+        self._counts = {}
+        self._totals = {}
+        self._last = time.perf_counter()
+        self._last_write = self._last
+        self._last_write_step = None
+
+    def lap(self, name):
+        if not self.enabled:
+            return
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        dt = now - self._last
+        self._last = now
+        if name not in self._samples:
+            self._samples[name] = np.zeros(self.window)
+            self._counts[name] = 0
+            self._totals[name] = 0.0
+        self._samples[name][self._counts[name] % self.window] = dt
+        self._counts[name] += 1
+        self._totals[name] += dt
+
+    def write(self, writer, global_step):
+        # export statistics of the phases since the last write under perf/, then start over
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        elapsed = now - self._last_write
+        n_steps = None if self._last_write_step is None else global_step - self._last_write_step
+        for name, count in self._counts.items():
+            if count == 0:
+                continue
+            samples = self._samples[name][:min(count, self.window)] * 1000
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            writer.add_scalar(f"perf/{name}/mean_ms", self._totals[name] / count * 1000, global_step)
+            writer.add_scalar(f"perf/{name}/p50_ms", p50, global_step)
+            writer.add_scalar(f"perf/{name}/p90_ms", p90, global_step)
+            writer.add_scalar(f"perf/{name}/p99_ms", p99, global_step)
+            writer.add_scalar(f"perf/{name}/share", self._totals[name] / elapsed, global_step)
+            if n_steps:
+                # the SPS the run would have if this phase was all it did
+                writer.add_scalar(f"perf/{name}/sps", n_steps / self._totals[name], global_step)
+            self._counts[name] = 0
+            self._totals[name] = 0.0
+        self._last_write = now
+        self._last_write_step = global_step
@@ -0,0 +1,219 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from stable_baselines3.common.buffers import ReplayBuffer
+from stable_baselines3.common.type_aliases import ReplayBufferSamples
+from torch.func import stack_module_state
+
+from drs.fused_update import squashed_normal_sample
+
+# Population mode: K independent SAC agents (e.g. K seeds) trained in one process. Their networks
+# are stacked along a leading member dim (torch.func.stack_module_state) and evaluated with batched
+# matmuls, like the ensemble critics of drs.fused_update, so every op runs once for all members
+# instead of K times. The env workers are partitioned between the members: member k owns
+# the env columns [k * E, (k + 1) * E) of the vector env, with E = num_envs / K. Each member has a
+# seed: its replay sampling, random warm-up actions and action noise draw from its own generators.
+
+
+def split_infos(infos, n_members):
+    # the per-member part of the infos of a vector env step, as far as collect_episode_info needs it
+    if "final_info" not in infos:
+        return [{} for _ in range(n_members)]
+    e = len(infos["_final_info"]) // n_members
+    return [{
+        "final_info": infos["final_info"][k * e:(k + 1) * e],
+        "_final_info": infos["_final_info"][k * e:(k + 1) * e],
+    } for k in range(n_members)]
+
+
+class PopulationReplayBuffer(object):
+    # One replay buffer per member, filled from the member's env columns and sampled with the member's
+    # own indices, drawn from a generator seeded with the member's seed. `sample` stacks the members'
+    # batches, i.e. every field is (n_members, batch_size, ...).
+    def __init__(self, n_members, buffer_size, observation_space, action_space, device, n_envs, seeds=None, **kwargs):
+        assert n_envs % n_members == 0, f"{n_envs} envs cannot be split between {n_members} members"
+        assert not kwargs.get('optimize_memory_usage', False), "sampling does not support optimize_memory_usage"
+        self.n_members = n_members
+        self.envs_per_member = n_envs // n_members
+        self.buffers = [
+            ReplayBuffer(buffer_size, observation_space, action_space, device, n_envs=self.envs_per_member, **kwargs)
+            for _ in range(n_members)
+        ]
+        self.rngs = [np.random.default_rng(s) for s in (seeds if seeds is not None else [None] * n_members)]
+
+    def add(self, obs, next_obs, action, reward, done, infos):
+        e = self.envs_per_member
+        for k, b in enumerate(self.buffers):
+            sl = slice(k * e, (k + 1) * e)
+            b.add(obs[sl], next_obs[sl], action[sl], reward[sl], done[sl], infos)
+
+    @staticmethod
+    def _sample_member(b, rng, batch_size):
+        # ReplayBuffer.sample (without obs normalization), with the indices drawn from rng instead of np.random
+        batch_inds = rng.integers(0, b.buffer_size if b.full else b.pos, size=batch_size)
+        env_inds = rng.integers(0, b.n_envs, size=batch_size)
+        data = (
+            b.observations[batch_inds, env_inds],
+            b.actions[batch_inds, env_inds],
+            b.next_observations[batch_inds, env_inds],
+            (b.dones[batch_inds, env_inds] * (1 - b.timeouts[batch_inds, env_inds])).reshape(-1, 1),
+            b.rewards[batch_inds, env_inds].reshape(-1, 1),
+        )
+        return ReplayBufferSamples(*tuple(map(b.to_torch, data)))
+
+    def sample(self, batch_size):
+        batches = [self._sample_member(b, rng, batch_size) for b, rng in zip(self.buffers, self.rngs)]
+        return ReplayBufferSamples(*[torch.stack(x) for x in zip(*batches)])
+
+
+def stacked_linear(params, name, x):
+    # x: (n_members, batch, in_features), params stacked with torch.func.stack_module_state
+    return torch.baddbmm(params[f'{name}.bias'].unsqueeze(1), x, params[f'{name}.weight'].transpose(1, 2))
+
+
+def stacked_sequential(seq, params, name, x):
+    # an nn.Sequential of Linear and ReLU layers, evaluated for all members with batched matmuls
+    for i, m in enumerate(seq):
+        if isinstance(m, nn.Linear):
+            x = stacked_linear(params, f'{name}.{i}', x)
+        elif isinstance(m, nn.ReLU):
+            x = F.relu(x)
+        else:
+            raise NotImplementedError(type(m))
+    return x
+
+
+class PopulationSAC(object):
+    # The SAC update of the scripts for all members at once, following FusedSACUpdate (one actor
+    # forward on cat([next_obs, obs]), one backward pass for critic, actor and alpha losses, fused
+    # target update). The reward function (e.g. a frozen, shared Discriminator) runs once on the
+    # batches of all members. Adam is elementwise, so one optimizer over the stacked parameters
+    # equals one optimizer per member. Losses are returned per member, as (n_members,) tensors.
+    def __init__(self, actors, qf1s, qf2s, log_std_bounds, policy_lr, q_lr, gamma, tau, policy_frequency=1,
+                 target_network_frequency=1, reward_fn=None, alpha=0.2, autotune=False, target_entropy=None,
+                 alpha_loss_exp=False, seeds=None):
+        self.n_members = len(actors)
+        self.actor_params, self.actor_buffers = stack_module_state(actors)
+        # (2 * n_members, ...): the first critics of all members, then their second critics
+        self.q_params, _ = stack_module_state(list(qf1s) + list(qf2s))
+        self.q_target_params = {k: v.detach().clone() for k, v in self.q_params.items()}
+        self._actor = actors[0] # only its layout and action scaling are used
+        self._qf = qf1s[0]
+        self.log_std_min, self.log_std_max = log_std_bounds
+        device = actors[0].action_scale.device
+        seeds = seeds if seeds is not None else [None] * self.n_members
+        # the members' action noise (torch) and random warm-up actions (numpy)
+        self.generators = [torch.Generator(device=device) for _ in range(self.n_members)]
+        for g, s in zip(self.generators, seeds):
+            if s is not None:
+                g.manual_seed(s)
+            else:
+                g.seed()
+        self.action_rngs = [np.random.default_rng(s) for s in seeds]
+        self.actor_optimizer = optim.Adam(list(self.actor_params.values()), lr=policy_lr)
+        self.q_optimizer = optim.Adam(list(self.q_params.values()), lr=q_lr)
+        self.gamma = gamma
+        self.tau = tau
+        self.policy_frequency = policy_frequency
+        self.target_network_frequency = target_network_frequency
+        self.reward_fn = reward_fn # (next_obs, rewards, dones) -> rewards, e.g. Discriminator.get_reward
+        self.target_entropy = target_entropy
+        self.alpha_loss_exp = alpha_loss_exp # alpha loss on exp(log_alpha) instead of log_alpha
+        if autotune:
+            self.log_alpha = torch.zeros(self.n_members, requires_grad=True, device=device)
+            self.a_optimizer = optim.Adam([self.log_alpha], lr=q_lr)
+            self.alpha = self.log_alpha.detach().exp()
+        else:
+            self.log_alpha = None
+            self.alpha = torch.full((self.n_members,), alpha, device=device)
+        self.actor_loss = None
+        self.alpha_loss = None
+
+    def _policy(self, params, x):
+        # Actor.get_action for all members, x: (n_members, batch, obs_dim)
+        h = stacked_sequential(self._actor.backbone, params, 'backbone', x)
+        mean = stacked_linear(params, 'fc_mean', h)
+        log_std = torch.tanh(stacked_linear(params, 'fc_logstd', h))
+        log_std = self.log_std_min + 0.5 * (self.log_std_max - self.log_std_min) * (log_std + 1)
+        eps = torch.stack([torch.randn(mean.shape[1:], generator=g, device=mean.device) for g in self.generators])
+        return squashed_normal_sample(mean, log_std, self._actor.action_scale, self._actor.action_bias, eps=eps)
+
+    def _twin_q(self, params, x, a):
+        # (2, n_members, batch, 1)
+        x = torch.cat([x, a], -1).repeat(2, 1, 1)
+        return stacked_sequential(self._qf.net, params, 'net', x).view(2, self.n_members, *x.shape[1:-1], 1)
+
+    def __call__(self, data, global_update):
+        # data: stacked batches of the members, see PopulationReplayBuffer.sample
+        update_actor = global_update % self.policy_frequency == 0
+        update_target = global_update % self.target_network_frequency == 0
+        obs, actions, next_obs, dones, rewards = data.observations, data.actions, data.next_observations, data.dones, data.rewards
+        bs = obs.shape[1]
+        if self.reward_fn is not None:
+            with torch.no_grad():
+                rewards = self.reward_fn(next_obs.flatten(0, 1), rewards.flatten(0, 1), dones.flatten(0, 1)).view(rewards.shape)
+        alpha = self.alpha.view(-1, 1, 1)
+
+        pi, log_pi = self._policy(self.actor_params, torch.cat([next_obs, obs], 1))
+        with torch.no_grad():
+            next_state_actions, next_state_log_pi = pi[:, :bs], log_pi[:, :bs]
+            min_qf_next_target = self._twin_q(self.q_target_params, next_obs, next_state_actions).min(0).values - alpha * next_state_log_pi
+            next_q_value = rewards + (1 - dones) * self.gamma * min_qf_next_target
+
+        qf_a_values = self._twin_q(self.q_params, obs, actions)
+        qf1_loss = (qf_a_values[0] - next_q_value).pow(2).mean((1, 2))
+        qf2_loss = (qf_a_values[1] - next_q_value).pow(2).mean((1, 2))
+        loss = qf1_loss + qf2_loss
+
+        if update_actor:
+            pi, log_pi = pi[:, bs:], log_pi[:, bs:]
+            min_qf_pi = self._twin_q({k: v.detach() for k, v in self.q_params.items()}, obs, pi).min(0).values
+            actor_loss = ((alpha * log_pi) - min_qf_pi).mean((1, 2))
+            loss = loss + actor_loss
+            if self.log_alpha is not None:
+                log_alpha = self.log_alpha.exp() if self.alpha_loss_exp else self.log_alpha
+                alpha_loss = (-log_alpha * (log_pi.detach() + self.target_entropy).mean((1, 2)))
+                loss = loss + alpha_loss
+
+        # members and losses depend on disjoint parameters, so one backward pass computes all gradients
+        self.q_optimizer.zero_grad()
+        if update_actor:
+            self.actor_optimizer.zero_grad()
+            if self.log_alpha is not None:
+                self.a_optimizer.zero_grad()
+        loss.sum().backward()
+        self.q_optimizer.step()
+        if update_actor:
+            self.actor_optimizer.step()
+            self.actor_loss = actor_loss.detach()
+            if self.log_alpha is not None:
+                self.a_optimizer.step()
+                self.alpha = self.log_alpha.detach().exp()
+                self.alpha_loss = alpha_loss.detach()
+
+        if update_target:
+            with torch.no_grad():
+                torch._foreach_lerp_(list(self.q_target_params.values()), list(self.q_params.values()), self.tau)
+        qf_a_values = qf_a_values.detach().squeeze(-1)
+        return qf_a_values[0], qf_a_values[1], qf1_loss.detach(), qf2_loss.detach(), (qf1_loss + qf2_loss).detach(), \
+            self.actor_loss, self.alpha_loss, self.alpha
+
+    def act(self, obs):
+        # actions for the whole vector env, each member acting on its own env columns
+        with torch.inference_mode():
+            x = torch.as_tensor(obs, dtype=torch.float32, device=self.alpha.device)
+            actions, _ = self._policy(self.actor_params, x.view(self.n_members, -1, *x.shape[1:]))
+            return actions.flatten(0, 1).cpu().numpy()
+
+    def random_actions(self, action_space, n):
+        # uniform actions of a bounded Box for the whole vector env, each member drawing its own columns
+        return np.concatenate([
+            rng.uniform(action_space.low, action_space.high, size=(n // self.n_members,) + action_space.shape)
+            for rng in self.action_rngs
+        ]).astype(action_space.dtype)
+
+    def actor_state_dict(self, k):
+        # member k's actor, as a state_dict of the scripts' Actor
+        return {n: v[k].detach().clone() for n, v in {**self.actor_params, **self.actor_buffers}.items()}
@@ -0,0 +1,185 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+from collections import defaultdict
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import gymnasium as gym
+import numpy as np
+
+import drs.synthetic_env
+try:
+    import drs.envs_with_stage_indicators
+except ModuleNotFoundError as e: # DrS_Synthetic-v0 can be profiled without ManiSkill2
+    if e.name.split('.')[0] not in ('mani_skill2', 'sapien'):
+        raise
+
+# Per-step cost of the DrS additions (stage indicators, semi-sparse rewards) on each task.
+# Usage:
+#   python -m drs.profile_envs --num-steps 1000 --output env_profile.json
+
+CONTROL_MODES = {
+    'PickAndPlace_DrS_learn-v0': 'pd_ee_delta_pos',
+    'StackCube_DrS_learn-v0': 'pd_ee_delta_pos',
+    'PegInsertionSide_DrS_learn-v0': 'pd_ee_delta_pose',
+    'TurnFaucet_DrS_learn-v0': 'pd_ee_delta_pose',
+    'OpenCabinetDoor_DrS_learn-v0': 'base_pd_joint_vel_arm_pd_joint_vel',
+}
+# methods of the env, and of its agent, whose time is measured. step_action is the physics step.
+ENV_METHODS = ('_get_obs_extra', 'compute_stage_indicator', 'evaluate', 'get_reward', 'step_action')
+AGENT_METHODS = ('check_grasp',)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--env-ids", type=str, nargs='+', default=list(CONTROL_MODES.keys()))
+    parser.add_argument("--control-modes", type=str, nargs='+', default=None,
+        help="one control mode per env id, defaults to the ones used in the README")
+    parser.add_argument("--reward-modes", type=str, nargs='+', default=['semi_sparse', 'sparse'])
+    parser.add_argument("--num-steps", type=int, default=1000,
+        help="the number of timed env steps per env and reward mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env-kwargs", type=json.loads, default={})
+    parser.add_argument("--output", type=str, default='env_profile.json')
+    args = parser.parse_args()
+    if args.control_modes is None:
+        args.control_modes = [CONTROL_MODES.get(env_id) for env_id in args.env_ids]
+    assert len(args.control_modes) == len(args.env_ids)
+    return args
+
+
+class CallProfiler(object):
+    # Wraps bound methods to accumulate their calls, inclusive time and self time (excluding other
+    # profiled methods called from within them). Only records while `active`.
+    def __init__(self):
+        self.stats = defaultdict(lambda: dict(calls=0, total=0.0, self=0.0))
+        self.active = False
+        self._children = [] # time spent in profiled callees, per frame of the profiled call stack
+
+    def patch(self, obj, names, prefix=''):
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is None or getattr(method, '_profiled', False):
+                continue
+            setattr(obj, name, self._wrap(prefix + name, method))
+
+    def _wrap(self, name, fn):
+        def wrapped(*args, **kwargs):
+            if not self.active:
+                return fn(*args, **kwargs)
+            self._children.append(0.0)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                dt = time.perf_counter() - start
+                s = self.stats[name]
+                s['calls'] += 1
+                s['total'] += dt
+                s['self'] += dt - self._children.pop()
+                if self._children:
+                    self._children[-1] += dt
+        wrapped._profiled = True
+        return wrapped
+
+
+def profile_env(env_id, control_mode, reward_mode, num_steps, seed, env_kwargs):
+    env = gym.make(env_id, reward_mode=reward_mode, control_mode=control_mode, **env_kwargs)
+    env.action_space.seed(seed)
+    profiler = CallProfiler()
+    step_times = np.zeros(num_steps)
+    reset_time, n_resets = 0.0, 0
+
+    def reset(seed=None):
+        nonlocal reset_time, n_resets
+        start = time.perf_counter()
+        env.reset(seed=seed)
+        reset_time += time.perf_counter() - start
+        n_resets += 1
+        # the agent can be rebuilt when the scene is reconfigured, so patch again after every reset
+        profiler.patch(env.unwrapped, ENV_METHODS)
+        if hasattr(env.unwrapped, 'agent'):
+            profiler.patch(env.unwrapped.agent, AGENT_METHODS, prefix='agent.')
+
+    reset(seed=seed)
+    profiler.active = True
+    for t in range(num_steps):
+        action = env.action_space.sample()
+        start = time.perf_counter()
+        _, _, terminated, truncated, _ = env.step(action)
+        step_times[t] = time.perf_counter() - start
+        if terminated or truncated:
+            profiler.active = False
+            reset()
+            profiler.active = True
+    env.close()
+
+    return dict(
+        env_id=env_id,
+        control_mode=control_mode,
+        reward_mode=reward_mode,
+        num_steps=num_steps,
+        step_ms=dict(
+            mean=step_times.mean() * 1000,
+            p50=np.percentile(step_times, 50) * 1000,
+            p90=np.percentile(step_times, 90) * 1000,
+        ),
+        reset_ms=reset_time / n_resets * 1000,
+        methods={
+            name: dict(
+                calls_per_step=s['calls'] / num_steps,
+                ms_per_step=s['total'] / num_steps * 1000,
+                self_ms_per_step=s['self'] / num_steps * 1000,
+            ) for name, s in sorted(profiler.stats.items())
+        },
+    )
+
+
+def get_versions():
+    versions = dict(python=platform.python_version(), numpy=np.__version__, gymnasium=gym.__version__)
+    for name in ('mani_skill2', 'sapien'):
+        try:
+            versions[name] = __import__(name).__version__
+        except (ImportError, AttributeError):
+            pass
+    return versions
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    runs = []
+    for env_id, control_mode in zip(args.env_ids, args.control_modes):
+        for reward_mode in args.reward_modes:
+            run = profile_env(env_id, control_mode, reward_mode, args.num_steps, args.seed, args.env_kwargs)
+            runs.append(run)
+            print(f"{env_id} ({reward_mode}): step={run['step_ms']['mean']:.3f}ms  reset={run['reset_ms']:.1f}ms")
+            for name, m in run['methods'].items():
+                print(f"    {name:<28s} {m['ms_per_step']:8.3f}ms/step  self={m['self_ms_per_step']:8.3f}ms/step  calls/step={m['calls_per_step']:.2f}")
+
+    # what a semi_sparse step costs on top of a sparse one
+    overhead = {}
+    by_key = {(r['env_id'], r['reward_mode']): r for r in runs}
+    for env_id in args.env_ids:
+        if (env_id, 'semi_sparse') in by_key and (env_id, 'sparse') in by_key:
+            semi_sparse, sparse = by_key[(env_id, 'semi_sparse')], by_key[(env_id, 'sparse')]
+            overhead[env_id] = dict(
+                step_ms=semi_sparse['step_ms']['mean'] - sparse['step_ms']['mean'],
+                relative=semi_sparse['step_ms']['mean'] / sparse['step_ms']['mean'] - 1,
+            )
+            print(f"{env_id}: semi_sparse costs {overhead[env_id]['step_ms']:+.3f}ms/step ({overhead[env_id]['relative']:+.1%}) over sparse")
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(
+            meta=dict(
+                time=datetime.datetime.now().isoformat(timespec='seconds'),
+                machine=platform.machine(), processor=platform.processor(),
+                versions=get_versions(), args=vars(args),
+            ),
+            runs=runs,
+            semi_sparse_overhead=overhead,
+        ), f, indent=4)
+    print(f'Results written to {args.output}')
@@ -0,0 +1,226 @@
+import argparse
+import copy
+import glob
+import os
+import warnings
+from types import SimpleNamespace
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import gymnasium as gym
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Int8 versions of the frozen inference networks, the Actor and the Discriminator, for offline
+# evaluation on cpu-only machines:
+# - 'dynamic': int8 weights, activations quantized on the fly per batch, no calibration needed.
+# - 'static': int8 weights and activations, with activation ranges calibrated on stored observations
+#   (demos, saved stage buffers or a .npy array). Linear+ReLU pairs are fused.
+# The methods of the quantized copies are the ones of the float networks (get_eval_action, get_reward).
+# Int8 pays off with large batches of the 256-unit Actor (many eval envs), for a handful of rows the
+# quantize / dequantize steps cost more than the float32 matmuls. The 32-unit networks of the
+# Discriminator are too small to get faster at any batch size (about 2x slower), so its int8 copy is
+# only meant for measuring the reward error, not as a speed option.
+# Usage:
+#   python -m drs.quantization --ckpt reward_checkpoints/TurnFaucet.pt --mode static \
+#       --calib-data output/.../checkpoints/stage_buffers --output reward_checkpoints/TurnFaucet_int8.pt
+#   python -m drs.evaluate_checkpoints ... --int8 static --int8-calib output/.../checkpoints/stage_buffers
+# The export holds the quantized state_dicts and the error bounds against float32 measured on
+# held-out calibration rows.
+
+MODES = ('dynamic', 'static')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True,
+        help="a checkpoint with an `actor` and/or a `discriminator` entry")
+    parser.add_argument("--mode", type=str, choices=MODES, default='dynamic')
+    parser.add_argument("--calib-data", type=str, default=None,
+        help="observations to calibrate (static) and measure the errors on: a demo .pkl, a stage_buffers directory or a .npy array")
+    parser.add_argument("--calib-rows", type=int, default=2048,
+        help="the number of observations the activation ranges are calibrated on, the others are held out for the error report")
+    parser.add_argument("--max-rows", type=int, default=20000,
+        help="the maximum number of observations loaded from --calib-data")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None,
+        help="the path of the int8 export, defaults to `<ckpt>_int8.pt`")
+    args = parser.parse_args()
+    assert args.mode == 'dynamic' or args.calib_data, "static quantization needs --calib-data"
+    if args.output is None:
+        args.output = os.path.splitext(args.ckpt)[0] + '_int8.pt'
+    return args
+
+
+def load_calibration_obs(path, max_rows=None, seed=0):
+    # next observations of demos (.pkl), of the stage buffers saved by drs_learn_reward (a directory
+    # with stage_*.json), or a (n, obs_dim) .npy array, as shuffled float32 rows
+    if os.path.isdir(path):
+        from drs.data_utils import load_rows
+        paths = sorted(glob.glob(os.path.join(path, 'stage_*.json')))
+        assert len(paths) > 0, f"no stage buffers found in {path}"
+        obs = np.concatenate([load_rows(p[:-len('.json')]) for p in paths])
+    elif path.endswith('.pkl'):
+        from drs.data_utils import load_demo_dataset
+        obs = load_demo_dataset(path, keys=['next_observations'])['next_observations']
+    else:
+        obs = np.load(path, mmap_mode='r')
+    rng = np.random.default_rng(seed)
+    obs = np.asarray(obs[np.sort(rng.permutation(len(obs))[:max_rows])], dtype=np.float32) # sorted reads of memmaps
+    rng.shuffle(obs)
+    return torch.from_numpy(obs.reshape(len(obs), -1))
+
+
+def _static_qconfig():
+    from torch.ao.quantization import get_default_qconfig
+    return get_default_qconfig(torch.backends.quantized.engine)
+
+
+def _fuse_linear_relu(seq):
+    from torch.ao.quantization import fuse_modules
+    pairs = [[str(i), str(i + 1)] for i in range(len(seq) - 1)
+             if isinstance(seq[i], nn.Linear) and isinstance(seq[i + 1], nn.ReLU)]
+    return fuse_modules(seq, pairs) if pairs else seq
+
+
+def _quantize(model, mode, wrap, calibrate):
+    # model: a float copy. wrap: the names of its submodules that get quant / dequant stubs (static).
+    # calibrate(model) runs the calibration observations through them.
+    from torch.ao.quantization import QuantWrapper, convert, prepare, quantize_dynamic
+    assert mode in MODES, mode
+    model.eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # deprecation notices of torch.ao.quantization, kept for its cpu int8 kernels
+        if mode == 'dynamic':
+            return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        for name in wrap:
+            parent, _, attr = name.rpartition('.')
+            parent = model.get_submodule(parent)
+            m = getattr(parent, attr)
+            m = QuantWrapper(_fuse_linear_relu(m) if isinstance(m, nn.Sequential) else m)
+            m.qconfig = _static_qconfig()
+            setattr(parent, attr, m)
+        prepare(model, inplace=True)
+        with torch.no_grad():
+            calibrate(model)
+        return convert(model, inplace=True)
+
+
+def quantize_actor(actor, mode='dynamic', calib_obs=None):
+    # an int8 copy of the Actor of the scripts, without calib_obs only its structure is meaningful
+    model = copy.deepcopy(actor).cpu()
+    if calib_obs is None:
+        calib_obs = torch.zeros(1, model.backbone[0].in_features)
+    return _quantize(model, mode, ['backbone', 'fc_mean', 'fc_logstd'], lambda m: m(calib_obs))
+
+
+def quantize_discriminator(disc, mode='dynamic', calib_obs=None):
+    # an int8 copy of the Discriminator, all stages are calibrated on the same observations
+    model = copy.deepcopy(disc).cpu()
+    if calib_obs is None:
+        calib_obs = torch.zeros(1, model.nets[0][0].in_features)
+    def calibrate(m):
+        for net in m.nets:
+            net(calib_obs)
+    return _quantize(model, mode, [f'nets.{i}' for i in range(len(model.nets))], calibrate)
+
+
+def action_error(actor, qactor, obs, batch_size=4096):
+    # the abs error of get_eval_action against float32, max and mean over rows and action dims
+    with torch.inference_mode():
+        err = torch.cat([
+            (qactor.get_eval_action(x) - actor.get_eval_action(x)).abs()
+            for x in obs.split(batch_size)
+        ])
+    return dict(action_err_max=err.max().item(), action_err_mean=err.mean().item())
+
+
+def reward_error(disc, qdisc, obs, batch_size=4096):
+    # the abs error of get_reward against float32, with every row evaluated at every stage
+    errs = []
+    with torch.inference_mode():
+        for x in obs.split(batch_size):
+            zeros = torch.zeros(len(x), 1)
+            for i in range(disc.n_stages):
+                stage_idx = torch.full((len(x), 1), i)
+                errs.append((qdisc.get_reward(x, stage_idx, zeros) - disc.get_reward(x, stage_idx, zeros)).abs())
+    err = torch.cat(errs)
+    return dict(reward_err_max=err.max().item(), reward_err_mean=err.mean().item())
+
+
+def _spaces(obs_dim, act_dim=None):
+    box = lambda n: gym.spaces.Box(-1, 1, (n,), dtype=np.float32)
+    return SimpleNamespace(single_observation_space=box(obs_dim), single_action_space=box(act_dim or 1))
+
+
+def load_float_networks(ckpt):
+    # the Actor and Discriminator (or None) of a checkpoint, with shapes read from their state_dicts
+    from drs.drs_learn_reward_maniskill2 import Discriminator
+    from drs.drs_reuse_reward_maniskill2 import Actor
+    actor = disc = None
+    if 'actor' in ckpt:
+        state_dict = ckpt['actor']
+        actor = Actor(_spaces(state_dict['backbone.0.weight'].shape[1], state_dict['fc_mean.weight'].shape[0]))
+        actor.load_state_dict(state_dict)
+        actor.eval()
+    if 'discriminator' in ckpt:
+        state_dict = ckpt['discriminator']
+        n_stages = len({k.split('.')[1] for k in state_dict if k.startswith('nets.')})
+        disc = Discriminator(_spaces(state_dict['nets.0.0.weight'].shape[1]), n_stages)
+        disc.load_state_dict(state_dict)
+        for i in range(n_stages):
+            disc.set_trained(i)
+        disc.eval()
+    return actor, disc
+
+
+def load_int8(path, actor=None, disc=None):
+    # the int8 copies of actor and disc (float networks of the right shapes, e.g. built by the
+    # scripts), with the quantized weights of an export. Returns them and the export's error bounds.
+    export = torch.load(path, map_location='cpu', weights_only=False)
+    qactor = qdisc = None
+    if actor is not None:
+        assert 'actor' in export, f"{path} has no actor"
+        qactor = quantize_actor(actor, export['mode'])
+        qactor.load_state_dict(export['actor'])
+    if disc is not None:
+        assert 'discriminator' in export, f"{path} has no discriminator"
+        warnings.warn("the int8 Discriminator is slower than the float32 one, use it to check the reward error only")
+        qdisc = quantize_discriminator(disc, export['mode'])
+        qdisc.load_state_dict(export['discriminator'])
+    return qactor, qdisc, export['errors']
+
+
+def format_errors(errors):
+    return '  '.join(f'{k}={v:.2e}' for k, v in errors.items())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.set_num_threads(1)
+    actor, disc = load_float_networks(torch.load(args.ckpt, map_location='cpu', weights_only=False))
+    assert actor is not None or disc is not None, f"{args.ckpt} has neither an actor nor a discriminator"
+
+    calib_obs = eval_obs = None
+    if args.calib_data:
+        obs = load_calibration_obs(args.calib_data, args.max_rows, args.seed)
+        # with few rows, the errors are measured on the calibration rows
+        calib_obs, eval_obs = obs[:args.calib_rows], obs[args.calib_rows:] if len(obs) > args.calib_rows else obs
+        print(f'Loaded {len(obs)} observations from {args.calib_data}: {len(calib_obs)} for calibration, {len(eval_obs)} for the errors')
+
+    export = dict(mode=args.mode, errors={})
+    if actor is not None:
+        qactor = quantize_actor(actor, args.mode, calib_obs)
+        export['actor'] = qactor.state_dict()
+        if eval_obs is not None:
+            export['errors'].update(action_error(actor, qactor, eval_obs))
+    if disc is not None:
+        qdisc = quantize_discriminator(disc, args.mode, calib_obs)
+        export['discriminator'] = qdisc.state_dict()
+        if eval_obs is not None:
+            export['errors'].update(reward_error(disc, qdisc, eval_obs))
+    torch.save(export, args.output)
+    print(f'{args.mode} int8 export written to {args.output}')
+    if export['errors']:
+        print('Errors against float32:', format_errors(export['errors']))
@@ -0,0 +1,169 @@
+import argparse
+import glob
+import os
+import time
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import multiprocessing as mp
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+# Relabels stored transitions with the learned reward of a reward checkpoint, i.e. the reward the
+# reuse phase would give them, streamed in large chunks through Discriminator.get_reward on a pool
+# of worker processes. Sources:
+# - demo pickles (.pkl, see load_demo_dataset): the stage index of a transition is the sum of the
+#   stage indicators (the last n_stages - 1 entries of the next observation) plus its info's success
+# - trajectory shards of drs.traj_logger (traj_*.npz files, or a directory of them): their stage_indices
+# - columnar datasets: a directory with next_observations.npy (n, obs_dim) and stage_indices.npy (n,)
+# The rewards are written next to each source as a float32 column `<column>.npy`, aligned with its
+# transitions (for pickles in the order of load_demo_dataset): `demos.pkl` -> `demos.<column>.npy`,
+# `traj_000000.npz` -> `traj_000000.<column>.npy`, `dataset/` -> `dataset/<column>.npy`.
+# Usage:
+#   python -m drs.relabel_rewards --ckpt reward_checkpoints/TurnFaucet.pt \
+#       --sources demo_data/TurnFaucet_100.pkl output/.../trajectories --num-workers 16
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True,
+        help="the reward checkpoint (with a `discriminator` entry) whose rewards are computed")
+    parser.add_argument("--sources", type=str, nargs='+', required=True,
+        help="demo .pkl files, traj_*.npz shards or directories of them, and columnar dataset directories")
+    parser.add_argument("--column", type=str, default=None,
+        help="the name of the reward column, defaults to `reward_<checkpoint file name>`")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000,
+        help="the number of rows of a columnar dataset handed to a worker at once")
+    parser.add_argument("--batch-size", type=int, default=65536,
+        help="the number of rows per get_reward call")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action='store_true',
+        help="recompute the reward columns that already exist, instead of skipping their sources")
+    args = parser.parse_args()
+    if args.column is None:
+        from drs.reward_server import checkpoint_name
+        args.column = f'reward_{checkpoint_name(args.ckpt)}'
+    return args
+
+
+def stage_indices_from_obs(next_obs, success, n_stages):
+    # the semi_sparse reward: the stage indicators are the last entries of the observation
+    stage_indices = np.asarray(success, dtype=np.float32).reshape(-1)
+    if n_stages > 1:
+        stage_indices = stage_indices + next_obs[:, -(n_stages - 1):].sum(1)
+    return np.rint(stage_indices).astype(np.int64)
+
+
+def find_sources(paths):
+    # (kind, path) of every source, kind is 'pickle', 'shard' or 'columns'
+    sources = []
+    for path in paths:
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, 'next_observations.npy')):
+            sources.append(('columns', path))
+        elif os.path.isdir(path):
+            shards = sorted(glob.glob(os.path.join(path, 'traj_*.npz')))
+            assert len(shards) > 0, f"{path} has neither traj_*.npz shards nor next_observations.npy"
+            sources.extend(('shard', p) for p in shards)
+        elif path.endswith('.pkl'):
+            sources.append(('pickle', path))
+        elif path.endswith('.npz'):
+            sources.append(('shard', path))
+        else:
+            raise ValueError(f"unknown source {path}")
+    return sources
+
+
+def output_path(kind, path, column):
+    if kind == 'columns':
+        return os.path.join(path, f'{column}.npy')
+    return f'{os.path.splitext(path)[0]}.{column}.npy'
+
+
+# Worker state: the discriminator, loaded once per worker
+_worker = {}
+
+def _init_worker(ckpt_path, batch_size):
+    from drs.reward_server import load_discriminator
+    torch.set_num_threads(1)
+    _worker.update(disc=load_discriminator(ckpt_path), batch_size=batch_size)
+
+def relabel(disc, next_obs, stage_indices, batch_size=65536):
+    # get_reward of all rows, in batches. The success flag is only checked by get_reward with one stage.
+    rewards = np.empty(len(next_obs), dtype=np.float32)
+    with torch.inference_mode():
+        for i in range(0, len(next_obs), batch_size):
+            x = torch.from_numpy(np.array(next_obs[i:i + batch_size], dtype=np.float32)) # a copy, memmaps are read-only
+            stage_idx = torch.from_numpy(np.array(stage_indices[i:i + batch_size], dtype=np.int64).reshape(-1, 1))
+            rewards[i:i + batch_size] = disc.get_reward(x.reshape(len(x), -1), stage_idx, stage_idx == disc.n_stages).numpy()
+    return rewards
+
+def _save(path, rewards):
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, rewards)
+    os.replace(path + '.tmp', path) # a column is either complete or absent
+
+def _run_job(job):
+    kind, path, out_path, start, end = job
+    disc, batch_size = _worker['disc'], _worker['batch_size']
+    if kind == 'columns':
+        next_obs = np.load(os.path.join(path, 'next_observations.npy'), mmap_mode='r')
+        stage_indices = np.load(os.path.join(path, 'stage_indices.npy'), mmap_mode='r')
+        out = open_memmap(out_path, mode='r+')
+        out[start:end] = relabel(disc, next_obs[start:end], stage_indices[start:end], batch_size)
+        out.flush()
+        del out
+        return path, end - start
+    if kind == 'shard':
+        with np.load(path) as shard:
+            next_obs, stage_indices = shard['next_observations'], shard['stage_indices']
+    else:
+        from drs.data_utils import load_raw_trajectories
+        trajectories = load_raw_trajectories(path)
+        next_obs = np.concatenate([t['observations'][1:] for t in trajectories])
+        success = np.concatenate([[info['success'] for info in t['infos']] for t in trajectories])
+        stage_indices = stage_indices_from_obs(next_obs, success, disc.n_stages)
+    _save(out_path, relabel(disc, next_obs, stage_indices, batch_size))
+    return path, len(next_obs)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    jobs = []
+    n_skipped = 0
+    for kind, path in find_sources(args.sources):
+        out_path = output_path(kind, path, args.column)
+        if os.path.exists(out_path) and not args.overwrite:
+            n_skipped += 1
+            continue
+        if kind == 'columns':
+            n_rows = len(np.load(os.path.join(path, 'next_observations.npy'), mmap_mode='r'))
+            assert len(np.load(os.path.join(path, 'stage_indices.npy'), mmap_mode='r')) == n_rows, \
+                f"{path}: next_observations.npy and stage_indices.npy have different lengths"
+            # created here, the workers fill in their chunks
+            open_memmap(out_path + '.tmp', mode='w+', dtype=np.float32, shape=(n_rows,)).flush()
+            jobs.extend(
+                (kind, path, out_path + '.tmp', i, min(i + args.chunk_size, n_rows))
+                for i in range(0, n_rows, args.chunk_size)
+            )
+        else:
+            jobs.append((kind, path, out_path, None, None))
+    if n_skipped > 0:
+        print(f'Skipped {n_skipped} sources with an existing {args.column} column (see --overwrite)')
+    print(f'Relabelling with {args.ckpt}: {len(jobs)} jobs on {args.num_workers} workers')
+
+    start_time = time.time()
+    n_rows = 0
+    ctx = mp.get_context('forkserver')
+    with ctx.Pool(args.num_workers, initializer=_init_worker, initargs=(args.ckpt, args.batch_size)) as pool:
+        for n_done, (path, n) in enumerate(pool.imap_unordered(_run_job, jobs), 1):
+            n_rows += n
+            if n_done % 100 == 0:
+                print(f'{n_done}/{len(jobs)} jobs done, {n_rows} rows, {time.time() - start_time:.0f}s')
+    for kind, path, out_path, start, _ in jobs:
+        if kind == 'columns' and start == 0:
+            os.replace(out_path, out_path[:-len('.tmp')])
+    elapsed = time.time() - start_time
+    print(f'Relabelled {n_rows} transitions into `{args.column}` columns in {elapsed:.0f}s ({n_rows / max(elapsed, 1e-6):.0f} rows/s)')
@@ -0,0 +1,514 @@
+import argparse
+import atexit
+import functools
+import json
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import numpy as np
+
+# Collection on other hosts: collector processes run the envs (drs.envs_with_stage_indicators, or
+# DrS_Synthetic-v0) and a copy of the Actor, and stream their transitions and finished trajectories
+# to the learner over TCP, where a CollectorPool hands them to the training loop.
+# Usage:
+#   python drs/drs_learn_reward_maniskill2.py ... --collector-port 5555     # on the learner host
+#   python -m drs.remote_collect --learner <learner host>:5555 --num-envs 16  # on each collector host
+# or, with the collectors as local processes on loopback: drs_learn_reward_maniskill2.py ... --local-collectors 4
+#
+# Protocol: every message is a frame, a little-endian uint32 length and a type byte followed by the
+# payload. A collector sends HELLO (json: its number of envs and, when reconnecting, its collector
+# id) and receives CONFIG (json: the env and its seed). Then the learner sends WEIGHTS whenever the
+# actor changed (only the latest version is sent, a slow collector skips versions) and the collector
+# sends BATCH every `--batch-steps` env steps. WEIGHTS and BATCH are arrays packed by pack_arrays.
+# A collector only sends a BATCH for which it holds a CREDIT: it starts with `credits` of them and
+# the learner returns one for every BATCH it consumes. This bounds the transitions in flight, and
+# thus how old the policy that collected them is, instead of letting collectors run ahead into
+# queues and socket buffers. The learner sends CLOSE when training is over.
+# A collector that disconnects (or is killed) is dropped, its unsent transitions are lost and the
+# others go on. Collectors reconnect with backoff, keeping their envs and unfinished episodes. The
+# learner only fails when no transitions arrived for `timeout` seconds.
+# Until the first WEIGHTS arrive, collectors sample random actions, like the learner before
+# learning_starts.
+
+_HEADER = struct.Struct('<IB')
+_LEN = struct.Struct('<I')
+HELLO, CONFIG, WEIGHTS, BATCH, CREDIT, CLOSE = range(6)
+
+# rows of a BATCH, the replay buffer transitions. rewards are the stage indices (semi_sparse) and
+# dones the terminations, as stored by the learner.
+ROW_KEYS = ('observations', 'next_observations', 'actions', 'rewards', 'dones', 'versions')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--learner", type=str, required=True,
+        help="the host:port the learner listens on (its --collector-port)")
+    parser.add_argument("--num-envs", type=int, default=1)
+    parser.add_argument("--sync-venv", action='store_true',
+        help="step the envs in this process instead of env worker processes")
+    parser.add_argument("--batch-steps", type=int, default=16,
+        help="the number of env steps (of all envs) per BATCH message")
+    parser.add_argument("--compress-level", type=int, default=1)
+    parser.add_argument("--max-reconnect-time", type=float, default=300,
+        help="seconds of failed reconnection attempts after which the collector exits")
+    return parser.parse_args()
+
+
+def pack_arrays(arrays, level=1):
+    # a json header of names, dtypes and shapes, then the zlib-compressed bytes of all arrays. The
+    # bytes are shuffled (the k-th bytes of all elements together), float32 observations and weights
+    # compress better this way, their exponent bytes vary little.
+    header, chunks = [], []
+    for k, a in arrays.items():
+        a = np.asarray(a)
+        header.append((k, a.dtype.str, a.shape))
+        chunks.append(np.ascontiguousarray(a).reshape(-1).view(np.uint8).reshape(-1, a.dtype.itemsize).T.tobytes())
+    header = json.dumps(header).encode()
+    return _LEN.pack(len(header)) + header + zlib.compress(b''.join(chunks), level)
+
+
+def unpack_arrays(payload):
+    n, = _LEN.unpack_from(payload)
+    header = json.loads(bytes(payload[_LEN.size:_LEN.size + n]))
+    data = zlib.decompress(payload[_LEN.size + n:])
+    arrays, offset = {}, 0
+    for k, dtype, shape in header:
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        shuffled = np.frombuffer(data, np.uint8, size, offset).reshape(dtype.itemsize, -1)
+        arrays[k] = shuffled.T.copy().view(dtype).reshape(shape)
+        offset += size
+    return arrays
+
+
+class _Channel(object):
+    # frames over a blocking TCP socket, sends from several threads are serialized
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._lock = threading.Lock()
+
+    def send(self, kind, payload=b''):
+        with self._lock:
+            self.sock.sendall(_HEADER.pack(len(payload), kind) + payload)
+
+    def _recv_exactly(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while n > 0:
+            k = self.sock.recv_into(view, n)
+            if k == 0:
+                raise ConnectionError('the connection was closed')
+            view, n = view[k:], n - k
+        return buf
+
+    def recv(self):
+        n, kind = _HEADER.unpack(self._recv_exactly(_HEADER.size))
+        return kind, self._recv_exactly(n)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def actor_weights(actor, version, level=1):
+    state = {k: v.detach().cpu().numpy() for k, v in actor.state_dict().items()}
+    state['version'] = np.array(version, dtype=np.int64)
+    return pack_arrays(state, level)
+
+
+#############################################
+# Learner side
+#############################################
+
+class _Connection(object):
+    # a connected collector: the WEIGHTS sender thread only ever sends the latest weights
+    def __init__(self, channel, collector_id, num_envs, address):
+        self.channel = channel
+        self.id = collector_id
+        self.num_envs = num_envs
+        self.address = address
+        self.alive = True
+        self._weights = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._send_weights, daemon=True)
+        self._thread.start()
+
+    def set_weights(self, payload):
+        with self._cond:
+            self._weights = payload
+            self._cond.notify()
+
+    def _send_weights(self):
+        while True:
+            with self._cond:
+                while self._weights is None and self.alive:
+                    self._cond.wait()
+                if not self.alive:
+                    return
+                payload, self._weights = self._weights, None
+            try:
+                self.channel.send(WEIGHTS, payload)
+            except OSError:
+                return # the reader notices the lost connection
+
+    def grant(self):
+        try:
+            self.channel.send(CREDIT)
+        except OSError:
+            pass # the reader notices the lost connection
+
+    def close(self, notify=False):
+        with self._cond:
+            self.alive = False
+            self._cond.notify()
+        if not notify:
+            self.channel.close()
+            return
+        # the collector closes its side once it read CLOSE, the reader thread then closes this one
+        try:
+            self.channel.send(CLOSE)
+            self.channel.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class CollectorPool(object):
+    # Accepts collectors on a TCP port and gathers their transitions. `take(n)` returns exactly n
+    # transitions (rows of ROW_KEYS), together with the finished trajectories and episodes of the
+    # messages they came from. Each collector has at most `credits` messages in flight.
+    # config: env_id, control_mode, env_kwargs, seed and rollout_backend of the collectors.
+    def __init__(self, config, host='0.0.0.0', port=0, credits=2, timeout=600, compress_level=1):
+        self.config = config
+        self.timeout = timeout
+        self.compress_level = compress_level
+        self._server = socket.create_server((host, port), reuse_port=False)
+        self.port = self._server.getsockname()[1]
+        self.credits = credits
+        self._queue = queue.Queue() # (connection, batch), bounded by the credits
+        self._lock = threading.Lock()
+        self._conns = {}
+        self._next_id = 0
+        self._weights = None
+        self._closed = False
+        self._rows = None # leftover rows of the last take
+        self._local = [] # (popen, num_envs) of the local collectors
+        self.n_lost = 0
+        self.n_respawned = 0
+        self._accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._accept_thread.start()
+        atexit.register(self.close)
+        print(f'CollectorPool: listening on port {self.port}')
+
+    @property
+    def num_collectors(self):
+        with self._lock:
+            return len(self._conns)
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                sock, address = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+    def _serve(self, sock, address):
+        channel = _Channel(sock)
+        conn = None
+        try:
+            kind, payload = channel.recv()
+            assert kind == HELLO, f"expected HELLO, got message type {kind}"
+            hello = json.loads(bytes(payload))
+            with self._lock:
+                collector_id = hello.get('collector_id')
+                if collector_id is None:
+                    collector_id = self._next_id
+                    self._next_id += 1
+            # env seeds apart from the ones of the learner's eval envs (seed + 1000 + i)
+            config = dict(self.config, collector_id=collector_id, seed=self.config['seed'] + 10000 + 1000 * collector_id,
+                          credits=self.credits)
+            channel.send(CONFIG, json.dumps(config).encode())
+            conn = _Connection(channel, collector_id, hello['num_envs'], address)
+            with self._lock:
+                if self._closed:
+                    conn.close(notify=True)
+                    return
+                self._conns[collector_id] = conn
+                if self._weights is not None:
+                    conn.set_weights(self._weights)
+            print(f'CollectorPool: collector {collector_id} connected from {address[0]} with {conn.num_envs} envs')
+            while True:
+                kind, payload = channel.recv()
+                if kind != BATCH:
+                    continue
+                self._queue.put((conn, unpack_arrays(payload)))
+        except (OSError, ConnectionError, AssertionError, ValueError) as e:
+            if conn is not None and not self._closed:
+                print(f'CollectorPool: lost collector {conn.id} ({e})')
+                self.n_lost += 1
+        finally:
+            if conn is not None:
+                with self._lock:
+                    if self._conns.get(conn.id) is conn:
+                        del self._conns[conn.id]
+                conn.close()
+            else:
+                channel.close()
+
+    def broadcast(self, actor, version):
+        # the weights are packed once, and sent to each collector by its sender thread
+        payload = actor_weights(actor, version, self.compress_level)
+        with self._lock:
+            self._weights = payload
+            for conn in self._conns.values():
+                conn.set_weights(payload)
+
+    def spawn_local(self, n, num_envs):
+        # collector processes on this host, connected over loopback. Dead ones are restarted by take().
+        for _ in range(n):
+            self._local.append([self._spawn(num_envs), num_envs])
+
+    def _spawn(self, num_envs):
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        return subprocess.Popen([
+            sys.executable, '-m', 'drs.remote_collect', '--learner', f'127.0.0.1:{self.port}',
+            '--num-envs', str(num_envs), '--compress-level', str(self.compress_level),
+        ], env=env)
+
+    def _respawn_local(self):
+        for entry in self._local:
+            p, num_envs = entry
+            if p.poll() is not None:
+                print(f'CollectorPool: local collector (pid {p.pid}) exited with {p.returncode}, restarting it')
+                entry[0] = self._spawn(num_envs)
+                self.n_respawned += 1
+
+    def take(self, n):
+        # exactly n rows, and the trajectories and episodes of the messages that were read for them
+        self._respawn_local()
+        batches = [] if self._rows is None else [self._rows]
+        n_rows = 0 if self._rows is None else len(self._rows['actions'])
+        last_arrival = time.time()
+        while n_rows < n:
+            try:
+                conn, batch = self._queue.get(timeout=1)
+            except queue.Empty:
+                self._respawn_local()
+                if time.time() - last_arrival > self.timeout:
+                    raise TimeoutError(f'no transitions from the collectors in {self.timeout}s ({self.num_collectors} connected)')
+                continue
+            last_arrival = time.time()
+            conn.grant()
+            batches.append(batch)
+            n_rows += len(batch['actions'])
+        rows = {k: np.concatenate([b[k] for b in batches]) for k in ROW_KEYS}
+        self._rows = {k: v[n:] for k, v in rows.items()} if n_rows > n else None
+        trajectories, episodes = [], []
+        for b in batches:
+            if 'traj_lengths' not in b:
+                continue # the leftover rows of the last take
+            ends = np.cumsum(b['traj_lengths'])
+            for end, l, success, ret in zip(ends, b['traj_lengths'], b['traj_success'], b['traj_returns']):
+                trajectories.append((b['traj_next_observations'][end - l:end], b['traj_stage_indices'][end - l:end], bool(success)))
+                episodes.append(dict(r=float(ret), l=int(l), success=bool(success)))
+        return {k: v[:n] for k, v in rows.items()}, trajectories, episodes
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._server.shutdown(socket.SHUT_RDWR) # wakes the accept thread
+        except OSError:
+            pass
+        self._server.close()
+        with self._lock:
+            conns = list(self._conns.values())
+        for conn in conns:
+            conn.close(notify=True)
+        for p, _ in self._local:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.terminate()
+                p.wait()
+
+
+#############################################
+# Collector side
+#############################################
+
+def _make_env(config, seed):
+    # importable, so that the env worker processes import the env registrations of the learn script
+    from drs.drs_learn_reward_maniskill2 import make_env
+    return make_env(config['env_id'], seed, config['control_mode'], **config['env_kwargs'])()
+
+
+class Collector(object):
+    # the envs of a collector and its current episodes, which outlive reconnections
+    def __init__(self, config, num_envs, sync_venv=False):
+        import gymnasium as gym
+        import torch
+        import drs.drs_learn_reward_maniskill2 as learn
+        from drs.rollout_inference import RolloutPolicy
+        env_fns = [functools.partial(_make_env, config, config['seed'] + i) for i in range(num_envs)]
+        self.envs = gym.vector.SyncVectorEnv(env_fns) if sync_venv or num_envs == 1 \
+            else gym.vector.AsyncVectorEnv(env_fns, context='forkserver')
+        self.envs.single_observation_space.dtype = np.float32
+        self.num_envs = num_envs
+        torch.set_num_threads(1)
+        self.actor = learn.Actor(self.envs)
+        backend = 'torch' if config['rollout_backend'] == 'actor' else config['rollout_backend']
+        self.policy = RolloutPolicy(self.actor, num_envs, torch.device('cpu'), (learn.LOG_STD_MIN, learn.LOG_STD_MAX),
+                                    backend=backend, seed=config['seed'])
+        self.version = -1 # random actions until the first weights
+        self.obs, _ = self.envs.reset(seed=config['seed'])
+        self._episodes = [([], []) for _ in range(num_envs)]
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._rows = {k: [] for k in ROW_KEYS}
+        self._trajs = []
+
+    def load_weights(self, payload):
+        import torch
+        state = unpack_arrays(payload)
+        version = int(state.pop('version'))
+        self.actor.load_state_dict({k: torch.from_numpy(v) for k, v in state.items()})
+        self.policy.sync()
+        self.version = version
+
+    def step(self):
+        from drs.rollout_inference import sample_actions
+        if self.version < 0:
+            actions = sample_actions(self.envs.single_action_space, self.num_envs)
+        else:
+            actions = self.policy(self.obs)
+        next_obs, rewards, terminations, truncations, infos = self.envs.step(actions)
+        real_next_obs = next_obs.copy()
+        for idx in np.where(truncations & ~terminations)[0]: # bootstrap at truncated
+            real_next_obs[idx] = infos["final_observation"][idx]
+        for k, v in zip(ROW_KEYS, (self.obs, real_next_obs, actions, rewards, terminations,
+                                   np.full(self.num_envs, self.version))):
+            self._rows[k].append(np.asarray(v))
+        for i in range(self.num_envs):
+            self._episodes[i][0].append(real_next_obs[i])
+            self._episodes[i][1].append(rewards[i])
+            if terminations[i] or truncations[i]:
+                info = infos["final_info"][i]
+                next_obs_i, stage_indices = self._episodes[i]
+                self._trajs.append((np.stack(next_obs_i), np.array(stage_indices), info['success'], info['episode']['r'][0]))
+                self._episodes[i] = ([], [])
+        self.obs = next_obs
+
+    def pack_batch(self, level=1):
+        arrays = {k: np.concatenate(v).astype(np.float32 if k != 'versions' else np.int64) for k, v in self._rows.items()}
+        obs_dim = arrays['observations'].shape[1:]
+        arrays.update(
+            traj_next_observations=np.concatenate([t[0] for t in self._trajs]).astype(np.float32) if self._trajs
+                else np.zeros((0,) + obs_dim, dtype=np.float32),
+            traj_stage_indices=np.concatenate([t[1] for t in self._trajs]).astype(np.int8) if self._trajs
+                else np.zeros(0, dtype=np.int8),
+            traj_lengths=np.array([len(t[0]) for t in self._trajs], dtype=np.int64),
+            traj_success=np.array([t[2] for t in self._trajs], dtype=bool),
+            traj_returns=np.array([t[3] for t in self._trajs], dtype=np.float32),
+        )
+        self._reset_batch()
+        return pack_arrays(arrays, level)
+
+    def close(self):
+        self.envs.close()
+
+
+def _read_messages(channel, latest, credits, stop):
+    # keeps only the latest WEIGHTS and counts the CREDITs. On CLOSE or a lost connection, stop[0] is
+    # set to the reason.
+    try:
+        while True:
+            kind, payload = channel.recv()
+            if kind == WEIGHTS:
+                latest[0] = payload
+            elif kind == CREDIT:
+                credits.release()
+            elif kind == CLOSE:
+                stop[0] = 'close'
+                return
+    except (OSError, ConnectionError) as e:
+        stop[0] = stop[0] or str(e)
+    finally:
+        credits.release() # wakes the collector if it waits for a credit
+
+
+def run_collector(address, num_envs=1, sync_venv=False, batch_steps=16, compress_level=1, max_reconnect_time=300):
+    host, port = address.rsplit(':', 1)
+    collector = None
+    collector_id = None
+    last_connected = time.time()
+    delay = 1
+    while True:
+        try:
+            sock = socket.create_connection((host, int(port)), timeout=30)
+            sock.settimeout(None)
+        except OSError as e:
+            if time.time() - last_connected > max_reconnect_time:
+                print(f'Collector {collector_id}: could not reach the learner at {address} for {max_reconnect_time:.0f}s ({e}), exiting')
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, 30)
+            continue
+        delay = 1
+        channel = _Channel(sock)
+        stop = [None]
+        try:
+            channel.send(HELLO, json.dumps(dict(num_envs=num_envs, collector_id=collector_id)).encode())
+            kind, payload = channel.recv()
+            assert kind == CONFIG, f"expected CONFIG, got message type {kind}"
+            config = json.loads(bytes(payload))
+            collector_id = config['collector_id']
+            if collector is None:
+                collector = Collector(config, num_envs, sync_venv)
+            print(f'Collector {collector_id}: connected to {address}')
+            latest = [None]
+            credits = threading.Semaphore(config['credits'])
+            threading.Thread(target=_read_messages, args=(channel, latest, credits, stop), daemon=True).start()
+            while stop[0] is None:
+                for _ in range(batch_steps):
+                    if latest[0] is not None:
+                        payload, latest[0] = latest[0], None
+                        collector.load_weights(payload)
+                    collector.step()
+                credits.acquire()
+                if stop[0] is None:
+                    channel.send(BATCH, collector.pack_batch(compress_level))
+        except (OSError, ConnectionError) as e:
+            stop[0] = stop[0] or str(e)
+        finally:
+            channel.close()
+        last_connected = time.time()
+        if stop[0] == 'close':
+            print(f'Collector {collector_id}: training is over, exiting')
+            break
+        print(f'Collector {collector_id}: lost the learner ({stop[0]}), reconnecting')
+    if collector is not None:
+        collector.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_collector(args.learner, args.num_envs, args.sync_venv, args.batch_steps, args.compress_level, args.max_reconnect_time)
@@ -0,0 +1,96 @@
+import math
+import time
+
+import torch
+
+
+class ReplayRatioController(object):
+    # Chooses the env steps and updates of each collect / train cycle of the training loops, instead
+    # of the fixed `--training-freq` steps and `training_freq * utd` updates. It measures the cost of
+    # an env step (per transition) and of an update online, and picks the replay ratio (updates per
+    # transition) that spends as long on updates as on collection, clipped to
+    # [target * (1 - tolerance), target * (1 + tolerance)]. Env-bound runs (slow envs) do more
+    # updates per transition, learner-bound runs fewer, without retuning per task and machine.
+    # With remote collectors, which step their envs while the learner updates, the collection time
+    # is the time the learner waits for transitions, and the ratio rises until it stops waiting.
+    # A cycle keeps about `training_freq * target` updates, so the number of env steps per cycle
+    # shrinks as the ratio grows. The fractional updates are carried over to the next cycle, the
+    # effective ratio since learning started is `ratio`.
+    #   steps, updates = controller.plan()
+    #   ... steps env steps ...
+    #   controller.collected()
+    #   ... updates updates ...
+    #   controller.trained()
+    def __init__(self, target, tolerance, num_envs, training_freq, smoothing=0.1, cuda_sync=False):
+        assert target > 0 and 0 <= tolerance < 1, "the tolerance is relative to the (positive) target ratio"
+        self.target = target
+        self.min_ratio = target * (1 - tolerance)
+        self.max_ratio = target * (1 + tolerance)
+        self.num_envs = num_envs
+        self.cycle_updates = max(1.0, training_freq * target)
+        self.smoothing = smoothing
+        self.cuda_sync = cuda_sync
+        self.env_cost = None # seconds per transition
+        self.update_cost = None # seconds per update
+        self.n_steps = 0 # since learning started
+        self.n_updates = 0
+        self._carry = 0.0
+        self._plan = None
+        self._start = self._collected = None
+
+    def _ema(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def balanced_ratio(self):
+        if self.env_cost is None or self.update_cost is None:
+            return self.target
+        return min(max(self.env_cost / self.update_cost, self.min_ratio), self.max_ratio)
+
+    def plan(self):
+        # (env steps, updates) of the next cycle, the env steps are a multiple of num_envs
+        ratio = self.balanced_ratio()
+        steps = self.num_envs * math.ceil(self.cycle_updates / ratio / self.num_envs)
+        updates = int(self._carry + ratio * steps)
+        self._plan = (steps, updates, ratio)
+        self._start = time.perf_counter()
+        return steps, updates
+
+    def collected(self):
+        self._collected = time.perf_counter()
+        self.env_cost = self._ema(self.env_cost, (self._collected - self._start) / self._plan[0])
+
+    def trained(self):
+        # only cycles that trained count towards the ratio
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        steps, updates, ratio = self._plan
+        if updates > 0:
+            self.update_cost = self._ema(self.update_cost, (time.perf_counter() - self._collected) / updates)
+        self._carry += ratio * steps - updates
+        self.n_steps += steps
+        self.n_updates += updates
+
+    def state_dict(self):
+        # what a resumed run needs to plan the same cycles
+        return dict(env_cost=self.env_cost, update_cost=self.update_cost, n_steps=self.n_steps,
+                    n_updates=self.n_updates, carry=self._carry)
+
+    def load_state_dict(self, state):
+        self.env_cost = state['env_cost']
+        self.update_cost = state['update_cost']
+        self.n_steps = state['n_steps']
+        self.n_updates = state['n_updates']
+        self._carry = state['carry']
+
+    @property
+    def ratio(self):
+        return self.n_updates / max(self.n_steps, 1)
+
+    def write(self, writer, global_step):
+        writer.add_scalar("charts/replay_ratio", self.ratio, global_step)
+        writer.add_scalar("charts/replay_ratio_planned", self.balanced_ratio(), global_step)
+        writer.add_scalar("charts/cycle_steps", self._plan[0], global_step)
+        if self.env_cost is not None:
+            writer.add_scalar("charts/env_step_cost_ms", self.env_cost * 1000, global_step)
+        if self.update_cost is not None:
+            writer.add_scalar("charts/update_cost_ms", self.update_cost * 1000, global_step)
@@ -0,0 +1,95 @@
+import json
+import multiprocessing as mp
+import os
+
+import torch
+
+# Assigns the learner (each of its ranks), the env workers and the eval workers to disjoint cpu sets,
+# with a thread budget for the learner. A plan is a json-serializable dict:
+#   cpus:            the cpus available to the run
+#   learner:         one cpu list per learner rank (see --ddp-workers), its length is the rank's thread budget
+#   envs:            one cpu list per training env worker
+#   eval:            the cpus shared by the eval env workers (or the async evaluator process)
+#   oversubscribed:  whether some of these sets had to share cpus
+# Env and eval workers keep a budget of one thread (OMP_NUM_THREADS=1 in the scripts).
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def make_resource_plan(num_envs, num_eval_envs=0, learner_ranks=1, learner_threads=None, cpus=None):
+    # one cpu per env worker, a few for evaluation (it runs periodically), and the remaining ones for the
+    # learner, split evenly between its ranks. With too few cpus, env and eval workers share theirs.
+    cpus = sorted(cpus) if cpus is not None else available_cpus()
+    n = len(cpus)
+    n_eval = min(num_eval_envs, max(1, n // 8)) if num_eval_envs > 0 else 0
+    if learner_threads is None:
+        learner_threads = max(1, (n - num_envs - n_eval) // learner_ranks)
+    n_learner = min(learner_ranks * learner_threads, max(n - 1, 1))
+    learner_cpus, rest = cpus[:n_learner], cpus[n_learner:]
+    eval_cpus, env_cpus = rest[:n_eval], rest[n_eval:]
+    if not env_cpus:
+        env_cpus = rest or cpus
+    if num_eval_envs > 0 and not eval_cpus:
+        eval_cpus = env_cpus
+    per_rank = max(1, len(learner_cpus) // learner_ranks)
+    plan = dict(
+        cpus=cpus,
+        learner=[
+            learner_cpus[r * per_rank:(r + 1) * per_rank] or [learner_cpus[r % len(learner_cpus)]]
+            for r in range(learner_ranks)
+        ],
+        envs=[[env_cpus[i % len(env_cpus)]] for i in range(num_envs)],
+        eval=eval_cpus,
+    )
+    plan['oversubscribed'] = is_oversubscribed(plan)
+    return plan
+
+
+def is_oversubscribed(plan):
+    assigned = [c for cs in plan['learner'] + plan['envs'] for c in cs] + list(plan['eval'])
+    return len(assigned) != len(set(assigned))
+
+
+def load_resource_plan(path, num_envs, learner_ranks=1):
+    # a plan written by a previous run (resource_plan.json), or by hand
+    with open(path, 'r') as f:
+        plan = json.load(f)
+    assert len(plan['envs']) == num_envs, f"the plan has {len(plan['envs'])} env workers, not {num_envs}"
+    assert len(plan['learner']) == learner_ranks, f"the plan has {len(plan['learner'])} learner ranks, not {learner_ranks}"
+    cpus = set(available_cpus())
+    for cs in plan['learner'] + plan['envs'] + [plan.get('eval', [])]:
+        assert set(cs) <= cpus, f"cpus {sorted(set(cs) - cpus)} of the plan are not available"
+    plan.setdefault('cpus', sorted(cpus))
+    plan.setdefault('eval', [])
+    plan['oversubscribed'] = is_oversubscribed(plan)
+    return plan
+
+
+def format_resource_plan(plan):
+    def fmt(cs):
+        return ','.join(map(str, cs)) if cs else '-'
+    learner = ' | '.join(fmt(cs) for cs in plan['learner'])
+    envs = ' '.join(fmt(cs) for cs in plan['envs'])
+    s = f"learner: {learner}  envs: {envs}  eval: {fmt(plan['eval'])}"
+    return s + '  (oversubscribed)' if plan['oversubscribed'] else s
+
+
+def pin_process(cpus, num_threads=None):
+    # pins the calling process to cpus, and gives torch one intra-op thread per cpu
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads or len(cpus))
+
+
+def pinned_env_fn(env_fn, cpus):
+    # pins the worker process that creates the env. SyncVectorEnv creates its envs in the training
+    # process, which must not be pinned to the cpus of an env, so it is only done in child processes.
+    def thunk():
+        if mp.parent_process() is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        return env_fn()
+    return thunk
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+# Serves frozen discriminators (reward checkpoints) to many reuse runs on one node over a unix socket.
+# Requests of all clients for the same checkpoint are coalesced into one batch, which is run as soon
+# as it has `--max-batch` rows, holds a request of every connected client, or its first request has
+# waited `--max-delay-ms`.
+# Usage:
+#   python -m drs.reward_server --socket /tmp/drs_reward.sock --ckpts reward_checkpoints/TurnFaucet.pt reward_checkpoints/PickAndPlace.pt
+#   python drs/drs_reuse_reward_maniskill2.py ... --disc-ckpt reward_checkpoints/TurnFaucet.pt --reward-server /tmp/drs_reward.sock
+#
+# Protocol: every message is a frame, a little-endian uint32 length followed by the payload. A client
+# first sends the name of a checkpoint (its file name without extension) and receives a json header
+# with its `n_stages` and `obs_dim` (or an `error`). Then each request is a float32 array of rows
+# [next_obs, stage_idx, success] and each reply the float32 array of their rewards.
+
+_HEADER = struct.Struct('<I')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, required=True,
+        help="the path of the unix socket to listen on")
+    parser.add_argument("--ckpts", type=str, nargs='+', required=True,
+        help="reward checkpoints to serve, clients select them by file name without extension")
+    parser.add_argument("--max-batch", type=int, default=4096,
+        help="the number of rows at which a batch is run without waiting for the deadline")
+    parser.add_argument("--max-delay-ms", type=float, default=2.0,
+        help="how long the first request of a batch waits for others to join it")
+    parser.add_argument("--threads", type=int, default=1,
+        help="the number of torch threads of the inference")
+    parser.add_argument("--stats-interval", type=float, default=60,
+        help="seconds between printing the number of requests and the mean batch size")
+    return parser.parse_args()
+
+
+def checkpoint_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def load_discriminator(path):
+    # the observation size and number of stages are read from the checkpoint
+    from drs.drs_learn_reward_maniskill2 import Discriminator
+    state_dict = torch.load(path, map_location='cpu')['discriminator']
+    n_stages = len({k.split('.')[1] for k in state_dict if k.startswith('nets.')})
+    obs_dim = state_dict['nets.0.0.weight'].shape[1]
+    envs = SimpleNamespace(single_observation_space=gym.spaces.Box(-np.inf, np.inf, (obs_dim,), dtype=np.float32))
+    disc = Discriminator(envs, n_stages)
+    disc.load_state_dict(state_dict)
+    for i in range(n_stages):
+        disc.set_trained(i)
+    disc.eval()
+    return disc
+
+
+async def _read_frame(reader):
+    n, = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return await reader.readexactly(n)
+
+
+def _frame(payload):
+    return _HEADER.pack(len(payload)) + payload
+
+
+class RewardServer(object):
+    def __init__(self, discs, max_batch=4096, max_delay=0.002):
+        self.discs = discs # name -> Discriminator
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_rows = 0
+        self._executor = ThreadPoolExecutor(max_workers=1) # inference does not block the socket I/O
+
+    async def serve(self, path, stats_interval=None):
+        self._queues = {name: asyncio.Queue() for name in self.discs}
+        self._n_clients = {name: 0 for name in self.discs}
+        batchers = [asyncio.create_task(self._batcher(name)) for name in self.discs]
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self._handle, path=path)
+        print(f'Serving {", ".join(self.discs)} on {path}')
+        if stats_interval:
+            batchers.append(asyncio.create_task(self._print_stats(stats_interval)))
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        name, registered = None, False
+        try:
+            name = (await _read_frame(reader)).decode()
+            if name not in self.discs:
+                writer.write(_frame(json.dumps(dict(error=f"unknown checkpoint {name}, serving {list(self.discs)}")).encode()))
+                await writer.drain()
+                return
+            disc = self.discs[name]
+            obs_dim = int(disc.nets[0][0].in_features)
+            writer.write(_frame(json.dumps(dict(n_stages=disc.n_stages, obs_dim=obs_dim)).encode()))
+            await writer.drain()
+            self._n_clients[name] += 1
+            registered = True
+            loop = asyncio.get_running_loop()
+            while True:
+                rows = np.frombuffer(await _read_frame(reader), dtype=np.float32).reshape(-1, obs_dim + 2)
+                future = loop.create_future()
+                await self._queues[name].put((rows, future))
+                rewards = await future
+                writer.write(_frame(rewards.tobytes()))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # the client disconnected
+        finally:
+            if registered:
+                self._n_clients[name] -= 1
+            writer.close()
+
+    async def _batcher(self, name):
+        disc, queue = self.discs[name], self._queues[name]
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await queue.get()]
+            n = len(items[0][0])
+            deadline = loop.time() + self.max_delay
+            # every client has at most one request in flight, so none can join once all of them are in
+            while n < self.max_batch and len(items) < self._n_clients[name]:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                n += len(item[0])
+            rows = np.concatenate([rows for rows, _ in items])
+            try:
+                rewards = await loop.run_in_executor(self._executor, self._infer, disc, rows)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            self.n_requests += len(items)
+            self.n_batches += 1
+            self.n_rows += n
+            offset = 0
+            for rows, future in items:
+                future.set_result(rewards[offset:offset + len(rows)])
+                offset += len(rows)
+
+    @staticmethod
+    def _infer(disc, rows):
+        x = torch.from_numpy(rows)
+        stage_idx = x[:, -2:-1].long()
+        return disc.get_reward(x[:, :-2], stage_idx, x[:, -1:]).numpy().astype(np.float32)
+
+    async def _print_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            if self.n_batches > 0:
+                print(f'{time.strftime("%H:%M:%S")} requests={self.n_requests} batches={self.n_batches} '
+                      f'mean_batch={self.n_rows / self.n_batches:.1f} rows')
+
+
+class RewardClient(object):
+    # Drop-in for `Discriminator.get_reward` of a frozen discriminator, computed by a RewardServer.
+    # Blocking, one request in flight per client. Picklable: copies connect on first use.
+    def __init__(self, socket_path, name, timeout=60):
+        self.socket_path = socket_path
+        self.name = name
+        self.timeout = timeout
+        self._sock = None
+        self._connect()
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.socket_path)
+        self._send(self.name.encode())
+        header = json.loads(self._recv())
+        if 'error' in header:
+            raise ValueError(header['error'])
+        self.n_stages = header['n_stages']
+        self.obs_dim = header['obs_dim']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_sock'] = None
+        return state
+
+    def _send(self, payload):
+        self._sock.sendall(_frame(payload))
+
+    def _recv_exactly(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while n > 0:
+            k = self._sock.recv_into(view, n)
+            if k == 0:
+                raise ConnectionError('the reward server closed the connection')
+            view, n = view[k:], n - k
+        return buf
+
+    def _recv(self):
+        n, = _HEADER.unpack(self._recv_exactly(_HEADER.size))
+        return self._recv_exactly(n)
+
+    @torch.compiler.disable
+    def get_reward(self, next_s, stage_idx, success):
+        if self._sock is None:
+            self._connect()
+        bs = next_s.shape[0]
+        rows = torch.cat([
+            next_s.reshape(bs, -1).float(),
+            stage_idx.reshape(bs, 1).float(),
+            torch.as_tensor(success, device=next_s.device).reshape(bs, 1).float(),
+        ], dim=1)
+        self._send(rows.cpu().numpy().tobytes())
+        reward = np.frombuffer(self._recv(), dtype=np.float32)
+        return torch.from_numpy(reward.copy()).to(next_s.device)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.set_num_threads(args.threads)
+    discs = {checkpoint_name(path): load_discriminator(path) for path in args.ckpts}
+    server = RewardServer(discs, max_batch=args.max_batch, max_delay=args.max_delay_ms / 1000)
+    try:
+        asyncio.run(server.serve(args.socket, stats_interval=args.stats_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
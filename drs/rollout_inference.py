@@ -0,0 +1,95 @@
+import gymnasium as gym
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def sample_actions(action_space, n):
+    # Same as np.array([action_space.sample() for _ in range(n)]), drawn at once. For a bounded Box,
+    # sample() only draws one uniform per dimension from action_space.np_random, so the random
+    # stream, and thus every action, is identical.
+    if isinstance(action_space, gym.spaces.Box) and action_space.is_bounded('both') and action_space.dtype.kind == 'f':
+        return action_space.np_random.uniform(
+            low=action_space.low, high=action_space.high, size=(n,) + action_space.shape,
+        ).astype(action_space.dtype)
+    return np.array([action_space.sample() for _ in range(n)])
+
+
+class RolloutPolicy(object):
+    # Samples actions for collection with the least per-step overhead, equivalent to
+    # `actor.get_action(torch.Tensor(obs).to(device))[0].cpu().numpy()`:
+    # - 'torch': inference mode, no distribution object or log-prob, the obs array is wrapped without
+    #   a copy on cpu (or copied through a preallocated pinned buffer to the gpu). Given the same torch
+    #   RNG state, it samples exactly the actions of get_action.
+    # - 'numpy': a frozen copy of the actor weights evaluated with numpy, with its own RNG. The copy is
+    #   refreshed with `sync()`, which the training loop calls after every round of updates.
+    def __init__(self, actor, num_envs, device, log_std_bounds, backend='torch', seed=None):
+        assert backend in ('torch', 'numpy'), backend
+        self.actor = actor
+        self.device = device
+        self.log_std_min, self.log_std_max = log_std_bounds
+        self.backend = backend
+        if backend == 'torch' and device.type == 'cuda':
+            obs_dim = actor.backbone[0].in_features
+            self._obs_host = torch.zeros((num_envs, obs_dim), dtype=torch.float32).pin_memory()
+            self._obs = torch.zeros((num_envs, obs_dim), dtype=torch.float32, device=device)
+        self._rng = np.random.default_rng(seed)
+        self._layers = None
+        self.sync()
+
+    def rng_state(self):
+        # the state of the numpy backend's RNG, part of the full training state
+        return self._rng.bit_generator.state
+
+    def set_rng_state(self, state):
+        self._rng.bit_generator.state = state
+
+    def sync(self):
+        if self.backend != 'numpy':
+            return
+        def to_numpy(m):
+            return m.weight.detach().cpu().numpy().T.copy(), m.bias.detach().cpu().numpy().copy()
+        self._layers = []
+        for m in self.actor.backbone:
+            if isinstance(m, nn.Linear):
+                self._layers.append(to_numpy(m))
+            elif isinstance(m, nn.ReLU):
+                self._layers.append(None)
+            else:
+                raise NotImplementedError(type(m))
+        self._fc_mean = to_numpy(self.actor.fc_mean)
+        self._fc_logstd = to_numpy(self.actor.fc_logstd)
+        self._action_scale = self.actor.action_scale.cpu().numpy()
+        self._action_bias = self.actor.action_bias.cpu().numpy()
+
+    def __call__(self, obs):
+        if self.backend == 'numpy':
+            return self._numpy_action(obs)
+        return self._torch_action(obs)
+
+    def _torch_action(self, obs):
+        with torch.inference_mode():
+            if self.device.type == 'cuda':
+                self._obs_host.numpy()[:] = obs
+                x = self._obs.copy_(self._obs_host, non_blocking=True)
+            elif obs.dtype == np.float32:
+                x = torch.from_numpy(obs)
+            else:
+                x = torch.from_numpy(obs.astype(np.float32))
+            mean, log_std = self.actor(x)
+            eps = torch.empty_like(mean).normal_() # as in Normal.rsample
+            action = torch.tanh(mean + log_std.exp() * eps) * self.actor.action_scale + self.actor.action_bias
+            return action.cpu().numpy()
+
+    def _numpy_action(self, obs):
+        x = obs.astype(np.float32, copy=False)
+        for layer in self._layers:
+            if layer is None:
+                np.maximum(x, 0, out=x)
+            else:
+                x = x @ layer[0] + layer[1]
+        mean = x @ self._fc_mean[0] + self._fc_mean[1]
+        log_std = np.tanh(x @ self._fc_logstd[0] + self._fc_logstd[1])
+        log_std = self.log_std_min + 0.5 * (self.log_std_max - self.log_std_min) * (log_std + 1)
+        eps = self._rng.standard_normal(mean.shape, dtype=np.float32)
+        return np.tanh(mean + np.exp(log_std) * eps) * self._action_scale + self._action_bias
@@ -0,0 +1,388 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from drs.resource_plan import available_cpus
+
+# Runs a sweep of training jobs (seeds, env ids, hyperparameters) on one node. Jobs are started as
+# soon as their declared cpu and memory costs fit next to the running ones, and each one is pinned
+# to its own cpus (its --pin-cpus plan is made within them). Failed jobs are restarted, from their
+# last full training state if they saved one (--state-save-freq). The sweep directory holds one
+# output directory per job and an index.json of all jobs with their status and log_path.
+# With --asha-min-step, runs that fall behind at the rungs of successive halving are stopped early
+# (see SuccessiveHalving), which frees their cpus for the queued jobs.
+# Usage:
+#   python -m drs.sweep --spec sweeps/reuse_seeds.json --sweep-dir output/sweeps/reuse_seeds
+#   python -m drs.sweep --sweep-dir output/sweeps/reuse_seeds --resume # after an interruption
+#
+# A spec is a json dict:
+#   script:  the training script of all jobs (configs can set their own)
+#   args:    the arguments shared by all jobs, without the leading dashes
+#   configs: an optional list of argument dicts, one job each (before the grid)
+#   grid:    argument -> list of values, every combination is crossed with every config. Arguments
+#            that must vary together are joined by commas, e.g. "env-id,n-stages": [["TurnFaucet_DrS_reuse-v0", 2], ...]
+# A job's `cpus` and `mem_gb` entries override its declared costs, which default to one cpu per env
+# worker and learner process, and --env-rss-gb per env worker plus --learner-rss-gb.
+# Example:
+#   {"script": "drs/drs_reuse_reward_maniskill2.py",
+#    "args": {"total-timesteps": 1000000, "state-save-freq": 100000, "num-envs": 8},
+#    "grid": {"seed": [1, 2, 3],
+#             "env-id,n-stages,control-mode,disc-ckpt": [
+#                 ["TurnFaucet_DrS_reuse-v0", 2, "pd_ee_delta_pose", "reward_checkpoints/TurnFaucet.pt"],
+#                 ["PickAndPlace_DrS_reuse-v0", 3, "pd_ee_delta_pos", "reward_checkpoints/PickAndPlace.pt"]]}}
+
+RESUMABLE_SCRIPTS = ('drs_learn_reward_maniskill2.py', 'drs_reuse_reward_maniskill2.py')
+_COST_KEYS = ('script', 'cpus', 'mem_gb')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--spec", type=str, default=None,
+        help="the json spec of the sweep, see above (not needed with --resume)")
+    parser.add_argument("--sweep-dir", type=str, required=True,
+        help="the directory of the job outputs, their stdout logs and index.json")
+    parser.add_argument("--resume", action='store_true',
+        help="continue the sweep of --sweep-dir: finished jobs are kept, the others are resumed or restarted")
+    parser.add_argument("--cpus", type=str, default=None,
+        help="the cpus the jobs are packed on, as a comma-separated list, defaults to all available cpus")
+    parser.add_argument("--mem-gb", type=float, default=None,
+        help="the memory the jobs are packed into, defaults to 90%% of the available memory")
+    parser.add_argument("--env-rss-gb", type=float, default=1.0,
+        help="the expected resident memory of one env worker")
+    parser.add_argument("--learner-rss-gb", type=float, default=4.0,
+        help="the expected resident memory of a job's training process (networks, replay buffer)")
+    parser.add_argument("--max-retries", type=int, default=2,
+        help="how many times a failed job is restarted")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--asha-min-step", type=int, default=None,
+        help="if set, runs are stopped early by successive halving, with the first rung at this global step")
+    parser.add_argument("--asha-eta", type=float, default=3,
+        help="the reduction factor: rung k is at min-step * eta^k, and the top 1/eta of the runs at a rung continue")
+    parser.add_argument("--asha-metric", type=str, default='eval/success',
+        help="the tensorboard scalar the runs are ranked by, higher is better")
+    parser.add_argument("--asha-window", type=int, default=3,
+        help="the number of evaluations up to a rung that are averaged into the run's metric there")
+    parser.add_argument("--asha-group-by", type=str, nargs='*', default=['script', 'env-id'],
+        help="the arguments of the runs that are ranked together, e.g. runs on different tasks are not compared")
+    parser.add_argument("--asha-interval", type=float, default=60,
+        help="seconds between reading the scalars of a running job")
+    args = parser.parse_args()
+    assert args.spec or args.resume, "a new sweep needs --spec"
+    return args
+
+
+def expand_spec(spec):
+    # the argument dicts of all jobs, in a deterministic order
+    base = dict(spec.get('args', {}))
+    if 'script' in spec:
+        base['script'] = spec['script']
+    grid = spec.get('grid', {})
+    axes = []
+    for key, values in grid.items():
+        names = key.split(',')
+        axes.append([dict(zip(names, v if len(names) > 1 else [v])) for v in values])
+    jobs = []
+    for config in spec.get('configs', [{}]):
+        for point in itertools.product(*axes):
+            job = {**base, **config}
+            for d in point:
+                job.update(d)
+            assert 'script' in job, f"no script for job {job}"
+            jobs.append(job)
+    return jobs
+
+
+def to_argv(job_args):
+    # argparse command line of an argument dict, values are passed as the scripts parse them
+    argv = []
+    for k, v in job_args.items():
+        if k in _COST_KEYS:
+            continue
+        if isinstance(v, bool):
+            v = str(v).lower()
+        if isinstance(v, dict):
+            argv += [f'--{k}', json.dumps(v)]
+        elif isinstance(v, (list, tuple)):
+            argv += [f'--{k}', *map(str, v)]
+        elif v is not None:
+            argv += [f'--{k}', str(v)]
+    return argv
+
+
+def declared_cost(job_args, env_rss_gb, learner_rss_gb):
+    # (cpus, memory in GB): one cpu per env worker and learner process, unless the job declares them
+    num_envs = int(job_args.get('num-envs', 16)) # the defaults of the scripts
+    num_eval_envs = 0 if job_args.get('async-eval') else int(job_args.get('num-eval-envs', 1))
+    learner = int(job_args.get('ddp-workers', 1))
+    cpus = job_args.get('cpus', num_envs + num_eval_envs + learner)
+    mem_gb = job_args.get('mem_gb', env_rss_gb * (num_envs + num_eval_envs) + learner_rss_gb * learner)
+    return int(cpus), float(mem_gb)
+
+
+def available_mem_gb():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 2**20
+    raise RuntimeError('MemAvailable is missing in /proc/meminfo')
+
+
+def find_log_path(output_dir):
+    # the log path a script created under --output-dir (the newest one, if it was restarted from scratch)
+    paths = glob.glob(os.path.join(output_dir, '*', '*', '*', 'args.json'))
+    return os.path.dirname(max(paths, key=os.path.getmtime)) if paths else None
+
+
+class SuccessiveHalving(object):
+    # Asynchronous successive halving (ASHA) for early stopping: rung k is at global step
+    # min_step * eta^k. When the evaluations of a run reach a rung, its metric there (the mean of its
+    # last `window` evaluations up to the first one at or after the rung) is recorded in job['rungs'].
+    # Unless it reaches the top 1/eta of the metrics recorded at that rung by runs of its group before
+    # it, the run is stopped. The first run at a rung always continues.
+    def __init__(self, min_step, eta=3, metric='eval/success', window=3, group_by=('script', 'env-id'), interval=60):
+        self.min_step = min_step
+        self.eta = eta
+        self.metric = metric
+        self.window = window
+        self.group_by = group_by
+        self.interval = interval
+        self._accumulators = {} # job id -> (log_path, EventAccumulator), reloaded incrementally
+        self._last_check = {}
+
+    def group(self, job):
+        return tuple(json.dumps(job['args'].get(k)) for k in self.group_by)
+
+    def scalars(self, job):
+        # (steps, values) of the metric logged by the job so far
+        from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+        log_path, acc = self._accumulators.get(job['id'], (None, None))
+        if log_path != job['log_path']:
+            acc = EventAccumulator(job['log_path'], size_guidance={'scalars': 0})
+            self._accumulators[job['id']] = (job['log_path'], acc)
+        acc.Reload()
+        if self.metric not in acc.Tags()['scalars']:
+            return np.zeros(0), np.zeros(0)
+        events = sorted(acc.Scalars(self.metric), key=lambda e: e.step)
+        return np.array([e.step for e in events]), np.array([e.value for e in events])
+
+    def record_rungs(self, job, jobs):
+        # records the metric of the job at the rungs it reached since the last call, and returns the
+        # first of them at which it fell behind (or None)
+        if job['log_path'] is None:
+            return None
+        steps, values = self.scalars(job)
+        rungs = job.setdefault('rungs', {})
+        rung = self.min_step
+        while len(steps) > 0 and rung <= steps[-1]:
+            key = str(int(rung))
+            if key not in rungs:
+                i = int(np.searchsorted(steps, rung))
+                value = float(values[max(0, i + 1 - self.window):i + 1].mean())
+                recorded = [j['rungs'][key] for j in jobs
+                            if j is not job and key in j.get('rungs', {}) and self.group(j) == self.group(job)]
+                rungs[key] = value
+                if recorded and value < np.percentile(recorded, 100 * (1 - 1 / self.eta)):
+                    return int(rung)
+            rung *= self.eta
+        return None
+
+    def should_stop(self, job, jobs):
+        # checked every `interval` seconds for a running job
+        if time.time() - self._last_check.get(job['id'], 0) < self.interval:
+            return False
+        self._last_check[job['id']] = time.time()
+        rung = self.record_rungs(job, jobs)
+        if rung is not None:
+            job['stopped_at'] = rung
+        return rung is not None
+
+
+class SweepRunner(object):
+    # Packs the jobs of an index (see load_index) onto cpus and memory. A job is a dict:
+    #   id, args, cpus, mem_gb, status ('pending', 'running', 'done', 'failed' or 'stopped' early),
+    #   attempts, returncode, log_path, cpu_ids, and the rungs reached with early stopping
+    def __init__(self, sweep_dir, jobs, cpus, mem_gb, max_retries=2, poll_interval=2.0, early_stopping=None):
+        self.sweep_dir = sweep_dir
+        self.jobs = jobs
+        self.cpus = sorted(cpus)
+        self.mem_gb = mem_gb
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.early_stopping = early_stopping # e.g. SuccessiveHalving
+        self.free_cpus = list(self.cpus)
+        self.free_mem_gb = mem_gb
+        self._procs = {} # job id -> Popen
+
+    def output_dir(self, job):
+        return os.path.join(self.sweep_dir, job['id'])
+
+    def write_index(self):
+        path = os.path.join(self.sweep_dir, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.jobs, f, indent=4)
+        os.replace(path + '.tmp', path)
+
+    def _fits(self, job):
+        # a job larger than the node runs alone
+        if not self._procs:
+            return True
+        return job['cpus'] <= len(self.free_cpus) and job['mem_gb'] <= self.free_mem_gb
+
+    def _command(self, job):
+        argv = [sys.executable, job['args']['script'], *to_argv(job['args']), '--output-dir', self.output_dir(job)]
+        log_path = job['log_path'] or find_log_path(self.output_dir(job))
+        resumable = os.path.basename(job['args']['script']) in RESUMABLE_SCRIPTS
+        if log_path and resumable and os.path.exists(os.path.join(log_path, 'checkpoints', 'state', 'state.pt')):
+            argv += ['--resume', log_path]
+        return argv
+
+    def launch(self, job):
+        # _fits leaves free cpus: enough of them, or all of them for a job larger than the node
+        n = min(job['cpus'], len(self.free_cpus))
+        cpu_ids, self.free_cpus = self.free_cpus[:n], self.free_cpus[n:]
+        self.free_mem_gb -= job['mem_gb']
+        os.makedirs(self.output_dir(job), exist_ok=True)
+        argv = self._command(job)
+        job.update(status='running', attempts=job['attempts'] + 1, cpu_ids=cpu_ids, command=' '.join(argv))
+        log = open(os.path.join(self.output_dir(job), 'stdout.log'), 'a')
+        log.write(f"\n# attempt {job['attempts']}: {job['command']}\n")
+        log.flush()
+        self._procs[job['id']] = subprocess.Popen(
+            argv, stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+            preexec_fn=(lambda: os.sched_setaffinity(0, cpu_ids)) if hasattr(os, 'sched_setaffinity') else None,
+        )
+        log.close()
+        print(f"{time.strftime('%H:%M:%S')} started {job['id']} (attempt {job['attempts']}) on cpus {cpu_ids[0]}-{cpu_ids[-1]}")
+
+    def _release(self, job):
+        self.free_cpus = sorted(set(self.free_cpus) | (set(job['cpu_ids']) & set(self.cpus)))
+        self.free_mem_gb += job['mem_gb']
+
+    def finished(self, job, returncode):
+        del self._procs[job['id']]
+        self._release(job)
+        job['returncode'] = returncode
+        job['log_path'] = find_log_path(self.output_dir(job)) or job['log_path']
+        if returncode == 0:
+            job['status'] = 'done'
+            if self.early_stopping is not None:
+                self.early_stopping.record_rungs(job, self.jobs) # the later runs are compared to it
+        elif job['attempts'] <= self.max_retries:
+            job['status'] = 'pending' # restarted, from its training state if it has one
+        else:
+            job['status'] = 'failed'
+        print(f"{time.strftime('%H:%M:%S')} {job['id']} exited with {returncode}: {job['status']}")
+
+    def poll(self):
+        for job in self.jobs:
+            if job['status'] == 'running' and job['id'] in self._procs:
+                returncode = self._procs[job['id']].poll()
+                if returncode is not None:
+                    self.finished(job, returncode)
+                    continue
+                if job['log_path'] is None:
+                    job['log_path'] = find_log_path(self.output_dir(job))
+                if self.early_stopping is not None and self.early_stopping.should_stop(job, self.jobs):
+                    self.stop(job)
+                    job['status'] = 'stopped'
+                    print(f"{time.strftime('%H:%M:%S')} stopped {job['id']} at rung {job['stopped_at']}")
+
+    def schedule(self):
+        # first fit in sweep order, so that smaller jobs fill the gaps left by larger ones
+        for job in self.jobs:
+            if job['status'] == 'pending' and self._fits(job):
+                self.launch(job)
+
+    def run(self):
+        try:
+            while True:
+                self.poll()
+                self.schedule()
+                self.write_index()
+                if not self._procs:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            self.stop_all()
+        counts = {s: sum(j['status'] == s for j in self.jobs) for s in ('done', 'stopped', 'failed', 'pending')}
+        print(f"Sweep finished: {counts['done']} done, {counts['stopped']} stopped early, {counts['failed']} failed, "
+              f"{counts['pending']} pending, index in {self.sweep_dir}/index.json")
+
+    def stop(self, job):
+        # stops a running job's whole process group (its env workers too)
+        proc = self._procs[job['id']]
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+        except ProcessLookupError:
+            pass
+        del self._procs[job['id']]
+        self._release(job)
+
+    def stop_all(self):
+        # on interruption, running jobs are stopped and left pending for --resume
+        for job in self.jobs:
+            if job['id'] in self._procs:
+                self.stop(job)
+                job['status'] = 'pending'
+                job['log_path'] = find_log_path(self.output_dir(job)) or job['log_path']
+        self.write_index()
+
+
+def make_jobs(spec, env_rss_gb, learner_rss_gb):
+    jobs = []
+    for i, job_args in enumerate(expand_spec(spec)):
+        cpus, mem_gb = declared_cost(job_args, env_rss_gb, learner_rss_gb)
+        jobs.append(dict(
+            id=f'job_{i:04d}', args=job_args, cpus=cpus, mem_gb=mem_gb, status='pending', attempts=0,
+            returncode=None, log_path=None, cpu_ids=[],
+        ))
+    return jobs
+
+
+def load_index(sweep_dir):
+    # the jobs of a previous sweep: finished and early stopped ones are kept, all others are pending again
+    with open(os.path.join(sweep_dir, 'index.json')) as f:
+        jobs = json.load(f)
+    for job in jobs:
+        if job['status'] not in ('done', 'stopped'):
+            job.update(status='pending', attempts=0)
+    return jobs
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    if args.resume:
+        jobs = load_index(args.sweep_dir)
+    else:
+        assert not os.path.exists(os.path.join(args.sweep_dir, 'index.json')), \
+            f"{args.sweep_dir} already holds a sweep, continue it with --resume or choose another --sweep-dir"
+        with open(args.spec) as f:
+            spec = json.load(f)
+        with open(os.path.join(args.sweep_dir, 'spec.json'), 'w') as f:
+            json.dump(spec, f, indent=4)
+        jobs = make_jobs(spec, args.env_rss_gb, args.learner_rss_gb)
+    cpus = [int(c) for c in args.cpus.split(',')] if args.cpus else available_cpus()
+    mem_gb = args.mem_gb if args.mem_gb is not None else 0.9 * available_mem_gb()
+    n_pending = sum(j['status'] == 'pending' for j in jobs)
+    print(f'Sweep of {len(jobs)} jobs ({n_pending} to run) on {len(cpus)} cpus and {mem_gb:.0f} GB')
+    early_stopping = None
+    if args.asha_min_step:
+        early_stopping = SuccessiveHalving(args.asha_min_step, args.asha_eta, args.asha_metric, args.asha_window,
+                                           args.asha_group_by, args.asha_interval)
+    runner = SweepRunner(args.sweep_dir, jobs, cpus, mem_gb, max_retries=args.max_retries, poll_interval=args.poll_interval,
+                         early_stopping=early_stopping)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1)) # stops the jobs like ctrl-c
+    runner.run()
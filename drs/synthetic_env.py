@@ -0,0 +1,146 @@
+import time
+from collections import OrderedDict
+
+import gymnasium as gym
+import numpy as np
+
+
+class DrS_SyntheticEnv(gym.Env):
+    # A pure-NumPy stand-in for the multi-stage ManiSkill2 tasks, with the same contract as DrS_BaseEnv:
+    # the stage indicators are the last entries of the observation (they are appended to `extra`),
+    # `semi_sparse` rewards are sum(stage indicators) + success, and `success` is in the info.
+    # A point moves through `n_stages` waypoints in order, stage j is reached at waypoint j and the
+    # task is solved at the last one. `step_cost` (in seconds) busy-waits to emulate simulation time.
+    SUPPORTED_REWARD_MODES = ("dense", "sparse", "semi_sparse")
+
+    def __init__(self, obs_dim=48, act_dim=7, n_stages=3, step_cost=0.0, goal_thresh=0.1,
+                 reward_mode="semi_sparse", control_mode=None, render_mode=None):
+        assert reward_mode in self.SUPPORTED_REWARD_MODES, reward_mode
+        assert obs_dim >= 2 * act_dim + n_stages - 1, "obs_dim is too small for the position, the target and the stage indicators"
+        self.obs_dim = obs_dim
+        self.act_dim = act_dim
+        self.n_stages = n_stages
+        self.step_cost = step_cost
+        self.goal_thresh = goal_thresh
+        self._reward_mode = reward_mode
+        self.control_mode = control_mode # only one controller, accepted for compatibility with the scripts
+        self.render_mode = render_mode
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, (obs_dim,), dtype=np.float32)
+        self.action_space = gym.spaces.Box(-1, 1, (act_dim,), dtype=np.float32)
+        # fixed features that pad the observation to obs_dim
+        n_features = obs_dim - 2 * act_dim - (n_stages - 1)
+        self._features = np.random.RandomState(0).randn(act_dim, n_features).astype(np.float32)
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.waypoints = self.np_random.uniform(-1, 1, (self.n_stages, self.act_dim)).astype(np.float32)
+        self.pos = self.np_random.uniform(-1, 1, self.act_dim).astype(np.float32)
+        self.stage = 0 # number of waypoints reached so far
+        self._update_stage()
+        return self.get_obs(), self.get_info()
+
+    def step(self, action):
+        self.step_action(action)
+        info = self.get_info()
+        reward = self.get_reward(info=info)
+        return self.get_obs(), reward, info["success"], False, info
+
+    def step_action(self, action):
+        if self.step_cost > 0:
+            end = time.perf_counter() + self.step_cost
+            while time.perf_counter() < end:
+                pass
+        self.pos = np.clip(self.pos + 0.1 * np.clip(action, -1, 1), -1, 1).astype(np.float32)
+        self._update_stage()
+
+    def _update_stage(self):
+        # waypoints are reached in order and stay reached, like a grasp that is not lost
+        while self.stage < self.n_stages and \
+                np.linalg.norm(self.waypoints[self.stage] - self.pos) <= self.goal_thresh:
+            self.stage += 1
+
+    def compute_stage_indicator(self):
+        return OrderedDict(
+            (f'is_stage_{j}_reached', float(self.stage >= j)) for j in range(1, self.n_stages)
+        )
+
+    def evaluate(self, **kwargs):
+        return dict(success=self.stage == self.n_stages)
+
+    def get_info(self):
+        return self.evaluate()
+
+    def _get_obs_extra(self):
+        target = self.waypoints[min(self.stage, self.n_stages - 1)]
+        ret = OrderedDict(
+            tcp_to_target=target - self.pos,
+            features=np.tanh(self.pos @ self._features),
+        )
+        ret.update(self.compute_stage_indicator())
+        return ret
+
+    def get_obs(self):
+        extra = [np.atleast_1d(v) for v in self._get_obs_extra().values()]
+        return np.concatenate([self.pos] + extra).astype(np.float32)
+
+    def compute_dense_reward(self, **kwargs):
+        if self.stage == self.n_stages:
+            return float(self.n_stages + 1)
+        dist = np.linalg.norm(self.waypoints[self.stage] - self.pos)
+        return self.stage + 1 - np.tanh(2 * dist)
+
+    def get_reward(self, **kwargs):
+        if self._reward_mode == "sparse":
+            return float(self.evaluate()["success"])
+        elif self._reward_mode == "dense":
+            return self.compute_dense_reward(**kwargs)
+        elif self._reward_mode == "semi_sparse":
+            return sum(self.compute_stage_indicator().values()) + float(self.evaluate()["success"])
+        else:
+            raise NotImplementedError(self._reward_mode)
+
+
+if "DrS_Synthetic-v0" not in gym.registry: # this module is imported again when run as a script
+    gym.register("DrS_Synthetic-v0", entry_point="drs.synthetic_env:DrS_SyntheticEnv", max_episode_steps=100)
+
+
+def scripted_trajectories(num_traj, seed=0, **kwargs):
+    # demos in the format of load_demo_dataset, from a policy that moves straight to the next waypoint
+    env = gym.make("DrS_Synthetic-v0", **kwargs)
+    trajectories = []
+    for i in range(num_traj):
+        obs, info = env.reset(seed=seed + i)
+        observations, actions, rewards, infos = [obs], [], [], []
+        while True:
+            u = env.unwrapped
+            action = np.clip((u.waypoints[min(u.stage, u.n_stages - 1)] - u.pos) * 10, -1, 1)
+            obs, rew, terminated, truncated, info = env.step(action)
+            observations.append(obs)
+            actions.append(action)
+            rewards.append(rew)
+            infos.append(info)
+            if terminated or truncated:
+                break
+        trajectories.append(dict(
+            observations=np.stack(observations), actions=np.stack(actions).astype(np.float32),
+            rewards=np.array(rewards), infos=infos,
+        ))
+    env.close()
+    return trajectories
+
+
+if __name__ == "__main__":
+    # python -m drs.synthetic_env --output demo_data/Synthetic_100.pkl --env-kwargs '{"obs_dim": 64}'
+    import argparse
+    import json
+    import pickle
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--num-traj", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env-kwargs", type=json.loads, default={})
+    args = parser.parse_args()
+    trajectories = scripted_trajectories(args.num_traj, args.seed, **args.env_kwargs)
+    with open(args.output, 'wb') as f:
+        pickle.dump(trajectories, f)
+    print(f'Saved {len(trajectories)} demos to {args.output}')
@@ -0,0 +1,102 @@
+import glob
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+class TrajectoryLogger(object):
+    # Appends finished trajectories to rotating, compressed, append-only shards.
+    # Writing happens in a background thread; `log` never blocks the caller, and
+    # trajectories are dropped (and counted) if the writer falls too far behind.
+    def __init__(self, log_dir, shard_size=100_000, max_pending=256):
+        self.log_dir = log_dir
+        self.shard_size = shard_size # number of transitions per shard
+        os.makedirs(log_dir, exist_ok=True)
+        existing = glob.glob(os.path.join(log_dir, 'traj_*.npz'))
+        # never touch shards written by a previous run in the same directory
+        self.shard_idx = max([int(os.path.basename(p)[5:-4]) for p in existing], default=-1) + 1
+        self.n_dropped = 0
+        self.n_logged = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._reset_shard()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, next_obs, stage_indices, success, stage_idx):
+        self._raise_error()
+        # copy here, the caller reuses its episode arrays
+        traj = (
+            np.array(next_obs, dtype=np.float32),
+            np.array(stage_indices, dtype=np.int8).reshape(-1),
+            bool(success),
+            int(stage_idx),
+        )
+        try:
+            self._queue.put_nowait(traj)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def close(self):
+        # the writer may have stopped with a full queue, only wait for it while it is alive
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        if self.n_dropped > 0:
+            print(f'TrajectoryLogger: dropped {self.n_dropped} trajectories because the writer could not keep up')
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('writing the trajectory shards failed') from self._error
+
+    def _reset_shard(self):
+        self._next_obs = []
+        self._stage_indices = []
+        self._success = []
+        self._stages = []
+        self._rows = 0
+
+    def _run(self):
+        try:
+            self._consume()
+        except Exception as e:
+            self._error = e
+
+    def _consume(self):
+        while True:
+            traj = self._queue.get()
+            if traj is None:
+                break
+            next_obs, stage_indices, success, stage_idx = traj
+            self._next_obs.append(next_obs)
+            self._stage_indices.append(stage_indices)
+            self._success.append(success)
+            self._stages.append(stage_idx)
+            self._rows += next_obs.shape[0]
+            if self._rows >= self.shard_size:
+                self._write_shard()
+        if self._rows > 0:
+            self._write_shard()
+
+    def _write_shard(self):
+        path = os.path.join(self.log_dir, f'traj_{self.shard_idx:06d}.npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(
+                f,
+                next_observations=np.concatenate(self._next_obs, axis=0),
+                stage_indices=np.concatenate(self._stage_indices, axis=0),
+                traj_lengths=np.array([t.shape[0] for t in self._next_obs], dtype=np.int32),
+                success=np.array(self._success, dtype=bool),
+                traj_stages=np.array(self._stages, dtype=np.int8),
+            )
+        os.replace(path + '.tmp', path) # a shard is either complete or absent
+        self.n_logged += len(self._next_obs)
+        self.shard_idx += 1
+        self._reset_shard()